@@ -0,0 +1,35 @@
+import os
+from argparse import ArgumentParser
+import logging
+
+settings = {}
+filename = 'hommod/default_settings.py'
+with open(filename) as config_file:
+    exec(compile(config_file.read(), filename, 'exec'), settings)
+env_settings = {}
+filename = os.environ['HOMMOD_SETTINGS']
+with open(filename) as config_file:
+    exec(compile(config_file.read(), filename, 'exec'), env_settings)
+settings.update(env_settings)
+settings = {k:v for k, v in settings.items() if k.isupper()}
+
+from hommod.controllers.stage import stage_storage
+stage_storage.stage_dir = settings['STAGE_DIR']
+
+
+_log = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig()
+    if settings['DEBUG']:
+        _log.setLevel(logging.DEBUG)
+
+    parser = ArgumentParser(description='Remove stages of jobs that failed halfway')
+    parser.add_argument('--days', type=int, default=7, help='age of the stages to remove')
+
+    args = parser.parse_args()
+
+    count = stage_storage.remove_older_than(args.days * 24 * 60 * 60)
+    _log.info("removed {} stages".format(count))
@@ -1,4 +1,8 @@
 import os
+import glob
+import json
+import zlib
+import hashlib
 import logging
 import tempfile
 import subprocess
@@ -6,81 +10,244 @@ import xml.etree.ElementTree as ET
 
 from hommod.models.error import InitError, RecoverableError
 from hommod.controllers.fasta import write_fasta
-from hommod.models.align import BlastAlignment
+from hommod.models.align import BlastAlignment, get_percentage_identity
 
 _log = logging.getLogger(__name__)
 
 
+class BlastCache:
+    """
+    Keeps blastp results on disk, so that they can be shared between workers.
+
+    Entries are addressed by a hash of the query sequence, the databank,
+    the databank's modification time and the search parameters. So when a
+    databank is rebuilt, its old entries are no longer found.
+    """
+
+    # Change this when the stored format changes.
+    _VERSION = 1
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+
+    def get_databank_mtime(self, databank):
+        """
+        Returns the latest modification time of the databank's files,
+        or None if there are none.
+        """
+
+        paths = glob.glob(databank + '.*')
+        if len(paths) <= 0:
+            return None
+
+        return max([os.stat(path).st_mtime_ns for path in paths])
+
+    def get_key(self, sequence, databank, databank_mtime, params):
+        s = json.dumps([self._VERSION, sequence, os.path.abspath(databank), databank_mtime, params])
+        return hashlib.sha256(s.encode('ascii')).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json.z')
+
+    def get(self, key, sequence, databank):
+        """
+        Returns the cached hits, or None if not in the cache.
+        """
+
+        if self.cache_dir is None:
+            return None
+
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(zlib.decompress(f.read()).decode('ascii'))
+        except FileNotFoundError:
+            return None
+        except (ValueError, zlib.error):
+            _log.warning("unreadable blast cache entry {}".format(path))
+            return None
+
+        hits = {}
+        for hit_id, hsps in data:
+            hits[hit_id] = [BlastAlignment(hit_id, sequence, databank,
+                                           query_start, query_end, query_alignment,
+                                           subject_start, subject_end, subject_alignment)
+                            for query_start, query_end, query_alignment,
+                                subject_start, subject_end, subject_alignment in hsps]
+        return hits
+
+    def set(self, key, hits):
+        if self.cache_dir is None:
+            return
+
+        data = [[hit_id, [[alignment.query_start, alignment.query_end, alignment.query_alignment,
+                           alignment.subject_start, alignment.subject_end, alignment.subject_alignment]
+                          for alignment in hits[hit_id]]]
+                for hit_id in hits]
+
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Replace at once, so that other workers never read a half written entry.
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(zlib.compress(json.dumps(data, separators=(',', ':')).encode('ascii')))
+        os.replace(tmp_path, path)
+
+
 class Blaster:
 
-    def __init__(self, blastp_exe=None):
+    def __init__(self, blastp_exe=None, num_threads=1, cache=None):
         self.blastp_exe = blastp_exe
+        self.num_threads = num_threads
+
+        if cache is None:
+            cache = BlastCache()
+        self.cache = cache
+
+    def blastp(self, sequence, databank, hit_id_suffix=None, min_identity=None):
+        return self.blastp_many([sequence], databank, hit_id_suffix, min_identity)[0]
+
+    def blastp_many(self, sequences, databank, hit_id_suffix=None, min_identity=None):
+        """
+        Runs a single blastp process for multiple query sequences.
+        Returns a list of hit dictionaries, in the same order as the input sequences.
+
+        Hits with ids that don't end with hit_id_suffix and hsps with a lower
+        percentage identity than min_identity are left out.
+
+        Results are taken from the cache when possible.
+        """
+
+        databank_mtime = self.cache.get_databank_mtime(databank)
+        params = {'hit_id_suffix': hit_id_suffix, 'min_identity': min_identity}
+
+        results = [None] * len(sequences)
+        keys = [None] * len(sequences)
+        if databank_mtime is not None:
+            for i in range(len(sequences)):
+                keys[i] = self.cache.get_key(sequences[i], databank, databank_mtime, params)
+                results[i] = self.cache.get(keys[i], sequences[i], databank)
+
+        missing = [i for i in range(len(sequences)) if results[i] is None]
+        if len(missing) > 0:
+            _log.debug("{} of {} blast queries not in cache".format(len(missing), len(sequences)))
+
+            hits_per_sequence = self._run_blastp([sequences[i] for i in missing], databank,
+                                                 hit_id_suffix, min_identity)
+            for i, hits in zip(missing, hits_per_sequence):
+                if keys[i] is not None:
+                    self.cache.set(keys[i], hits)
+                results[i] = hits
 
-    def blastp(self, sequence, databank):
+        return results
+
+    def _run_blastp(self, sequences, databank, hit_id_suffix, min_identity):
         if self.blastp_exe is None:
             raise InitError("blastp executable is not set")
 
+        query_ids = ['query%i' % i for i in range(len(sequences))]
+        query_sequences = dict(zip(query_ids, sequences))
+
         input_path = tempfile.mktemp()
-        output_path = tempfile.mktemp()
 
-        write_fasta(input_path, {'target': sequence})
+        write_fasta(input_path, query_sequences)
 
+        # Without an output file, blastp writes the xml to stdout.
         cmd = [self.blastp_exe, '-query', input_path, '-db', databank,
-               '-outfmt', '5', '-out', output_path]
+               '-outfmt', '5', '-num_threads', str(self.num_threads)]
 
         _log.debug("{}".format(cmd))
 
         try:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd='/')
-            p.wait()
-
-            if p.returncode != 0:
-                err_msg = p.stderr.read().decode('ascii')
-                if err_msg.startswith("BLAST Database error: No alias or index file found for protein database"):
-                    raise RecoverableError(err_msg)
-
-                raise RuntimeError("%s for databank %s, sequence %s"
-                                   % (err_msg, databank, sequence))
-
-            with open(output_path, 'r') as f:
-                xml_str = f.read()
+            # stderr goes to a file, so that it can't fill up a pipe while we read stdout.
+            with tempfile.TemporaryFile() as stderr_file:
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, cwd='/')
+                try:
+                    hits_per_query = self._parse_alignments(p.stdout, query_sequences, databank,
+                                                            hit_id_suffix, min_identity)
+                    parse_error = None
+                except ET.ParseError as e:
+                    parse_error = e
+                finally:
+                    p.stdout.close()
+                    p.wait()
+
+                if p.returncode != 0:
+                    stderr_file.seek(0)
+                    err_msg = stderr_file.read().decode('ascii')
+                    if err_msg.startswith("BLAST Database error: No alias or index file found for protein database"):
+                        raise RecoverableError(err_msg)
+
+                    raise RuntimeError("%s for databank %s, sequences %s"
+                                       % (err_msg, databank, sequences))
+                elif parse_error is not None:
+                    raise parse_error
         finally:
-            for path in [input_path, output_path]:
-                if os.path.isfile(path):
-                    os.remove(path)
-
-        return self._parse_alignments(xml_str, sequence, databank)
-
-    def _parse_alignments(self, xml_str, full_query_sequence, databank):
-        hits = {}
-        root = ET.fromstring(xml_str)
-        iterations = root.find('BlastOutput_iterations')
-        for it in iterations.findall('Iteration'):
-            for mem in it.findall('Iteration_hits'):
-                for hit in mem.findall('Hit'):
-                    hit_id = hit.find('Hit_def').text
-                    hits[hit_id] = []
-
-                    hsps = hit.find('Hit_hsps')
-                    for hsp in hsps.findall('Hsp'):
-
-                        query_start = int(hsp.find('Hsp_query-from').text)
-                        query_end = int(hsp.find('Hsp_query-to').text)
-                        query_alignment = hsp.find('Hsp_qseq').text
-
-                        subject_start = int(hsp.find('Hsp_hit-from').text)
-                        subject_end = int(hsp.find('Hsp_hit-to').text)
-                        subject_alignment = hsp.find('Hsp_hseq').text
-
-                        hits[hit_id].append(BlastAlignment(hit_id,
-                                                           full_query_sequence,
-                                                           databank,
-                                                           query_start,
-                                                           query_end,
-                                                           query_alignment,
-                                                           subject_start,
-                                                           subject_end,
-                                                           subject_alignment))
-        return hits
+            if os.path.isfile(input_path):
+                os.remove(input_path)
+
+        return [hits_per_query.get(query_id, {}) for query_id in query_ids]
+
+    def _parse_alignments(self, xml_file, query_sequences, databank,
+                          hit_id_suffix=None, min_identity=None):
+        """
+        Parses the xml while it streams in, so that the whole output
+        never needs to be in memory.
+        """
+
+        hits_per_query = {}
+        query_id = None
+        for event, elem in ET.iterparse(xml_file, events=('end',)):
+
+            if elem.tag == 'Iteration_query-def':
+                query_id = elem.text.split()[0]
+                if query_id not in hits_per_query:
+                    hits_per_query[query_id] = {}
+
+            elif elem.tag == 'Hit':
+                hit_id = elem.find('Hit_def').text
+
+                if hit_id_suffix is None or hit_id.endswith(hit_id_suffix):
+                    alignments = self._parse_hit(elem, hit_id, query_sequences[query_id],
+                                                 databank, min_identity)
+                    if len(alignments) > 0:
+                        hits_per_query[query_id][hit_id] = alignments
+
+                elem.clear()
+
+            elif elem.tag == 'Iteration':
+                elem.clear()
+
+        return hits_per_query
+
+    def _parse_hit(self, hit, hit_id, full_query_sequence, databank, min_identity):
+        alignments = []
+        hsps = hit.find('Hit_hsps')
+        for hsp in hsps.findall('Hsp'):
+
+            query_alignment = hsp.find('Hsp_qseq').text
+            subject_alignment = hsp.find('Hsp_hseq').text
+
+            if min_identity is not None and \
+                    get_percentage_identity(query_alignment, subject_alignment) < min_identity:
+                continue
+
+            query_start = int(hsp.find('Hsp_query-from').text)
+            query_end = int(hsp.find('Hsp_query-to').text)
+
+            subject_start = int(hsp.find('Hsp_hit-from').text)
+            subject_end = int(hsp.find('Hsp_hit-to').text)
+
+            alignments.append(BlastAlignment(hit_id,
+                                             full_query_sequence,
+                                             databank,
+                                             query_start,
+                                             query_end,
+                                             query_alignment,
+                                             subject_start,
+                                             subject_end,
+                                             subject_alignment))
+        return alignments
 
 blaster = Blaster()
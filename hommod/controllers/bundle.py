@@ -0,0 +1,242 @@
+import io
+import os
+import struct
+import tarfile
+import zipfile
+import logging
+from abc import ABC, abstractmethod
+
+from hommod.models.align import Alignment
+from hommod.controllers.fasta import parse_fasta_from_string
+
+
+_log = logging.getLogger(__name__)
+
+
+BUNDLE_EXTENSIONS = {'zip': '.zip', 'tgz': '.tgz'}
+
+_ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+_GZIP_TRAILER = struct.Struct('<LL')
+
+
+def write_bundle(path, work_dir_path, dir_name, format_='zip'):
+    """
+    Puts all files from the work directory in a bundle, under dir_name.
+    Zip bundles can be read member by member, tgz bundles only from the start.
+    """
+
+    if format_ == 'zip':
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for root, dir_names, file_names in os.walk(work_dir_path):
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(root, file_name)
+                    zf.write(file_path, os.path.join(dir_name, os.path.relpath(file_path, work_dir_path)))
+    elif format_ == 'tgz':
+        with tarfile.open(path, mode="w:gz") as ar:
+            ar.add(work_dir_path, arcname=dir_name)
+    else:
+        raise ValueError("unknown bundle format: {}".format(format_))
+
+
+class ModelBundle(ABC):
+    """
+    Base class for reading the files that belong to one model.
+    Member names are relative to the bundle's directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dir_name = os.path.splitext(os.path.basename(path))[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def has_member(self, name):
+        pass
+
+    @abstractmethod
+    def read(self, name):
+        pass
+
+    @abstractmethod
+    def open_member(self, name):
+        """
+        Returns a binary file object, to read the member in parts.
+        """
+
+        pass
+
+    @abstractmethod
+    def get_member_size(self, name):
+        pass
+
+    def get_gzip_size(self, name):
+        """
+        Returns the size of the member's gzip stream, or None if the bundle
+        can't serve one without compressing. Bundles that return a size
+        must also implement iter_gzip.
+        """
+
+        return None
+
+    def get_model(self):
+        return self.read('target.pdb').decode('ascii')
+
+    def get_target_sequence(self):
+        """
+        Returns the full target sequence, or None if the bundle has none.
+        """
+
+        if not self.has_member('target.fa'):
+            return None
+
+        return parse_fasta_from_string(self.read('target.fa').decode('ascii'))['target']
+
+    def get_alignments(self):
+        name = 'align.fa'
+        if not self.has_member(name):
+            name = 'align.fasta'
+
+        alignment_fasta = parse_fasta_from_string(self.read(name).decode('ascii'))
+
+        rows = {}
+        for key in alignment_fasta:
+            rows[key] = alignment_fasta[key].split('|')
+
+        alignments = []
+        for n in range(len(list(rows.values())[0])):
+            a = {key: rows[key][n] for key in rows}
+            alignments.append(Alignment(a))
+        return alignments
+
+    def get_selected_targets(self):
+        targets = {}
+        for line in self.read('selected-targets.txt').decode('ascii').split('\n'):
+            if ':' in line:
+                chain_id, target_id = line.split(':')
+                targets[chain_id.strip()] = target_id.strip()
+
+        return targets
+
+
+class ZipBundle(ModelBundle):
+    """
+    Reads members directly, using the zip's central directory.
+    """
+
+    def __init__(self, path):
+        ModelBundle.__init__(self, path)
+
+        self._zip = zipfile.ZipFile(path, 'r')
+        self._names = set(self._zip.namelist())
+
+    def close(self):
+        self._zip.close()
+
+    def _get_member_path(self, name):
+        return os.path.join(self.dir_name, name)
+
+    def has_member(self, name):
+        return self._get_member_path(name) in self._names
+
+    def read(self, name):
+        return self._zip.read(self._get_member_path(name))
+
+    def open_member(self, name):
+        return self._zip.open(self._get_member_path(name))
+
+    def get_member_size(self, name):
+        return self._zip.getinfo(self._get_member_path(name)).file_size
+
+    def get_gzip_size(self, name):
+        info = self._zip.getinfo(self._get_member_path(name))
+        if info.compress_type != zipfile.ZIP_DEFLATED:
+            return None
+
+        return len(_GZIP_HEADER) + info.compress_size + _GZIP_TRAILER.size
+
+    def iter_gzip(self, name, chunk_size=65536):
+        """
+        Yields the member as a gzip stream. The deflated data in the zip is
+        passed on as it is, only the gzip header and trailer are added.
+        """
+
+        info = self._zip.getinfo(self._get_member_path(name))
+        if info.compress_type != zipfile.ZIP_DEFLATED:
+            raise ValueError("{} is not deflated in {}".format(name, self.path))
+
+        with open(self.path, 'rb') as f:
+            f.seek(info.header_offset)
+            header = _ZIP_LOCAL_HEADER.unpack(f.read(_ZIP_LOCAL_HEADER.size))
+            if header[0] != zipfile.stringFileHeader:
+                raise ValueError("bad local file header for {} in {}".format(name, self.path))
+
+            # The local extra field may differ from the one in the central directory.
+            f.seek(header[10] + header[11], os.SEEK_CUR)
+
+            yield _GZIP_HEADER
+
+            remaining = info.compress_size
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if len(chunk) <= 0:
+                    raise ValueError("{} is truncated".format(self.path))
+                remaining -= len(chunk)
+                yield chunk
+
+            yield _GZIP_TRAILER.pack(info.CRC, info.file_size & 0xFFFFFFFF)
+
+
+class TarBundle(ModelBundle):
+    """
+    A gzipped tar can't be read at random, so this decompresses
+    all members at once when opened.
+    """
+
+    def __init__(self, path):
+        ModelBundle.__init__(self, path)
+
+        self._members = {}
+        with tarfile.open(path, 'r:gz') as ar:
+            for info in ar:
+                if not info.isfile():
+                    continue
+
+                f = ar.extractfile(info)
+                try:
+                    self._members[os.path.relpath(info.name, self.dir_name)] = f.read()
+                finally:
+                    f.close()
+
+    def has_member(self, name):
+        return name in self._members
+
+    def read(self, name):
+        if name not in self._members:
+            raise KeyError("no member {} in {}".format(name, self.path))
+        return self._members[name]
+
+    def open_member(self, name):
+        return io.BytesIO(self.read(name))
+
+    def get_member_size(self, name):
+        return len(self.read(name))
+
+
+def open_bundle(path):
+    """
+    Opens a model bundle of either format, determined by its contents.
+    """
+
+    if zipfile.is_zipfile(path):
+        return ZipBundle(path)
+
+    return TarBundle(path)
@@ -0,0 +1,131 @@
+import json
+import sqlite3
+import logging
+from contextlib import closing, contextmanager
+
+from hommod.models.error import InitError
+
+
+_log = logging.getLogger(__name__)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    name TEXT PRIMARY KEY,
+    sequence_id TEXT NOT NULL,
+    species_id TEXT NOT NULL,
+    range_start INTEGER NOT NULL,
+    range_end INTEGER NOT NULL,
+    pdbid TEXT,
+    chain_id TEXT,
+    ctime REAL NOT NULL,
+    covered TEXT,
+    identity REAL
+);
+CREATE INDEX IF NOT EXISTS models_target ON models (sequence_id, species_id, pdbid, chain_id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+class ModelCatalog:
+    """
+    Keeps one row per model tarball in an sqlite database, so that models
+    can be looked up without scanning the model directory.
+
+    Covered residues are stored as a json list of [start, end] intervals,
+    residue numbers start from 1 and ends are inclusive.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def _connect(self):
+        if self.path is None:
+            raise InitError("catalog path is not set")
+
+        # Many worker processes write to the catalog, wait for each other's locks.
+        connection = sqlite3.connect(self.path, timeout=60.0)
+
+        # WAL lets readers go on while a model is being added.
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.executescript(_SCHEMA)
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        """
+        Yields a connection, everything done with it is committed at once at
+        the end, or rolled back on an exception.
+        """
+
+        with closing(self._connect()) as connection:
+            with connection:
+                yield connection
+
+    def add_model(self, connection, name, sequence_id, species_id, range_start, range_end,
+                  template_id, ctime, covered, identity):
+        if covered is not None:
+            covered = json.dumps(covered)
+
+        connection.execute("INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           (name, sequence_id, species_id.upper(), range_start, range_end,
+                            template_id.pdbid.lower() if template_id is not None else None,
+                            template_id.chain_id if template_id is not None else None,
+                            ctime, covered, identity))
+
+    def remove_models(self, connection, names):
+        connection.executemany("DELETE FROM models WHERE name = ?", [(name,) for name in names])
+
+    def find_models(self, sequence_id, species_id, template_id=None):
+        """
+        Returns (name, covered intervals) tuples.
+        Covered is None when it's unknown for a model.
+        """
+
+        query = "SELECT name, covered FROM models WHERE sequence_id = ? AND species_id = ?"
+        params = [sequence_id, species_id.upper()]
+        if template_id is not None:
+            query += " AND pdbid = ? AND chain_id = ?"
+            params += [template_id.pdbid.lower(), template_id.chain_id]
+
+        with closing(self._connect()) as connection:
+            rows = connection.execute(query, params).fetchall()
+
+        return [(name, json.loads(covered) if covered is not None else None) for name, covered in rows]
+
+    def find_models_for_sequences(self, sequence_ids):
+        """
+        Returns (name, covered intervals) tuples per sequence id,
+        for all species and templates.
+        """
+
+        sequence_ids = list(set(sequence_ids))
+        models = {sequence_id: [] for sequence_id in sequence_ids}
+
+        with closing(self._connect()) as connection:
+            # Stay under sqlite's limit on the number of query parameters.
+            for i in range(0, len(sequence_ids), 500):
+                chunk = sequence_ids[i: i + 500]
+                rows = connection.execute("SELECT sequence_id, name, covered FROM models WHERE sequence_id IN (%s)"
+                                          % ', '.join(['?'] * len(chunk)), chunk).fetchall()
+                for sequence_id, name, covered in rows:
+                    models[sequence_id].append((name, json.loads(covered) if covered is not None else None))
+
+        return models
+
+    def list_names(self):
+        with closing(self._connect()) as connection:
+            return [row[0] for row in connection.execute("SELECT name FROM models")]
+
+    def is_complete(self):
+        """
+        Tells whether the catalog has been built from the model directory.
+        Until then, it can't tell which models exist.
+        """
+
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone()
+        return row is not None
+
+    def set_complete(self, connection):
+        connection.execute("INSERT OR REPLACE INTO meta VALUES ('complete', '1')")
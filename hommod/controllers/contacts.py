@@ -0,0 +1,112 @@
+from math import floor
+
+
+def _get_cell(position, cell_size):
+    return (int(floor(position[0] / cell_size)),
+            int(floor(position[1] / cell_size)),
+            int(floor(position[2] / cell_size)))
+
+
+def _get_neighbour_cells(cell):
+    x, y, z = cell
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                yield (x + dx, y + dy, z + dz)
+
+
+def _get_squared_distance(position1, position2):
+    return ((position1[0] - position2[0]) ** 2 +
+            (position1[1] - position2[1]) ** 2 +
+            (position1[2] - position2[2]) ** 2)
+
+
+class PositionGrid:
+    """
+    Spatial hash of 3D positions. With the cell size set to the contact distance,
+    only the 27 cells around a position need to be checked for neighbours.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+
+        self._cells = {}
+
+    def add(self, key, position):
+        cell = _get_cell(position, self.cell_size)
+        if cell not in self._cells:
+            self._cells[cell] = []
+        self._cells[cell].append((key, position))
+
+    def has_neighbour(self, position, distance):
+        if distance > self.cell_size:
+            raise ValueError("distance {} exceeds the grid cell size {}".format(distance, self.cell_size))
+
+        squared_distance = distance ** 2
+        for cell in _get_neighbour_cells(_get_cell(position, self.cell_size)):
+            for key, other_position in self._cells.get(cell, []):
+                if _get_squared_distance(position, other_position) < squared_distance:
+                    return True
+        return False
+
+    def get_cells(self):
+        return self._cells
+
+
+def any_within_distance(positions, other_positions, distance):
+    """
+    Tells whether any position from the first list lies within the given
+    distance from any position in the second list.
+    """
+
+    grid = PositionGrid(distance)
+    for position in other_positions:
+        grid.add(None, position)
+
+    for position in positions:
+        if grid.has_neighbour(position, distance):
+            return True
+    return False
+
+
+def get_interacting_chains(positions_per_chain, distance):
+    """
+    For every chain id in the input, lists the chain ids that have at
+    least one position within the given distance.
+    """
+
+    grid = PositionGrid(distance)
+    for chain_id in positions_per_chain:
+        for position in positions_per_chain[chain_id]:
+            grid.add(chain_id, position)
+
+    cells = grid.get_cells()
+    cell_chain_ids = {cell: set([chain_id for chain_id, position in cells[cell]]) for cell in cells}
+
+    squared_distance = distance ** 2
+    pairs = set()
+    for cell in cells:
+        for neighbour_cell in _get_neighbour_cells(cell):
+            if neighbour_cell not in cells:
+                continue
+
+            # Skip the distance checks if these cells can't add a new pair.
+            if not any([(chain_id, other_chain_id) not in pairs
+                        for chain_id in cell_chain_ids[cell]
+                        for other_chain_id in cell_chain_ids[neighbour_cell]
+                        if chain_id != other_chain_id]):
+                continue
+
+            for chain_id, position in cells[cell]:
+                for other_chain_id, other_position in cells[neighbour_cell]:
+                    if chain_id == other_chain_id or (chain_id, other_chain_id) in pairs:
+                        continue
+
+                    if _get_squared_distance(position, other_position) < squared_distance:
+                        pairs.add((chain_id, other_chain_id))
+                        pairs.add((other_chain_id, chain_id))
+
+    interacting = {chain_id: [] for chain_id in positions_per_chain}
+    for chain_id, other_chain_id in sorted(pairs):
+        interacting[chain_id].append(other_chain_id)
+    return interacting
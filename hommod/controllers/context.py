@@ -5,7 +5,8 @@ import os
 from hommod.models.error import ModelRunError, InitError
 from hommod.models.aminoacid import AminoAcid
 from hommod.models.residue import ModelingResidue
-from hommod.controllers.yasara import YasaraObject
+from hommod.controllers.yasara import yasara_pool
+from hommod.controllers.contacts import any_within_distance, get_interacting_chains
 
 
 class ModelingContext:
@@ -18,12 +19,15 @@ class ModelingContext:
         self.target_species_id = None
         self.target_sequences = {}
 
+        self._atom_positions = None
+        self._interacting_chains = None
+
     def __enter__(self):
-        self.yasara = YasaraObject(self.yasara_dir)
+        self.yasara = yasara_pool.acquire(self.yasara_dir)
         return self
 
     def __exit__(self, type_, value, traceback):
-        self.yasara.Exit()
+        yasara_pool.release(self.yasara, failed=type_ is not None)
 
     def set_main_target(self, main_target_sequence, target_species_id, main_target_chain_id):
         self.target_species_id = target_species_id
@@ -45,6 +49,7 @@ class ModelingContext:
             raise ModelRunError("template object is not set")
 
         self.yasara.DelMol('obj %i and protein and mol %s' % (self.template_obj, chain_id))
+        self.clear_atom_positions()
 
     def get_sequence(self, chain_id):
         sequence = ""
@@ -70,26 +75,55 @@ class ModelingContext:
 
         return residues
 
-    def list_interacting_chains(self, chain_id):
-        return self.yasara.ListMol(
-                 'protein and obj %i and not mol %s with distance<4.5 from obj %i mol %s' %
-                 (self.template_obj, chain_id, self.template_obj, chain_id),
-                 'MOL')
+    def clear_atom_positions(self):
+        self._atom_positions = None
+        self._interacting_chains = None
+
+    def _get_atom_positions(self):
+        """
+        Lists the coordinates of all protein atoms in the template with a single
+        yasara call. These are kept until the template changes.
+        """
 
-    def residue_interacts_with(self, residue, interacting_residues):
         if self.template_obj is None:
             raise ModelRunError("template object is not set")
 
-        if 'CA' not in residue.atom_numbers:
-            return False
+        if self._atom_positions is None or self._atom_positions[0] != self.template_obj:
+            positions = {}
+            for s in self.yasara.ListAtom("obj %i and protein" % self.template_obj,
+                                          "MOL ATOMNUM X Y Z"):
+                chain_id, atomnum, x, y, z = s.split()
+                positions[int(atomnum)] = (chain_id, (float(x), float(y), float(z)))
 
-        interacting_residues = list(filter(lambda res: 'CA' in res.atom_numbers, interacting_residues))
+            self._atom_positions = (self.template_obj, positions)
+            self._interacting_chains = None
+
+        return self._atom_positions[1]
+
+    def list_interacting_chains(self, chain_id):
+        if self._interacting_chains is None:
+            positions_per_chain = {}
+            for atom_chain_id, position in self._get_atom_positions().values():
+                if atom_chain_id not in positions_per_chain:
+                    positions_per_chain[atom_chain_id] = []
+                positions_per_chain[atom_chain_id].append(position)
 
-        atoms = self.yasara.ListAtom("CA and atom %i-%i and obj %i with distance<6 from %i" %
-                                     (interacting_residues[0].atom_numbers['CA'],
-                                      interacting_residues[-1].atom_numbers['CA'],
-                                      self.template_obj, residue.atom_numbers['CA']))
-        return len(atoms) > 0
+            self._interacting_chains = get_interacting_chains(positions_per_chain, 4.5)
+
+        return self._interacting_chains.get(chain_id, [])
+
+    def residues_interact(self, residues, interacting_residues):
+        positions = self._get_atom_positions()
+
+        ca_positions = [positions[residue.atom_numbers['CA']][1] for residue in residues
+                        if 'CA' in residue.atom_numbers]
+        interacting_ca_positions = [positions[residue.atom_numbers['CA']][1] for residue in interacting_residues
+                                    if 'CA' in residue.atom_numbers]
+
+        return any_within_distance(ca_positions, interacting_ca_positions, 6.0)
+
+    def residue_interacts_with(self, residue, interacting_residues):
+        return self.residues_interact([residue], interacting_residues)
 
     def get_secondary_structure(self, chain_id):
         if self.template_obj is None:
@@ -1,5 +1,6 @@
 import logging
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from hommod.controllers.rost import get_min_identity
 from hommod.controllers.blast import blaster
@@ -24,7 +25,8 @@ class DomainAligner:
                  similar_ranges_max_length_difference_percentage=None,
                  template_blast_databank=None,
                  min_percentage_coverage=None,
-                 highly_homologous_percentage_identity=None):
+                 highly_homologous_percentage_identity=None,
+                 kmad_concurrency=1):
 
             self.forbidden_interpro_domains = forbidden_interpro_domains
             self.similar_ranges_min_overlap_percentage = similar_ranges_min_overlap_percentage
@@ -33,7 +35,14 @@ class DomainAligner:
             self.min_percentage_coverage = min_percentage_coverage
             self.highly_homologous_percentage_identity = highly_homologous_percentage_identity
 
-    def get_domain_alignments(self, target_sequence, require_resnum=None, template_id=None):
+            # Number of kmad processes to run at once, per worker.
+            self.kmad_concurrency = kmad_concurrency
+
+    def get_domain_alignments(self, target_sequence, require_resnum=None, template_id=None,
+                              interpro_ranges=None):
+        """
+        Pass interpro_ranges when they're already known, otherwise they're looked up.
+        """
 
         ModelLogger.get_current().add("getting domain alignments for sequence {}, resnum {}, template {}"
                                       .format(target_sequence, require_resnum, template_id))
@@ -41,7 +50,8 @@ class DomainAligner:
         if self.min_percentage_coverage is None:
             raise InitError("min percentage coverage is not set")
 
-        interpro_ranges = interpro.get_domain_ranges(target_sequence)
+        if interpro_ranges is None:
+            interpro_ranges = interpro.get_domain_ranges(target_sequence)
         _log.debug("{} ranges from interpro".format(len(interpro_ranges)))
 
         sample_ranges = self._filter_forbidden_ranges(interpro_ranges)
@@ -63,6 +73,10 @@ class DomainAligner:
 
             _log.debug("sampling {} ranges".format(len(merged_sample_ranges)))
 
+            # Search templates for all new ranges of this round at once:
+            ranges_blast_hits = self._blast_ranges([range_ for range_ in merged_sample_ranges
+                                                    if range_ not in checked_ranges])
+
             # Check the largest ranges first. If that yields, then the smaller ones don't matter.
             for range_ in sorted(merged_sample_ranges, key=lambda r: r.get_length(), reverse=True):
 
@@ -79,7 +93,7 @@ class DomainAligner:
 
                 ModelLogger.get_current().add("examining range {}".format(range_))
 
-                hit_candidates = self._get_hits(range_, template_id)
+                hit_candidates = self._get_hits(range_, template_id, ranges_blast_hits[range_])
 
                 _log.debug('trying range: {} against {} hits'.format(range_, len(hit_candidates)))
 
@@ -280,15 +294,25 @@ class DomainAligner:
 
         return alignment.template_alignment[start: end]
 
-    def _get_hits(self, range_, template_id):
+    def _blast_ranges(self, ranges):
         if self.template_blast_databank is None:
             raise InitError("blast databank is not set")
 
-        blast_hits = blaster.blastp(range_.get_sub_sequence(), self.template_blast_databank)
+        if len(ranges) <= 0:
+            return {}
+
+        blast_hits = blaster.blastp_many([range_.get_sub_sequence() for range_ in ranges],
+                                         self.template_blast_databank)
+        return dict(zip(ranges, blast_hits))
+
+    def _get_hits(self, range_, template_id, blast_hits=None):
+        if blast_hits is None:
+            blast_hits = self._blast_ranges([range_])[range_]
+
         _log.debug("{} blast hits to filter".format(len(blast_hits)))
 
         count_template_hits = 0
-        good_hits = []
+        candidates = []
         for hit_id in blast_hits:
             for alignment in blast_hits[hit_id]:
                 hit_template_id = TemplateID(alignment.get_hit_accession_code(),
@@ -307,27 +331,32 @@ class DomainAligner:
                     _log.debug(f"skipping hit {hit_template_id}, because it has no secondary structure")
                     continue
 
-                # Replace the blast hit's alignment with the kmad alignment.
-                template_secstr = dssp.get_secondary_structure(hit_template_id)
-                template_sequence = dssp.get_sequence(hit_template_id)
-                try:
-                    kmad_alignment = kmad_aligner.align(template_sequence, template_secstr,
-                                                        range_.get_sub_sequence())
-                except:
-                    _log.warn(traceback.format_exc())
+                candidates.append((alignment,
+                                   dssp.get_sequence(hit_template_id),
+                                   dssp.get_secondary_structure(hit_template_id)))
 
-                    # If kmad fails, then skip this one :(
-                    continue
-                alignment.full_query_sequence = range_.sequence
-                alignment.query_start = range_.start + 1
-                alignment.query_end = range_.end
-                alignment.subject_start = 1
-                alignment.subject_end = len(template_sequence)
-                alignment.query_alignment = kmad_alignment.target_alignment
-                alignment.subject_alignment = kmad_alignment.template_alignment
+        kmad_alignments = self._kmad_align_all(range_.get_sub_sequence(),
+                                               [(template_sequence, template_secstr)
+                                                for alignment, template_sequence, template_secstr in candidates])
 
-                if alignment.get_percentage_identity() >= get_min_identity(alignment.count_aligned_residues()):
-                    good_hits.append(alignment)
+        # Keep the blast hit order, so that template selection doesn't depend on timing.
+        good_hits = []
+        for (alignment, template_sequence, template_secstr), kmad_alignment in zip(candidates, kmad_alignments):
+            if kmad_alignment is None:
+                # If kmad fails, then skip this one :(
+                continue
+
+            # Replace the blast hit's alignment with the kmad alignment.
+            alignment.full_query_sequence = range_.sequence
+            alignment.query_start = range_.start + 1
+            alignment.query_end = range_.end
+            alignment.subject_start = 1
+            alignment.subject_end = len(template_sequence)
+            alignment.query_alignment = kmad_alignment.target_alignment
+            alignment.subject_alignment = kmad_alignment.template_alignment
+
+            if alignment.get_percentage_identity() >= get_min_identity(alignment.count_aligned_residues()):
+                good_hits.append(alignment)
 
         if count_template_hits == 0 and template_id is not None:
             _log.warning("domain sequence {} has no suitable hits with {}".format(range_.get_sub_sequence(), template_id))
@@ -335,6 +364,28 @@ class DomainAligner:
 
         return good_hits
 
+    def _kmad_align(self, target_sequence, template_sequence, template_secstr):
+        try:
+            return kmad_aligner.align(template_sequence, template_secstr, target_sequence)
+        except:
+            _log.warn(traceback.format_exc())
+            return None
+
+    def _kmad_align_all(self, target_sequence, templates):
+        """
+        Aligns the target sequence to all (template sequence, template secstr) pairs.
+        Returns the alignments in the same order, None where kmad failed.
+        """
+
+        if self.kmad_concurrency <= 1 or len(templates) <= 1:
+            return [self._kmad_align(target_sequence, template_sequence, template_secstr)
+                    for template_sequence, template_secstr in templates]
+
+        # Every kmad call is a subprocess, so threads are enough to run them in parallel.
+        with ThreadPoolExecutor(max_workers=self.kmad_concurrency) as executor:
+            return list(executor.map(lambda template: self._kmad_align(target_sequence, *template),
+                                     templates))
+
     def _is_better_than(self, hit, other_hit):
         _log.debug("compare new {} {}% with current best {} {}%"
                    .format(hit.hit_id, hit.get_percentage_identity(),
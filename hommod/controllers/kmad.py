@@ -1,19 +1,37 @@
 import tempfile
 import os
+import json
+import hashlib
 import subprocess
 import logging
+from collections import OrderedDict
+from threading import Lock
 
 from hommod.models.align import TargetTemplateAlignment
 from hommod.controllers.fasta import write_fasta, parse_fasta
 from hommod.models.error import InitError
+from hommod.services.helpers.cache import cache_manager as cm
 
 
 _log = logging.getLogger(__name__)
 
 class KmadAligner:
-    def __init__(self, kmad_exe=None):
+    def __init__(self, kmad_exe=None, cache_size=10000, use_redis=False):
         self.kmad_exe = kmad_exe
 
+        # Number of alignments to keep in memory.
+        self.cache_size = cache_size
+
+        # Whether to share alignments between workers through redis.
+        self.use_redis = use_redis
+
+        self.cache_hits = 0
+        self.redis_hits = 0
+        self.cache_misses = 0
+
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
     def align(self, template_sequence, template_secstr, target_sequence,
               gap_open=-13.0, gap_extend=-0.4, modifier=3.0):
 
@@ -29,6 +47,74 @@ class KmadAligner:
             raise ValueError("template sequence ({}) has different length than secondary structure ({})"
                              .format(len(template_sequence), len(template_secstr)))
 
+        key = self._get_cache_key(template_sequence, template_secstr, target_sequence,
+                                  gap_open, gap_extend, modifier)
+
+        aligned = self._get_cached(key)
+        if aligned is None:
+            aligned = self._align(template_sequence, template_secstr, target_sequence,
+                                  gap_open, gap_extend, modifier)
+            self._set_cached(key, aligned)
+
+        # Alignment objects get modified by the callers, so always return a new one.
+        return TargetTemplateAlignment(aligned[0], aligned[1])
+
+    def get_cache_stats(self):
+        with self._lock:
+            count_calls = self.cache_hits + self.redis_hits + self.cache_misses
+            return {'hits': self.cache_hits,
+                    'redis_hits': self.redis_hits,
+                    'misses': self.cache_misses,
+                    'hit_rate': (self.cache_hits + self.redis_hits) / count_calls if count_calls > 0 else 0.0,
+                    'size': len(self._cache)}
+
+    def _get_cache_key(self, template_sequence, template_secstr, target_sequence,
+                       gap_open, gap_extend, modifier):
+        s = json.dumps([template_sequence, template_secstr, target_sequence, gap_open, gap_extend, modifier])
+        return 'kmad_%s' % hashlib.sha256(s.encode('ascii')).hexdigest()
+
+    def _get_cached(self, key):
+        with self._lock:
+            aligned = self._cache.get(key)
+            if aligned is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return aligned
+
+        aligned = None
+        if self.use_redis:
+            try:
+                aligned = cm.get(key)
+            except:
+                _log.exception("getting kmad alignment from redis")
+
+        with self._lock:
+            if aligned is not None:
+                self.redis_hits += 1
+                self._store(key, aligned)
+            else:
+                self.cache_misses += 1
+
+        return aligned
+
+    def _set_cached(self, key, aligned):
+        with self._lock:
+            self._store(key, aligned)
+
+        if self.use_redis:
+            try:
+                cm.set(key, aligned)
+            except:
+                _log.exception("storing kmad alignment in redis")
+
+    def _store(self, key, aligned):
+        self._cache[key] = aligned
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _align(self, template_sequence, template_secstr, target_sequence,
+               gap_open, gap_extend, modifier):
         kmad_template_sequence = self._to_kmad_sequence(template_sequence, template_secstr)
         kmad_target_sequence = self._to_kmad_sequence(target_sequence)
 
@@ -50,8 +136,7 @@ class KmadAligner:
                 if os.path.isfile(path):
                     os.remove(path)
 
-        alignment = TargetTemplateAlignment(aligned['target'], aligned['template'])
-        return alignment
+        return aligned['target'], aligned['template']
 
     def _run_kmad(self, input_path, output_path, gap_open, gap_extend, modifier):
 
@@ -315,9 +315,10 @@ class Modeler:
         if self.uniprot_databank is None:
             raise InitError("species databank dir not set")
 
-        target_sequences = {}
+        target_acs = set()
 
-        hits = blaster.blastp(template_chain_sequence, self.uniprot_databank)
+        hits = blaster.blastp(template_chain_sequence, self.uniprot_databank,
+                              hit_id_suffix='_' + target_species_id.upper(), min_identity=70.0)
         for hit_id in hits:
             if not hit_id.endswith('_' + target_species_id.upper()):
                 continue
@@ -328,8 +329,9 @@ class Modeler:
                 pcov = alignment.get_percentage_coverage()
                 if pid > 70.0:
                     if pcov > 90.0:
-                        target_sequences[ac] = uniprot.get_sequence(ac)
-        return target_sequences
+                        target_acs.add(ac)
+
+        return uniprot.get_sequences(target_acs)
 
     def _preserves_interactions(self, context,
                                 candidate_target_segment, candidate_chain_id,
@@ -363,9 +365,8 @@ class Modeler:
 
             # Check every target-covered residue.
             # Return True if a single interacting residue pair is found:
-            for candidate_residue in covered_candidate_residues:
-                if context.residue_interacts_with(candidate_residue, covered_residues):
-                    return True
+            if context.residues_interact(covered_candidate_residues, covered_residues):
+                return True
 
         return False
 
@@ -510,9 +511,6 @@ class Modeler:
             f.write('\n')
 
     def _wrap_template(self, main_target_sequence, target_species_id, main_domain_alignment, template_id):
-        model_name = model_storage.get_model_name(main_target_sequence, target_species_id,
-                                                  main_domain_alignment, template_id)
-
         work_dir_path = tempfile.mkdtemp()
         align_fasta_path = os.path.join(work_dir_path, 'align.fa')
         full_target_path = os.path.join(work_dir_path, 'target.fa')
@@ -539,8 +537,8 @@ class Modeler:
                                                   target_species_id,
                                                   main_domain_alignment,
                                                   template_id)
-            with tarfile.open(tar_path, mode="w:gz") as ar:
-                ar.add(work_dir_path, arcname=model_name)
+            model_storage.store_model(work_dir_path, tar_path, main_target_sequence,
+                                      main_domain_alignment.get_percentage_identity())
 
             return tar_path
         finally:
@@ -570,12 +568,6 @@ class Modeler:
 
     def _model_run(self, main_domain_alignment, chain_alignments, context, main_target_sequence, require_resnum):
 
-        model_name = model_storage.get_model_name(context.get_main_target_sequence(),
-                                                  context.target_species_id,
-                                                  main_domain_alignment,
-                                                  TemplateID(context.template_pdbid,
-                                                             context.main_target_chain_id))
-
         work_dir_path = tempfile.mkdtemp()
         full_target_path = os.path.join(work_dir_path, 'target.fa')
         align_fasta_path = os.path.join(work_dir_path, 'align.fa')
@@ -661,8 +653,8 @@ class Modeler:
                                                   main_domain_alignment,
                                                   TemplateID(context.template_pdbid,
                                                              context.main_target_chain_id))
-            with tarfile.open(tar_path, mode="w:gz") as ar:
-                ar.add(work_dir_path, arcname=model_name)
+            model_storage.store_model(work_dir_path, tar_path, context.get_main_target_sequence(),
+                                      main_domain_alignment.get_percentage_identity())
 
             return tar_path
         except RuntimeError as e:
@@ -718,6 +710,7 @@ class Modeler:
                                                             main_domain_alignment,
                                                             TemplateID(context.template_pdbid,
                                                                        context.main_target_chain_id))
+                os.makedirs(os.path.dirname(tar_path), exist_ok=True)
                 with tarfile.open(tar_path, mode="w:gz") as ar:
                     ar.add(work_dir_path, arcname=model_name)
 
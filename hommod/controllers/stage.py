@@ -0,0 +1,85 @@
+import os
+import time
+import pickle
+import logging
+from uuid import uuid4
+
+from hommod.models.error import InitError
+
+
+_log = logging.getLogger(__name__)
+
+
+class StageStorage:
+    """
+    Hands objects from one task to the next through files in a directory,
+    that all workers share. Tasks only need to pass the reference around.
+    """
+
+    def __init__(self, stage_dir=None):
+        self.stage_dir = stage_dir
+
+    def _get_path(self, ref):
+        if self.stage_dir is None:
+            raise InitError("stage directory is not set")
+
+        # References come in through the message broker, don't let them point elsewhere.
+        if os.path.basename(ref) != ref:
+            raise ValueError("invalid stage reference: {}".format(ref))
+
+        return os.path.join(self.stage_dir, ref + '.pickle')
+
+    def put(self, obj):
+        """
+        Stores the object and returns a reference to it.
+        """
+
+        ref = str(uuid4())
+        path = self._get_path(ref)
+
+        if not os.path.isdir(self.stage_dir):
+            os.makedirs(self.stage_dir, exist_ok=True)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        return ref
+
+    def get(self, ref):
+        with open(self._get_path(ref), 'rb') as f:
+            return pickle.load(f)
+
+    def remove(self, ref):
+        try:
+            os.remove(self._get_path(ref))
+        except FileNotFoundError:
+            _log.warning("stage {} was already removed".format(ref))
+
+    def remove_older_than(self, max_age):
+        """
+        Removes stages of jobs that failed halfway, those are never picked up.
+        Returns the number of removed stages.
+        """
+
+        if self.stage_dir is None:
+            raise InitError("stage directory is not set")
+
+        if not os.path.isdir(self.stage_dir):
+            return 0
+
+        count = 0
+        min_mtime = time.time() - max_age
+        for entry in os.scandir(self.stage_dir):
+            if entry.is_file() and entry.stat().st_mtime < min_mtime:
+                try:
+                    os.remove(entry.path)
+                    count += 1
+                except FileNotFoundError:
+                    pass
+
+        return count
+
+
+stage_storage = StageStorage()
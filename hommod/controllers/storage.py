@@ -1,13 +1,15 @@
 import os
+import json
+import time
 import logging
 from hashlib import md5
 from glob import glob
-import tarfile
 from filelock import FileLock
 
-from hommod.models.align import Alignment
 from hommod.models.error import InitError
-from hommod.controllers.fasta import parse_fasta_from_string
+from hommod.models.template import TemplateID
+from hommod.controllers.catalog import ModelCatalog
+from hommod.controllers.bundle import open_bundle, write_bundle, BUNDLE_EXTENSIONS
 from hommod.controllers.pdb import parse_seqres_from_string
 from hommod.controllers.clustal import clustal_aligner
 
@@ -16,20 +18,52 @@ _log = logging.getLogger(__name__)
 
 
 class ModelStorage:
-    def __init__(self, model_dir=None):
+    def __init__(self, model_dir=None, catalog=None, sharded=False, lock_dir=None, bundle_format='tgz'):
         self.model_dir = model_dir
 
+        # Format of new model bundles, 'zip' or 'tgz'. Both are read.
+        self.bundle_format = bundle_format
+
+        # Whether new models go in subdirectories, per sequence id prefix.
+        self.sharded = sharded
+
+        # Where lock files go, None means the model directory.
+        self.lock_dir = lock_dir
+
+        if catalog is None:
+            catalog = ModelCatalog()
+        self.catalog = catalog
+
     def get_sequence_id(self, sequence):
         hash_ = md5(sequence.encode('ascii')).hexdigest()
         return hash_
 
+    def _use_catalog(self):
+        if self.catalog.path is None or not os.path.isfile(self.catalog.path):
+            return False
+
+        return self.catalog.is_complete()
+
     def list_all_models(self):
         if self.model_dir is None:
             raise InitError("model directory is not set")
 
-        wildcard = os.path.join(self.model_dir, "*.tgz")
+        if self._use_catalog():
+            return [self.get_tar_path_from_name(name) for name in self.catalog.list_names()]
+
+        return self._scan_all_models()
+
+    def _glob_bundles(self, dir_path, wildcard):
+        paths = []
+        for extension in BUNDLE_EXTENSIONS.values():
+            paths += glob(os.path.join(dir_path, wildcard + extension))
+        return paths
+
+    def _scan_all_models(self):
+        paths = self._glob_bundles(self.model_dir, "*")
+        if self.sharded:
+            paths += self._glob_bundles(os.path.join(self.model_dir, "*", "*"), "*")
 
-        paths = glob(wildcard)
         paths = [path for path in paths if '_error' not in path]
         return paths
 
@@ -44,8 +78,23 @@ class ModelStorage:
 
         species_id = species_id.upper()
 
+        if self._use_catalog():
+            matching_paths = []
+            for name, covered in self.catalog.find_models(sequence_id, species_id, template_id):
+                path = self.get_tar_path_from_name(name)
+
+                if required_resnum is None:
+                    matching_paths.append(path)
+                elif covered is not None:
+                    if self._intervals_cover(covered, required_resnum):
+                        matching_paths.append(path)
+                elif self.model_covers(path, target_sequence, required_resnum):
+                    matching_paths.append(path)
+
+            return matching_paths
+
         if template_id is None:
-            wildcard = "%s_%s_*.tgz" % (sequence_id, species_id)
+            wildcard = "%s_%s_*" % (sequence_id, species_id)
         else:
             case_insensitive_pdbid = ""
             for i in range(len(template_id.pdbid)):
@@ -55,11 +104,12 @@ class ModelStorage:
                 else:
                     case_insensitive_pdbid += char
 
-            wildcard = "%s_%s_*_%s-%s.tgz" % (sequence_id, species_id, case_insensitive_pdbid, template_id.chain_id)
+            wildcard = "%s_%s_*_%s-%s" % (sequence_id, species_id, case_insensitive_pdbid, template_id.chain_id)
 
-        wildcard = os.path.join(self.model_dir, wildcard)
+        paths = self._glob_bundles(self.model_dir, wildcard)
+        if self.sharded:
+            paths += self._glob_bundles(self.get_shard_dir(sequence_id), wildcard)
 
-        paths = glob(wildcard)
         paths = [path for path in paths if '_error' not in path]
 
         if required_resnum is None:
@@ -72,12 +122,139 @@ class ModelStorage:
 
             return matching_paths
 
-    def model_covers(self, tar_path, sequence, covered_residue_number):
-        sequence_id = self.get_sequence_id(sequence)
+    def find_models_bulk(self, queries):
+        """
+        Looks up models for many (sequence, species id, required resnum, template id) queries at once.
+        Queries are grouped by sequence and the model directory is listed only once for all of them.
+
+        Yields (query index, model paths) tuples, in the order of the groups.
+        """
+
+        if self.model_dir is None:
+            raise InitError("model directory is not set")
 
-        seqres_sequences = parse_seqres_from_string(self.extract_model(tar_path))
+        indices_per_sequence_id = {}
+        for index, (sequence, species_id, required_resnum, template_id) in enumerate(queries):
+            sequence_id = self.get_sequence_id(sequence)
+            if sequence_id not in indices_per_sequence_id:
+                indices_per_sequence_id[sequence_id] = []
+            indices_per_sequence_id[sequence_id].append(index)
+
+        if self._use_catalog():
+            models = self.catalog.find_models_for_sequences(indices_per_sequence_id.keys())
+        else:
+            models = self._list_models_for_sequences(indices_per_sequence_id.keys())
+
+        for sequence_id in indices_per_sequence_id:
+            candidates = [(name, covered, self.parse_model_name(name)) for name, covered in models[sequence_id]]
+
+            for index in indices_per_sequence_id[sequence_id]:
+                sequence, species_id, required_resnum, template_id = queries[index]
+
+                paths = []
+                for name, covered, (name_sequence_id, name_species_id, range_start, range_end,
+                                    name_template_id) in candidates:
+                    if name_species_id != species_id.upper():
+                        continue
+                    if template_id is not None and (name_template_id is None or name_template_id != template_id):
+                        continue
+
+                    path = self.get_tar_path_from_name(name)
+                    if required_resnum is not None:
+                        if covered is None:
+                            if not self.model_covers(path, sequence, required_resnum):
+                                continue
+                        elif not self._intervals_cover(covered, required_resnum):
+                            continue
+
+                    paths.append(path)
+
+                yield index, paths
+
+    def _list_models_for_sequences(self, sequence_ids):
+        """
+        Returns (name, covered intervals) tuples per sequence id, from one listing
+        of the model directory. Covered is None, since it's not in the catalog.
+        """
+
+        sequence_ids = set(sequence_ids)
+        models = {sequence_id: [] for sequence_id in sequence_ids}
+
+        dir_paths = [self.model_dir]
+        if self.sharded:
+            dir_paths += sorted(set([self.get_shard_dir(sequence_id) for sequence_id in sequence_ids]))
+
+        extensions = tuple(BUNDLE_EXTENSIONS.values())
+        for dir_path in dir_paths:
+            if not os.path.isdir(dir_path):
+                continue
+
+            for entry in os.scandir(dir_path):
+                if not entry.name.endswith(extensions) or '_error' in entry.name:
+                    continue
+
+                sequence_id = self.get_sequence_id_from_name(entry.name)
+                if sequence_id in models:
+                    models[sequence_id].append((self.get_model_name_from_path(entry.name), None))
+
+        return models
+
+    def model_covers(self, tar_path, sequence, covered_residue_number):
+        covered = self.read_covered_intervals(tar_path, sequence)
+        if covered is None:
+            # An older model, determine it once and keep it for next time.
+            covered = self.get_covered_intervals(self.extract_model(tar_path), sequence)
+            try:
+                self._write_covered_intervals(tar_path, sequence, covered)
+            except OSError:
+                _log.warning("cannot store covered intervals for {}".format(tar_path))
+
+        return self._intervals_cover(covered, covered_residue_number)
+
+    def get_covered_path(self, tar_path):
+        return os.path.splitext(tar_path)[0] + '.covered'
+
+    def read_covered_intervals(self, tar_path, sequence):
+        """
+        Returns the covered intervals from the file next to the tarball,
+        or None if there's no such file for the given sequence.
+        """
+
+        try:
+            with open(self.get_covered_path(tar_path), 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            _log.warning("unreadable covered intervals for {}".format(tar_path))
+            return None
+
+        if data['sequence_id'] != self.get_sequence_id(sequence):
+            return None
+
+        return data['covered']
+
+    def _write_covered_intervals(self, tar_path, sequence, covered):
+        path = self.get_covered_path(tar_path)
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'sequence_id': self.get_sequence_id(sequence), 'covered': covered}, f)
+        os.replace(tmp_path, path)
+
+    def _intervals_cover(self, intervals, residue_number):
+        return any([start <= residue_number <= end for start, end in intervals])
+
+    def get_covered_intervals(self, pdb_contents, sequence):
+        """
+        Tells which residues of the full sequence are present in the model.
+        Returns a sorted list of [start, end] intervals, residue numbers
+        start from 1 and ends are inclusive.
+        """
+
+        seqres_sequences = parse_seqres_from_string(pdb_contents)
         _log.debug(str(seqres_sequences))
 
+        covered = set()
         for chain_id in seqres_sequences:
             _log.debug(chain_id)
 
@@ -96,9 +273,134 @@ class ModelStorage:
                 if full_to_model.aligned_sequences['full'][i].isalpha():
                     resnum += 1
 
-                    if resnum == covered_residue_number and full_to_model.aligned_sequences['model'][i].isalpha():
-                        return True
-        return False
+                    if full_to_model.aligned_sequences['model'][i].isalpha():
+                        covered.add(resnum)
+
+        intervals = []
+        for resnum in sorted(covered):
+            if len(intervals) > 0 and intervals[-1][1] == resnum - 1:
+                intervals[-1][1] = resnum
+            else:
+                intervals.append([resnum, resnum])
+        return intervals
+
+    def parse_model_name(self, model_name):
+        """
+        Returns sequence id, species id, range start, range end and template id.
+        The template id is None for models without one in their name.
+        """
+
+        s = model_name.split('_')
+        range_start, range_end = [int(n) for n in s[2].split('-')]
+
+        template_id = None
+        if len(s) > 3:
+            pdbid, chain_id = s[3].split('-', 1)
+            template_id = TemplateID(pdbid, chain_id)
+
+        return s[0], s[1], range_start, range_end, template_id
+
+    def store_model(self, work_dir_path, tar_path, target_sequence, identity):
+        """
+        Wraps the work directory in a bundle and adds it to the catalog.
+        The bundle only appears when the catalog row is written.
+        """
+
+        model_name = self.get_model_name_from_path(tar_path)
+
+        os.makedirs(os.path.dirname(tar_path), exist_ok=True)
+
+        tmp_path = tar_path + '.tmp'
+        try:
+            write_bundle(tmp_path, work_dir_path, model_name,
+                         os.path.splitext(tar_path)[1][1:])
+
+            # Write the covered residues before the tarball appears, so that nobody needs to extract it for that.
+            covered = self._read_covered_intervals(os.path.join(work_dir_path, 'target.pdb'), target_sequence)
+            if covered is not None:
+                self._write_covered_intervals(tar_path, target_sequence, covered)
+
+            if self.catalog.path is None:
+                os.replace(tmp_path, tar_path)
+                return
+
+            with self.catalog.transaction() as connection:
+                self.catalog.add_model(connection, model_name, *self.parse_model_name(model_name),
+                                       ctime=time.time(), covered=covered, identity=identity)
+                os.replace(tmp_path, tar_path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+    def _read_covered_intervals(self, pdb_path, sequence):
+        try:
+            with open(pdb_path, 'r') as f:
+                return self.get_covered_intervals(f.read(), sequence)
+        except:
+            _log.exception("cannot determine the residues covered by {}".format(pdb_path))
+            return None
+
+    def update_catalog(self):
+        """
+        Makes the catalog match the tarballs in the model directory.
+        Only models that are not in the catalog yet are read.
+        """
+
+        if self.model_dir is None:
+            raise InitError("model directory is not set")
+
+        # Read the catalog first, models stored during the scan are on disk by then.
+        catalog_names = set(self.catalog.list_names())
+        disk_names = set([self.get_model_name_from_path(path) for path in self._scan_all_models()])
+
+        # Workers keep storing models meanwhile, so look again before removing.
+        removed_names = [name for name in catalog_names - disk_names
+                         if not os.path.isfile(self.get_tar_path_from_name(name))]
+        with self.catalog.transaction() as connection:
+            self.catalog.remove_models(connection, removed_names)
+
+        for name in sorted(disk_names - catalog_names):
+            tar_path = self.get_tar_path_from_name(name)
+            try:
+                sequence, covered, identity = self._read_model_info(tar_path)
+                ctime = os.path.getmtime(tar_path)
+            except:
+                _log.exception("cannot add {} to the catalog".format(tar_path))
+                continue
+
+            with self.catalog.transaction() as connection:
+                self.catalog.add_model(connection, name, *self.parse_model_name(name),
+                                       ctime=ctime, covered=covered, identity=identity)
+
+        with self.catalog.transaction() as connection:
+            self.catalog.set_complete(connection)
+
+    def _read_model_info(self, tar_path):
+        with self.open_bundle(tar_path) as bundle:
+            sequence = bundle.get_target_sequence()
+            if sequence is None:
+                return None, None, None
+
+            try:
+                covered = self.read_covered_intervals(tar_path, sequence)
+                if covered is None:
+                    covered = self.get_covered_intervals(bundle.get_model(), sequence)
+                    self._write_covered_intervals(tar_path, sequence, covered)
+            except:
+                _log.exception("cannot determine the residues covered by {}".format(tar_path))
+                covered = None
+
+            alignments = bundle.get_alignments()
+
+        identity = None
+        for alignment in alignments:
+            keys = list(alignment.aligned_sequences.keys())
+            if len(keys) == 2 and alignment.get_sequence('target') in sequence:
+                pid = alignment.get_percentage_identity(keys[0], keys[1])
+                if identity is None or pid > identity:
+                    identity = pid
+
+        return sequence, covered, identity
 
     def get_model_name(self, main_target_sequence, target_species_id,
                        main_domain_alignment, template_id):
@@ -121,11 +423,64 @@ class ModelStorage:
     def get_model_name_from_path(self, tar_path):
         return os.path.splitext(os.path.basename(tar_path))[0]
 
-    def get_tar_path_from_name(self, name):
+    def get_shard_dir(self, sequence_id, root_dir=None):
+        """
+        Returns the directory where the files for the given sequence id go.
+        In the sharded layout, that's two levels of subdirectories, named after the id's first four characters.
+        """
+
+        if root_dir is None:
+            root_dir = self.model_dir
+
+        if root_dir is None:
+            raise InitError("model directory is not set")
+
+        if not self.sharded:
+            return root_dir
+
+        return os.path.join(root_dir, sequence_id[:2], sequence_id[2:4])
+
+    def _find_path(self, file_names):
+        """
+        Returns the path of the first of the given files that exists,
+        or else where the first one should be created.
+        """
+
         if self.model_dir is None:
             raise InitError("model directory is not set")
 
-        return os.path.join(self.model_dir, name + '.tgz')
+        new_dir = self.get_shard_dir(self.get_sequence_id_from_name(file_names[0]))
+
+        # Check the new location again, in case the file was migrated in the meantime.
+        for dir_path in [new_dir, self.model_dir, new_dir]:
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                if os.path.isfile(path):
+                    return path
+
+        return os.path.join(new_dir, file_names[0])
+
+    def get_tar_path_from_name(self, name):
+        """
+        Returns the path of an existing model, in either layout and format,
+        or else the path where it should be created.
+        """
+
+        extensions = [BUNDLE_EXTENSIONS[self.bundle_format]] + \
+                     [extension for extension in BUNDLE_EXTENSIONS.values()
+                      if extension != BUNDLE_EXTENSIONS[self.bundle_format]]
+
+        return self._find_path([name + extension for extension in extensions])
+
+    def resolve_tar_path(self, tar_path):
+        """
+        Finds a model, when it has moved since the given path was stored.
+        """
+
+        if os.path.isfile(tar_path):
+            return tar_path
+
+        return self.get_tar_path_from_name(self.get_model_name_from_path(tar_path))
 
     def get_tar_path(self, target_sequence, target_species_id, main_domain_alignment, template_id):
         name = self.get_model_name(target_sequence, target_species_id,
@@ -134,10 +489,7 @@ class ModelStorage:
         return self.get_tar_path_from_name(name)
 
     def get_error_tar_path_from_name(self, name):
-        if self.model_dir is None:
-            raise InitError("model directory is not set")
-
-        return os.path.join(self.model_dir, name + '_error.tgz')
+        return self._find_path([name + '_error.tgz'])
 
     def get_error_tar_path(self, target_sequence, target_species_id, main_domain_alignment, template_id):
         name = self.get_model_name(target_sequence, target_species_id,
@@ -145,6 +497,19 @@ class ModelStorage:
 
         return self.get_error_tar_path_from_name(name)
 
+    def get_lock_path(self, sequence_id, lock_name):
+        """
+        Locks go in their own directory, when set, sharded like the models.
+        """
+
+        if self.lock_dir is None:
+            lock_dir = self.get_shard_dir(sequence_id)
+        else:
+            lock_dir = self.get_shard_dir(sequence_id, self.lock_dir)
+
+        os.makedirs(lock_dir, exist_ok=True)
+        return os.path.join(lock_dir, lock_name)
+
     def get_model_lock(self, main_target_sequence, target_species_id,
                        main_domain_alignment, template_id):
         if self.model_dir is None:
@@ -154,64 +519,62 @@ class ModelStorage:
                                                         target_species_id,
                                                         main_domain_alignment,
                                                         template_id)
-        lock_path = os.path.join(self.model_dir, lock_name)
+        lock_path = self.get_lock_path(self.get_sequence_id(main_target_sequence), lock_name)
         return FileLock(lock_path)
 
+    def migrate_to_shards(self):
+        """
+        Moves the models from the flat layout to the sharded layout.
+        Can run while the service is up, readers look in both places.
+        """
+
+        if self.model_dir is None:
+            raise InitError("model directory is not set")
+        if not self.sharded:
+            raise InitError("sharding is not enabled")
+
+        count = 0
+        for flat_path in self._glob_bundles(self.model_dir, "*"):
+            file_name = os.path.basename(flat_path)
+            shard_dir = self.get_shard_dir(self.get_sequence_id_from_name(file_name))
+            os.makedirs(shard_dir, exist_ok=True)
+
+            # The covered intervals file must be in place before the tarball is.
+            covered_path = self.get_covered_path(flat_path)
+            if os.path.isfile(covered_path):
+                os.replace(covered_path, os.path.join(shard_dir, os.path.basename(covered_path)))
+
+            os.replace(flat_path, os.path.join(shard_dir, file_name))
+            count += 1
+
+        _log.info("moved {} models to shards".format(count))
+
+    def open_bundle(self, tar_path):
+        """
+        Opens a model, to read several of its files at once.
+        """
+
+        return open_bundle(tar_path)
+
     def extract_alignments(self, tar_path):
-        dir_name = os.path.splitext(os.path.basename(tar_path))[0]
-        with tarfile.open(tar_path, 'r:gz') as ar:
-            f = None
-            try:
-                path = os.path.join(dir_name, 'align.fa')
-                if path not in ar.getnames():
-                    path = os.path.join(dir_name, 'align.fasta')
-
-                f = ar.extractfile(path)
-                alignment_fasta = parse_fasta_from_string(f.read().decode('ascii'))
-
-                rows = {}
-                for key in alignment_fasta:
-                    rows[key] = alignment_fasta[key].split('|')
-
-                alignments = []
-                for n in range(len(list(rows.values())[0])):
-                    a = {key: rows[key][n] for key in rows}
-                    alignments.append(Alignment(a))
-                return alignments
-            finally:
-                if f is not None:
-                    f.close()
+        with self.open_bundle(tar_path) as bundle:
+            return bundle.get_alignments()
 
     def extract_selected_targets(self, tar_path):
-        dir_name = os.path.splitext(os.path.basename(tar_path))[0]
-        with tarfile.open(tar_path, 'r:gz') as ar:
-            f = None
-            try:
-                targets = {}
+        with self.open_bundle(tar_path) as bundle:
+            return bundle.get_selected_targets()
 
-                f = ar.extractfile(os.path.join(dir_name, 'selected-targets.txt'))
-                for line in f:
-                    line = line.decode('ascii')
-                    if ':' in line:
-                        chain_id, target_id = line.split(':')
-                        targets[chain_id.strip()] = target_id.strip()
+    def extract_target_sequence(self, tar_path):
+        """
+        Returns the full target sequence, or None if the bundle has none.
+        """
 
-                return targets
-            finally:
-                if f is not None:
-                    f.close()
+        with self.open_bundle(tar_path) as bundle:
+            return bundle.get_target_sequence()
 
     def extract_model(self, tar_path):
-        dir_name = os.path.splitext(os.path.basename(tar_path))[0]
-        with tarfile.open(tar_path, 'r:gz') as ar:
-            f = None
-            try:
-                f = ar.extractfile(os.path.join(dir_name, 'target.pdb'))
-
-                return f.read().decode('ascii')
-            finally:
-                if f is not None:
-                    f.close()
+        with self.open_bundle(tar_path) as bundle:
+            return bundle.get_model()
 
 
 model_storage = ModelStorage()
@@ -1,21 +1,162 @@
-from hommod.controllers.fasta import FastaIterator
+import os
+import mmap
+import logging
+import sqlite3
+from contextlib import closing
+
+from filelock import FileLock
+
 from hommod.models.error import InitError
 
 
+_log = logging.getLogger(__name__)
+
+
 class Uniprot:
+    """
+    Looks up uniprot sequences by accession code.
+
+    For every fasta file, an index of accession codes to byte offsets is kept
+    next to it. The index is rebuilt when the fasta file's mtime changes, so
+    that a lookup only has to read one record from the memory mapped fasta.
+    """
+
     def __init__(self, fasta_paths=None):
         self.fasta_paths = fasta_paths
 
+        self._maps = {}
+
     def get_sequence(self, ac):
+        return self.get_sequences([ac])[ac]
+
+    def get_sequences(self, acs):
         if self.fasta_paths is None:
             raise InitError("fasta paths not set")
 
+        sequences = {}
+        remaining = set(acs)
         for fasta_path in self.fasta_paths:
-            with FastaIterator(fasta_path) as fasta:
-                for id_, seq in fasta:
-                    if id_.split('|')[1] == ac:
-                        return seq
+            if len(remaining) <= 0:
+                break
+
+            index_path = self.update_index(fasta_path)
+            with closing(sqlite3.connect(index_path)) as connection:
+                for ac in sorted(remaining):
+                    row = connection.execute("SELECT offset, length FROM entries WHERE ac = ?",
+                                             (ac,)).fetchone()
+                    if row is None:
+                        continue
+
+                    offset, length = row
+                    sequences[ac] = self._read_sequence(fasta_path, offset, length)
+                    remaining.remove(ac)
+
+        if len(remaining) > 0:
+            raise ValueError("sequence not found in uniprot: {}".format(', '.join(sorted(remaining))))
+
+        return sequences
+
+    def get_index_path(self, fasta_path):
+        return fasta_path + '.idx'
+
+    def update_index(self, fasta_path):
+        """
+        Makes sure that the index for the given fasta is up to date.
+        Returns the path to the index.
+        """
+
+        index_path = self.get_index_path(fasta_path)
+        mtime = os.stat(fasta_path).st_mtime_ns
+
+        if self._get_index_mtime(index_path) != mtime:
+            with FileLock(index_path + '.lock'):
+                # Another process might have built it while we were waiting.
+                if self._get_index_mtime(index_path) != mtime:
+                    self._build_index(fasta_path, index_path, mtime)
+
+        return index_path
+
+    def _get_index_mtime(self, index_path):
+        if not os.path.isfile(index_path):
+            return None
+
+        try:
+            with closing(sqlite3.connect(index_path)) as connection:
+                row = connection.execute("SELECT value FROM meta WHERE key = 'mtime'").fetchone()
+        except sqlite3.DatabaseError:
+            _log.warning("unreadable index {}, rebuilding".format(index_path))
+            return None
+
+        if row is None:
+            return None
+        return row[0]
+
+    def _build_index(self, fasta_path, index_path, mtime):
+        _log.info("building uniprot index for {}".format(fasta_path))
+
+        tmp_path = index_path + '.tmp'
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+        with closing(sqlite3.connect(tmp_path)) as connection:
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute("CREATE TABLE entries (ac TEXT PRIMARY KEY, offset INTEGER, length INTEGER)")
+            connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value INTEGER)")
+
+            # Like a linear search would, keep the first record for every accession code.
+            connection.executemany("INSERT OR IGNORE INTO entries VALUES (?, ?, ?)",
+                                   self._iter_records(fasta_path))
+            connection.execute("INSERT INTO meta VALUES ('mtime', ?)", (mtime,))
+            connection.commit()
+
+        os.replace(tmp_path, index_path)
+
+    def _iter_records(self, fasta_path):
+        ac = None
+        start = 0
+        offset = 0
+        with open(fasta_path, 'rb') as f:
+            for line in f:
+                if line.startswith(b'>'):
+                    if ac is not None:
+                        yield ac, start, offset - start
+
+                    ac = self._get_accession(line[1:].decode('ascii').split()[0])
+                    start = offset
+
+                offset += len(line)
+
+        if ac is not None:
+            yield ac, start, offset - start
+
+    def _get_accession(self, id_):
+        s = id_.split('|')
+        if len(s) > 1:
+            return s[1]
+        return s[0]
+
+    def _get_map(self, fasta_path):
+        mtime = os.stat(fasta_path).st_mtime_ns
+
+        if fasta_path in self._maps:
+            map_mtime, map_ = self._maps[fasta_path]
+            if map_mtime == mtime:
+                return map_
+
+            map_.close()
+
+        with open(fasta_path, 'rb') as f:
+            map_ = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._maps[fasta_path] = (mtime, map_)
+        return map_
+
+    def _read_sequence(self, fasta_path, offset, length):
+        record = self._get_map(fasta_path)[offset: offset + length].decode('ascii')
+
+        lines = record.split('\n')
+        return ''.join([line.strip() for line in lines[1:]])
 
-        raise ValueError("sequence not found in uniprot: {}".format(ac))
 
 uniprot = Uniprot()
@@ -2,6 +2,12 @@ import sys
 import imp
 import platform
 import os
+import signal
+import logging
+from threading import Lock, Timer
+
+
+_log = logging.getLogger(__name__)
 
 
 class YasaraObject:
@@ -10,6 +16,9 @@ class YasaraObject:
         sys.path.append(os.path.join(yasara_dir, 'plg'))
         self._yasara_module = imp.load_module('yasaramodule', *imp.find_module('yasaramodule'))
 
+        self.yasara_dir = yasara_dir
+        self.count_jobs = 0
+
         self._start_yasara(yasara_dir)
 
     def _start_yasara(self, yasara_dir):
@@ -18,9 +27,38 @@ class YasaraObject:
         executable = os.path.join(yasara_dir, "yasara")
         arglist = [executable, "-pym", str(self._com.port), "-txt"]
 
+        self._owner_pid = os.getpid()
         self._pid = os.spawnv(os.P_NOWAIT, executable, arglist)
         self._com.accept()
 
+    def is_alive(self):
+        # A forked worker cannot talk to its parent's yasara process.
+        if self._pid is None or self._owner_pid != os.getpid():
+            return False
+
+        try:
+            pid, status = os.waitpid(self._pid, os.WNOHANG)
+        except ChildProcessError:
+            pid = self._pid
+
+        if pid != 0:
+            self._pid = None
+            return False
+
+        return True
+
+    def Kill(self):
+        if self._pid is None:
+            return
+
+        try:
+            os.kill(self._pid, signal.SIGKILL)
+            os.waitpid(self._pid, 0)
+        except OSError:
+            pass
+
+        self._pid = None
+
     def _execute(self, messagedata):
         self._com.sendmessage(self._com.EXECUTE, messagedata)
         result = self._com.receivemessage(self._com.RESULT)
@@ -36,6 +74,7 @@ class YasaraObject:
     def Exit(self):
         self._com.sendmessage(self._com.EXECUTE, "Exit")
         os.waitpid(self._pid, 0)
+        self._pid = None
 
     def ListRes(self, selection, format_=None):
         command = 'ListRes ' + self._yasara_module.selstr(selection) + ','
@@ -196,3 +235,105 @@ class YasaraObject:
     def SaveSce(self, filename):
         command = 'SaveSce %s' % filename
         self._run(command)
+
+
+class YasaraPool:
+    """
+    Keeps yasara processes running between modeling jobs, so that they
+    don't need to be started and stopped for every model.
+
+    At most 'size' idle processes are kept. A process is replaced after
+    it served 'max_jobs' jobs, after a failed job, or when it doesn't
+    respond within 'timeout' seconds.
+    """
+
+    def __init__(self, size=1, max_jobs=20, timeout=60):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+
+        self._idle = []
+        self._lock = Lock()
+
+    def acquire(self, yasara_dir):
+        while True:
+            yasara = self._pop_idle(yasara_dir)
+            if yasara is None:
+                _log.debug("starting a new yasara process")
+                return YasaraObject(yasara_dir)
+
+            if yasara.is_alive():
+                return yasara
+
+            _log.warning("discarding an unresponsive yasara process")
+            self._discard(yasara)
+
+    def release(self, yasara, failed=False):
+        yasara.count_jobs += 1
+
+        # After a failed job, the process might be in any state.
+        if failed or yasara.count_jobs >= self.max_jobs or not self._reset(yasara):
+            self._discard(yasara)
+            return
+
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(yasara)
+                return
+
+        self._discard(yasara)
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+
+        for yasara in idle:
+            self._discard(yasara)
+
+    def _pop_idle(self, yasara_dir):
+        with self._lock:
+            for yasara in self._idle:
+                if yasara.yasara_dir == yasara_dir:
+                    self._idle.remove(yasara)
+                    return yasara
+        return None
+
+    def _call_with_timeout(self, yasara, f):
+        """
+        Kills the process when it hangs, so that the call returns.
+        """
+
+        watchdog = Timer(self.timeout, yasara.Kill)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            f()
+        finally:
+            watchdog.cancel()
+
+    def _reset(self, yasara):
+        if not yasara.is_alive():
+            return False
+
+        try:
+            self._call_with_timeout(yasara, yasara.Clear)
+        except:
+            _log.exception("clearing yasara failed")
+            return False
+
+        # The watchdog might have killed it.
+        return yasara.is_alive()
+
+    def _discard(self, yasara):
+        if not yasara.is_alive():
+            return
+
+        try:
+            self._call_with_timeout(yasara, yasara.Exit)
+        except:
+            _log.exception("yasara did not exit, killing it")
+            yasara.Kill()
+
+
+yasara_pool = YasaraPool()
@@ -10,7 +10,21 @@ CACHE_REDIS_HOST = 'hommod_redis_1'
 CACHE_REDIS_PORT = 6379
 CACHE_REDIS_DB = 1
 CACHE_EXPIRATION_TIME = 60*60*24*30  # 30 days
-CACHE_LOCK_TIMEOUT = 60*60  # 1 hour
+# How long computing a cached value may take, longer than an interpro job:
+CACHE_LOCK_TIMEOUT = 60*60*3  # 3 hours
+# How long expired values of some functions, like interpro's, are still used while they're refreshed:
+CACHE_STALE_TIME = 60*60*24*30  # 30 days
+# Cached values kept in memory per function and process, in front of redis,
+# and how long they stay there, in seconds. Set the size to 0 to disable:
+CACHE_L1_SIZE = 1000
+CACHE_L1_TTL = 60*10  # 10 minutes
+# Cached values of at least this many bytes are compressed in redis, None to never compress:
+CACHE_COMPRESS_MIN_SIZE = 1024
+
+# Seconds that a search is marked as in flight, in case its job never finishes:
+JOB_KEY_EXPIRATION_TIME = 60*60*24  # 1 day
+# Seconds that a submitted job may be without a state, before its search is submitted again:
+JOB_PENDING_GRACE_TIME = 60*60  # 1 hour
 
 # Celery
 task_serializer = 'pickle'
@@ -20,12 +34,32 @@ broker_url = 'amqp://guest@hommod_rabbitmq_1'
 task_default_queue = 'hommod'
 worker_concurrency = 20
 worker_prefetch_multiplier = 1
+# Each stage of a modeling job has its own queue, so that workers can be
+# started per stage with -Q, sized to what the stage needs:
 task_queues = (
     Queue('hommod', Exchange('hommod'), routing_key='hommod'),
+    Queue('hommod_interpro', Exchange('hommod'), routing_key='hommod_interpro'),
+    Queue('hommod_search', Exchange('hommod'), routing_key='hommod_search'),
+    Queue('hommod_select', Exchange('hommod'), routing_key='hommod_select'),
+    Queue('hommod_model', Exchange('hommod'), routing_key='hommod_model'),
 )
+task_routes = {
+    'hommod.tasks.search_interpro': {'queue': 'hommod_interpro', 'routing_key': 'hommod_interpro'},
+    'hommod.tasks.search_domains': {'queue': 'hommod_search', 'routing_key': 'hommod_search'},
+    'hommod.tasks.select_template': {'queue': 'hommod_select', 'routing_key': 'hommod_select'},
+    'hommod.tasks.build_all_models': {'queue': 'hommod_select', 'routing_key': 'hommod_select'},
+    'hommod.tasks.build_model': {'queue': 'hommod_model', 'routing_key': 'hommod_model'},
+    'hommod.tasks.build_domain_model': {'queue': 'hommod_model', 'routing_key': 'hommod_model'},
+}
 task_track_started = True
 result_backend = 'redis://hommod_redis_1/1'
 
+# Yasara processes kept running per worker and jobs per process:
+YASARA_POOL_SIZE = 1
+YASARA_POOL_MAX_JOBS = 20
+# Seconds a pooled yasara process gets to clear or exit, before it's killed:
+YASARA_POOL_TIMEOUT = 60
+
 # Time it takes for a model to get outdated:
 MAX_MODEL_DAYS = 100
 
@@ -35,13 +69,40 @@ INTERPRO_URL = 'https://www.ebi.ac.uk/Tools/services/rest/iprscan5'
 # Directories and File Paths
 YASARA_DIR = '/deps/yasara/yasara'
 MODEL_DIR = '/data/models/'
+# Database of the models in MODEL_DIR, made by make_model_catalog.py:
+MODEL_CATALOG_PATH = '/data/models/catalog.sqlite'
+# Whether to put models in subdirectories per sequence id prefix, see migrate_models.py:
+MODEL_DIR_SHARDED = True
+MODEL_LOCK_DIR = '/data/locks/'
+# Where the stages of a modeling job leave their results for the next stage:
+STAGE_DIR = '/data/stages/'
+# Format of new model files: 'zip' allows reading single files from them, 'tgz' doesn't.
+MODEL_BUNDLE_FORMAT = 'zip'
 BLACKLIST_FILE_PATH = '/data/blacklisted_templates'
 DSSP_DIR = '/mnt/chelonium/dssp/'
 PDBFINDER2_FILE_PATH = '/mnt/chelonium/pdbfinder2/PDBFIND2.TXT'
 
+# Number of parsed dssp files to keep in memory, per worker:
+DSSP_CACHE_SIZE = 1000
+
+# Precompiled dssp data for all templates, made by update_databanks.bash:
+DSSP_STORE_PATH = '/data/secstr/templates.bin'
+
+# Number of kmad alignments to keep in memory, per worker,
+# and whether to share them between workers through redis:
+KMAD_CACHE_SIZE = 10000
+KMAD_USE_REDIS = False
+
+# Number of kmad processes that a worker may run at once,
+# keep worker_concurrency in mind when raising this:
+KMAD_CONCURRENCY = 1
+
 # Executables
 KMAD_EXE = '/deps/hommod-kmad/hommod_kmad'  # made by Joanna Lange
 BLASTP_EXE = '/usr/bin/blastp'  # ncbi
+BLASTP_NUM_THREADS = 1
+# Where blastp results are kept, shared by all workers. Set to None to disable:
+BLASTP_CACHE_DIR = '/data/blast/cache'
 CLUSTALW_EXE = '/usr/bin/clustalw'
 
 # Databanks
@@ -108,17 +108,31 @@ def create_celery_app(flask_app=None):  # pragma: no cover
 
     from hommod.controllers.kmad import kmad_aligner
     kmad_aligner.kmad_exe = flask_app.config['KMAD_EXE']
+    kmad_aligner.cache_size = flask_app.config['KMAD_CACHE_SIZE']
+    kmad_aligner.use_redis = flask_app.config['KMAD_USE_REDIS']
 
     from hommod.controllers.clustal import clustal_aligner
     clustal_aligner.clustalw_exe = flask_app.config['CLUSTALW_EXE']
 
     from hommod.controllers.storage import model_storage
     model_storage.model_dir = flask_app.config['MODEL_DIR']
+    model_storage.catalog.path = flask_app.config['MODEL_CATALOG_PATH']
+    model_storage.sharded = flask_app.config['MODEL_DIR_SHARDED']
+    model_storage.lock_dir = flask_app.config['MODEL_LOCK_DIR']
+    model_storage.bundle_format = flask_app.config['MODEL_BUNDLE_FORMAT']
+
+    from hommod.controllers.stage import stage_storage
+    stage_storage.stage_dir = flask_app.config['STAGE_DIR']
 
     from hommod.controllers.model import modeler
     modeler.yasara_dir = flask_app.config['YASARA_DIR']
     modeler.uniprot_databank = flask_app.config['UNIPROT_BLAST_DATABANK']
 
+    from hommod.controllers.yasara import yasara_pool
+    yasara_pool.size = flask_app.config['YASARA_POOL_SIZE']
+    yasara_pool.max_jobs = flask_app.config['YASARA_POOL_MAX_JOBS']
+    yasara_pool.timeout = flask_app.config['YASARA_POOL_TIMEOUT']
+
     from hommod.controllers.domain import domain_aligner
     domain_aligner.forbidden_interpro_domains = flask_app.config['FORBIDDEN_INTERPRO_DOMAINS']
     domain_aligner.similar_ranges_min_overlap_percentage = flask_app.config['SIMILAR_RANGES_MIN_OVERLAP_PERCENTAGE']
@@ -126,15 +140,20 @@ def create_celery_app(flask_app=None):  # pragma: no cover
     domain_aligner.min_percentage_coverage = flask_app.config['DOMAIN_MIN_PERCENTAGE_COVERAGE']
     domain_aligner.template_blast_databank = flask_app.config['TEMPLATE_BLAST_DATABANK']
     domain_aligner.highly_homologous_percentage_identity = flask_app.config['HIGHLY_HOMOLOGOUS_PERCENTAGE_IDENTITY']
+    domain_aligner.kmad_concurrency = flask_app.config['KMAD_CONCURRENCY']
 
     from hommod.controllers.blast import blaster
     blaster.blastp_exe = flask_app.config['BLASTP_EXE']
+    blaster.num_threads = flask_app.config['BLASTP_NUM_THREADS']
+    blaster.cache.cache_dir = flask_app.config['BLASTP_CACHE_DIR']
 
     from hommod.controllers.blacklist import blacklister
     blacklister.file_path = flask_app.config['BLACKLIST_FILE_PATH']
 
     from hommod.services.dssp import dssp
     dssp.dssp_dir = flask_app.config['DSSP_DIR']
+    dssp.cache_size = flask_app.config['DSSP_CACHE_SIZE']
+    dssp.store_path = flask_app.config['DSSP_STORE_PATH']
 
     from hommod.services.helpers.cache import cache_manager as cm
     cm.redis_hostname = flask_app.config['CACHE_REDIS_HOST']
@@ -142,5 +161,9 @@ def create_celery_app(flask_app=None):  # pragma: no cover
     cm.redis_db = flask_app.config['CACHE_REDIS_DB']
     cm.expiration_time = flask_app.config['CACHE_EXPIRATION_TIME']
     cm.lock_timeout = flask_app.config['CACHE_LOCK_TIMEOUT']
+    cm.stale_time = flask_app.config['CACHE_STALE_TIME']
+    cm.l1_size = flask_app.config['CACHE_L1_SIZE']
+    cm.l1_ttl = flask_app.config['CACHE_L1_TTL']
+    cm.compress_min_size = flask_app.config['CACHE_COMPRESS_MIN_SIZE']
 
     return celery
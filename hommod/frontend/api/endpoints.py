@@ -1,10 +1,16 @@
+import math
 import inspect
 import logging
+import json
 import re
 import os
 import traceback
+from time import time, sleep
+from uuid import uuid4
 
-from flask import Blueprint, render_template, request, jsonify, Response
+from celery.states import READY_STATES, PENDING, FAILURE
+from flask import Blueprint, render_template, request, jsonify, Response, current_app
+from werkzeug.wsgi import FileWrapper, ClosingIterator
 
 from hommod.models.template import TemplateID
 from hommod.controllers.storage import model_storage
@@ -49,6 +55,13 @@ def _validate_input_data(form):
     return sequence, species_id, position, template_id
 
 
+def _get_all_domains(form):
+    value = form.get('all_domains', False)
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
 @bp.route('/submit/', methods=['POST'])
 def submit():
 
@@ -59,6 +72,8 @@ def submit():
     :param species_id: uniprot species id for the model
     :param position: optional position of the required residue in the sequence, starting 1
     :param template_id: optional pdbid and chain id, separated by '_'
+    :param all_domains: optional, when true a model is built for every domain that the search finds,
+                        instead of only the best
     :return: a json object, containing the field 'jobid' or an error if the input is incorrect
     """
 
@@ -67,10 +82,117 @@ def submit():
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
-    from hommod.tasks import create_model
-    result = create_model.apply_async((sequence, species_id, position, template_id))
+    return jsonify({'jobid': _submit_job(sequence, species_id, position, template_id,
+                                         _get_all_domains(request.form))})
+
+
+def _submit_job(sequence, species_id, position, template_id, all_domains=False):
+    """
+    Queues a modeling job, unless the same search is already in flight.
+    Returns the id of the job that does the search.
+    """
+
+    from hommod.tasks import create_model, create_models, get_job_key
+    from hommod.application import celery
+    from hommod.services.helpers.cache import cache_manager as cm
+
+    args = (sequence, species_id, position, template_id)
+
+    # The key expires, in case the job never releases it.
+    expiration_time = current_app.config['JOB_KEY_EXPIRATION_TIME']
+    pending_grace_time = current_app.config['JOB_PENDING_GRACE_TIME']
+
+    key = get_job_key(*args, all_domains=all_domains)
+    try:
+        job_id = str(uuid4())
+        while not cm.add(key, (job_id, time()), expiration_time):
+            existing_job = cm.get(key)
+            if existing_job is not None:
+                existing_job_id, submit_time = existing_job
+
+                # A job without a state, long after it was submitted, was probably lost.
+                status = celery.AsyncResult(existing_job_id).status
+                if status not in READY_STATES and \
+                        (status != PENDING or (time() - submit_time) < pending_grace_time):
+                    return existing_job_id
+
+            # The job has finished without releasing its key, take it over.
+            cm.remove_if(key, lambda job: job == existing_job)
+    except:
+        _log.exception("cannot check for jobs in flight")
+        job_id = None
 
-    return jsonify({'jobid': result.task_id})
+    if all_domains:
+        task = create_models
+    else:
+        task = create_model
+
+    try:
+        return task.apply_async(args, task_id=job_id).task_id
+    except:
+        if job_id is not None:
+            try:
+                cm.remove_if(key, lambda job: job[0] == job_id)
+            except:
+                _log.exception("releasing {}".format(key))
+        raise
+
+
+@bp.route('/submit_many/', methods=['POST'])
+def submit_many():
+
+    """
+    Request models for many parameter sets at once. No jobs are queued for models that already exist,
+    or for searches that are already in flight.
+
+    :param: a json array of objects, each with the fields of 'submit'
+    :return: a json object with the field 'jobs': per submitted object, a json object
+             containing either the field 'model_ids', 'jobid' or 'error'
+    """
+
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list):
+        return jsonify({'error': "Expected a json array of queries"}), 400
+
+    from hommod.tasks import get_search_name
+
+    jobs = [None] * len(queries)
+    search_indices = {}
+    for index, query in enumerate(queries):
+        try:
+            if not isinstance(query, dict):
+                raise ValueError("Query is not a json object")
+            args = _validate_input_data(query)
+            all_domains = _get_all_domains(query)
+        except Exception as e:
+            jobs[index] = {'error': str(e)}
+            continue
+
+        # Identical searches in the batch share one job.
+        search_indices.setdefault((get_search_name(*args), all_domains), (args, all_domains, []))[2].append(index)
+
+    searches = list(search_indices.values())
+
+    # Existing models only answer searches for the best domain.
+    single_searches = [search for search in searches if not search[1]]
+    for search_index, paths in model_storage.find_models_bulk([args for args, all_domains, indices
+                                                               in single_searches]):
+        args, all_domains, indices = single_searches[search_index]
+        if len(paths) > 0:
+            job = {'model_ids': [model_storage.get_model_name_from_path(path) for path in paths]}
+        else:
+            job = {'jobid': _submit_job(*args)}
+
+        for index in indices:
+            jobs[index] = job
+
+    for args, all_domains, indices in searches:
+        if all_domains:
+            job = {'jobid': _submit_job(*args, all_domains=True)}
+            for index in indices:
+                jobs[index] = job
+
+    return jsonify({'jobs': jobs})
 
 
 @bp.route('/get_model_if_exists/', methods=['POST'])
@@ -98,6 +220,43 @@ def get_model_if_exists():
     return jsonify({'model_ids': model_ids})
 
 
+@bp.route('/get_models_if_exist/', methods=['POST'])
+def get_models_if_exist():
+
+    """
+    Get the models that exist in the set of earlier created models, for many queries at once.
+
+    :param: a json array of objects, each with the fields of 'get_model_if_exists'
+    :return: one json object per line, containing the field 'index' of the query and either 'model_ids' or 'error'
+    """
+
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list):
+        return jsonify({'error': "Expected a json array of queries"}), 400
+
+    errors = {}
+    valid_queries = []
+    valid_indices = []
+    for index, query in enumerate(queries):
+        try:
+            if not isinstance(query, dict):
+                raise ValueError("Query is not a json object")
+            valid_queries.append(_validate_input_data(query))
+            valid_indices.append(index)
+        except Exception as e:
+            errors[index] = str(e)
+
+    def generate():
+        for index in sorted(errors):
+            yield json.dumps({'index': index, 'error': errors[index]}) + '\n'
+
+        for valid_index, paths in model_storage.find_models_bulk(valid_queries):
+            model_ids = [model_storage.get_model_name_from_path(path) for path in paths]
+            yield json.dumps({'index': valid_indices[valid_index], 'model_ids': model_ids}) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
 @bp.route('/status/<job_id>/', methods=['GET'])
 def status(job_id):
 
@@ -118,6 +277,104 @@ def status(job_id):
     return jsonify(response)
 
 
+# Longest time that a request to 'statuses' may wait for a change, in seconds.
+_MAX_STATUS_WAIT = 30.0
+
+
+def _get_statuses(job_ids):
+    """
+    Looks up the statuses of many jobs. When the result backend is a key-value
+    store, this takes one request to it, instead of one per job.
+    """
+
+    from hommod.application import celery
+    backend = celery.backend
+
+    statuses = {}
+    if hasattr(backend, 'mget') and hasattr(backend, 'get_key_for_task'):
+        values = backend.mget([backend.get_key_for_task(job_id) for job_id in job_ids])
+        for job_id, value in zip(job_ids, values):
+            if value is None:
+                statuses[job_id] = {'status': PENDING}
+                continue
+
+            meta = backend.decode_result(value)
+            statuses[job_id] = {'status': meta['status']}
+            if meta['status'] == FAILURE:
+                statuses[job_id]['message'] = str(meta.get('traceback'))
+    else:
+        for job_id in job_ids:
+            result = celery.AsyncResult(job_id)
+            statuses[job_id] = {'status': result.status}
+            if result.failed():
+                statuses[job_id]['message'] = str(result.traceback)
+
+    return statuses
+
+
+def _wait_for_statuses(known_statuses, wait):
+    """
+    Returns the statuses of the jobs as soon as one differs from the known status,
+    or after waiting the given number of seconds.
+    """
+
+    from hommod.application import celery
+    backend = celery.backend
+
+    job_ids = list(known_statuses.keys())
+    deadline = time() + wait
+
+    # The redis backend publishes every status change under the job's key.
+    pubsub = None
+    if wait > 0 and len(job_ids) > 0 and hasattr(backend, 'client') and hasattr(backend, 'get_key_for_task'):
+        pubsub = backend.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*[backend.get_key_for_task(job_id) for job_id in job_ids])
+
+    try:
+        while True:
+            # Subscribed before looking, so that no change can be missed.
+            statuses = _get_statuses(job_ids)
+
+            remaining = deadline - time()
+            if remaining <= 0 or any(statuses[job_id]['status'] != known_statuses[job_id] for job_id in job_ids):
+                return statuses
+
+            if pubsub is not None:
+                pubsub.get_message(timeout=remaining)
+            else:
+                sleep(min(remaining, 1.0))
+    finally:
+        if pubsub is not None:
+            pubsub.close()
+
+
+@bp.route('/statuses/', methods=['POST'])
+def statuses():
+
+    """
+    Request the statuses of many jobs at once, optionally waiting until one of them changes.
+
+    :param jobs: a json object, mapping job ids returned by 'submit' to their last known status or null
+    :param wait: optional number of seconds to wait for a job's status to differ from the known status, at most 30
+    :return: a json object with the field 'statuses', mapping the job ids to objects like returned by 'status'
+    """
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('jobs'), dict):
+        return jsonify({'error': "Expected a json object with field 'jobs'"}), 400
+
+    try:
+        wait = float(data.get('wait', 0.0))
+    except (TypeError, ValueError):
+        return jsonify({'error': "Invalid wait data"}), 400
+
+    if not math.isfinite(wait):
+        return jsonify({'error': "Invalid wait data"}), 400
+    wait = max(0.0, min(wait, _MAX_STATUS_WAIT))
+
+    return jsonify({'statuses': _wait_for_statuses(data['jobs'], wait)})
+
+
 @bp.route('/result/<job_id>/', methods=['GET'])
 def result(job_id):
 
@@ -125,7 +382,7 @@ def result(job_id):
     Request whether a job has created a model or not.
 
     :param jobid: the job id returned by 'submit'
-    :return: a json object containing the boolean field 'model_created'
+    :return: a json object containing the boolean field 'model_created' and the list 'model_ids'
     """
 
     from hommod.application import celery
@@ -137,12 +394,80 @@ def result(job_id):
     try:
         path = result.get()
     except:
-        return jsonify({'model_created': False})
+        return jsonify({'model_created': False, 'model_ids': []})
 
-    if path is not None:
-        return jsonify({'model_created': True})
+    # Jobs for all domains return a list.
+    if path is None:
+        paths = []
+    elif isinstance(path, list):
+        paths = path
     else:
-        return jsonify({'model_created': False})
+        paths = [path]
+
+    return jsonify({'model_created': len(paths) > 0,
+                    'model_ids': [model_storage.get_model_name_from_path(path) for path in paths]})
+
+
+class _BundleMemberWrapper(FileWrapper):
+    """
+    Serves a bundle member and closes the bundle with it, werkzeug doesn't close
+    passed through responses itself. Seekable, so that range requests skip to the start.
+    """
+
+    def __init__(self, bundle, member):
+        FileWrapper.__init__(self, bundle.open_member(member))
+        self.bundle = bundle
+
+    def close(self):
+        try:
+            FileWrapper.close(self)
+        finally:
+            self.bundle.close()
+
+
+def _send_model_file(path):
+    """
+    Streams the model's pdb file from its bundle, in parts.
+    Model files don't change once written, so they're identified by the bundle's name, size and mtime.
+    """
+
+    bundle = model_storage.open_bundle(path)
+    try:
+        member = 'target.pdb'
+
+        stat = os.stat(path)
+        etag = "%s-%x-%x" % (model_storage.get_model_name_from_path(path), stat.st_mtime_ns, stat.st_size)
+
+        gzip_size = bundle.get_gzip_size(member)
+
+        # Ranges would refer to the gzipped bytes, serve those unencoded.
+        if gzip_size is not None and 'gzip' in request.accept_encodings and request.range is None:
+            response = Response(ClosingIterator(bundle.iter_gzip(member), bundle.close),
+                                mimetype='chemical/x-pdb', direct_passthrough=True)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.content_length = gzip_size
+            response.set_etag(etag + '-gz')
+            accept_ranges = False
+            complete_length = None
+        else:
+            member_size = bundle.get_member_size(member)
+            response = Response(_BundleMemberWrapper(bundle, member),
+                                mimetype='chemical/x-pdb', direct_passthrough=True)
+            response.content_length = member_size
+            response.set_etag(etag)
+            accept_ranges = True
+            complete_length = member_size
+
+        response.vary.add('Accept-Encoding')
+    except:
+        bundle.close()
+        raise
+
+    try:
+        return response.make_conditional(request, accept_ranges=accept_ranges, complete_length=complete_length)
+    except:
+        response.close()
+        raise
 
 
 @bp.route('/get_model_file/<job_id>.pdb', methods=['GET'])
@@ -172,9 +497,15 @@ def get_model_file(job_id):
         message = 'Job %s finished, but without creating a model. This could be due to lack of a suitable template.' % job_id
         return jsonify({'error': message}), 500
 
+    if isinstance(path, list):
+        message = "Job %s made %d models, get them by the model ids from 'result'" % (job_id, len(path))
+        return jsonify({'error': message}), 400
+
+    # The model may have been moved to a shard since the job finished.
+    path = model_storage.resolve_tar_path(path)
+
     try:
-        contents = model_storage.extract_model(path)
-        return Response(contents, mimetype='chemical/x-pdb')
+        return _send_model_file(path)
     except:
         return jsonify({'error': traceback.format_exc()}), 500
 
@@ -195,10 +526,8 @@ def get_model_file_by_model_id(model_id):
         return jsonify({'error': "no such model"}), 400
 
     try:
-        contents = model_storage.extract_model(path)
-        return Response(contents, mimetype='chemical/x-pdb')
+        return _send_model_file(path)
     except:
-        message = str(e)
         return jsonify({'error': traceback.format_exc()}), 500
 
 
@@ -228,11 +557,19 @@ def get_metadata(job_id):
         message = 'Job %s finished, but without creating a model. This could be due to lack of a suitable template.' % job_id
         return jsonify({'error': message}), 500
 
+    if isinstance(path, list):
+        message = "Job %s made %d models, get them by the model ids from 'result'" % (job_id, len(path))
+        return jsonify({'error': message}), 400
+
+    # The model may have been moved to a shard since the job finished.
+    path = model_storage.resolve_tar_path(path)
+
     try:
         data = {}
-        data['selected_targets'] = model_storage.extract_selected_targets(path)
-        data['alignments'] = [alignment.as_dict()
-                              for alignment in model_storage.extract_alignments(path)]
+        with model_storage.open_bundle(path) as bundle:
+            data['selected_targets'] = bundle.get_selected_targets()
+            data['alignments'] = [alignment.as_dict()
+                                  for alignment in bundle.get_alignments()]
 
         return jsonify(data)
     except:
@@ -255,9 +592,10 @@ def get_metadata_by_model_id(model_id):
 
     try:
         data = {}
-        data['selected_targets'] = model_storage.extract_selected_targets(path)
-        data['alignments'] = [alignment.as_dict()
-                              for alignment in model_storage.extract_alignments(path)]
+        with model_storage.open_bundle(path) as bundle:
+            data['selected_targets'] = bundle.get_selected_targets()
+            data['alignments'] = [alignment.as_dict()
+                                  for alignment in bundle.get_alignments()]
 
         return jsonify(data)
     except:
@@ -266,8 +604,8 @@ def get_metadata_by_model_id(model_id):
 
 @bp.route('/', methods=['GET'])
 def api_doc():
-    fs = [submit, status, result, get_model_file, get_metadata,
-          get_model_if_exists, get_model_file_by_model_id, get_metadata_by_model_id]
+    fs = [submit, submit_many, status, statuses, result, get_model_file, get_metadata,
+          get_model_if_exists, get_models_if_exist, get_model_file_by_model_id, get_metadata_by_model_id]
     docs = []
     for f in fs:
         src = inspect.getsourcelines(f)
@@ -8,6 +8,21 @@ from hommod.controllers.sequence import is_amino_acid_char
 _log = logging.getLogger(__name__)
 
 
+def get_percentage_identity(aligned_sequence1, aligned_sequence2):
+    nalign = 0
+    nid = 0
+    for i in range(len(aligned_sequence1)):
+        if is_amino_acid_char(aligned_sequence1[i]) and \
+                is_amino_acid_char(aligned_sequence2[i]):
+            nalign += 1
+            if aligned_sequence1[i] == aligned_sequence2[i]:
+                nid += 1
+    if nalign > 0:
+        return (100.0 * nid) / nalign
+    else:
+        return 0.0
+
+
 class Alignment:
     def __init__(self, aligned_sequences):
 
@@ -48,18 +63,7 @@ class Alignment:
         return nalign
 
     def get_percentage_identity(self, id1, id2):
-        nalign = 0
-        nid = 0
-        for i in range(len(self.aligned_sequences[id1])):
-            if is_amino_acid_char(self.aligned_sequences[id1][i]) and \
-                    is_amino_acid_char(self.aligned_sequences[id2][i]):
-                nalign += 1
-                if self.aligned_sequences[id1][i] == self.aligned_sequences[id2][i]:
-                    nid += 1
-        if nalign > 0:
-            return (100.0 * nid) / nalign
-        else:
-            return 0.0
+        return get_percentage_identity(self.aligned_sequences[id1], self.aligned_sequences[id2])
 
     def as_dict(self):
         return {key: self.aligned_sequences[key] for key in self.aligned_sequences}
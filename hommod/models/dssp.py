@@ -0,0 +1,19 @@
+
+
+class DsspChain:
+    __slots__ = ('sequence', 'secstr')
+
+    def __init__(self, sequence, secstr):
+        self.sequence = sequence
+        self.secstr = secstr
+
+
+class DsspEntry:
+    __slots__ = ('mtime', 'chains')
+
+    def __init__(self, mtime, chains):
+        # Modification time of the dssp file that this entry was parsed from.
+        self.mtime = mtime
+
+        # DsspChain objects, per chain id.
+        self.chains = chains
@@ -1,48 +1,138 @@
 import os
 import logging
+from collections import OrderedDict
+from threading import Lock
 
 from hommod.models.error import InitError
+from hommod.models.dssp import DsspChain, DsspEntry
+from hommod.services.helpers.dssp_store import DsspStore
 
 _log = logging.getLogger(__name__)
 
 
 class DsspService:
-    def __init__(self, dssp_dir=None):
+    def __init__(self, dssp_dir=None, cache_size=1000, store_path=None):
         self.dssp_dir = dssp_dir
 
+        # Precompiled store, to be tried before the dssp files.
+        self.store_path = store_path
+
+        # Number of parsed dssp entries to keep in memory.
+        self.cache_size = cache_size
+
+        self.store_hits = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self._store = None
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
     def has_secondary_structure(self, template_id):
         try:
-            dssp_str = self._get_dssp(template_id.pdbid)
+            chain = self._find_chain(template_id)
         except:
-            _log.exception("getting dssp for {template_id.pdbid}")
+            _log.exception("getting dssp for {}".format(template_id.pdbid))
             return False
 
-        data = self._parse_dssp(dssp_str)
-
-        _log.debug(f"parsed {template_id.pdbid} chains {data.keys()}")
-
-        return template_id.chain_id in data
+        return chain is not None
 
     def get_sequence(self, template_id):
-        dssp_str = self._get_dssp(template_id.pdbid)
-        data = self._parse_dssp(dssp_str)
-
-        return data[template_id.chain_id][0]
+        return self._get_chain(template_id).sequence
 
     def get_secondary_structure(self, template_id):
-        dssp_str = self._get_dssp(template_id.pdbid)
-        data = self._parse_dssp(dssp_str)
+        return self._get_chain(template_id).secstr
 
-        return data[template_id.chain_id][1]
+    def prefetch(self, template_ids):
+        store = self._get_store()
+        for pdbid in set([template_id.pdbid for template_id in template_ids]):
+            if store is not None and store.has_entry(pdbid):
+                continue
 
-    def _get_dssp(self, pdbid):
+            try:
+                self._get_chains(pdbid)
+            except:
+                _log.warning("cannot prefetch dssp for {}".format(pdbid))
+
+    def get_cache_stats(self):
+        with self._lock:
+            return {'store_hits': self.store_hits,
+                    'hits': self.cache_hits,
+                    'misses': self.cache_misses,
+                    'size': len(self._cache)}
+
+    def read_chains(self, pdbid):
+        """
+        Parses the dssp file for the given pdbid, bypassing the store and the cache.
+        """
+
+        data = self._parse_dssp(self._get_dssp(pdbid))
+        return {chain_id: DsspChain(data[chain_id][0], data[chain_id][1]) for chain_id in data}
+
+    def _get_store(self):
+        if self.store_path is None or not os.path.isfile(self.store_path):
+            return None
+
+        with self._lock:
+            # The store gets replaced when the databanks are updated.
+            if self._store is None or self._store.path != self.store_path or \
+                    self._store.mtime != os.stat(self.store_path).st_mtime_ns:
+                if self._store is not None:
+                    self._store.close()
+                self._store = DsspStore(self.store_path)
+
+            return self._store
+
+    def _find_chain(self, template_id):
+        store = self._get_store()
+        if store is not None and store.has_entry(template_id.pdbid):
+            with self._lock:
+                self.store_hits += 1
+
+            return store.get_chain(template_id.pdbid, template_id.chain_id)
+
+        return self._get_chains(template_id.pdbid).get(template_id.chain_id)
+
+    def _get_chain(self, template_id):
+        chain = self._find_chain(template_id)
+        if chain is None:
+            raise KeyError("no chain {} in dssp for {}".format(template_id.chain_id, template_id.pdbid))
+        return chain
+
+    def _get_chains(self, pdbid):
+        file_path = self._get_dssp_path(pdbid)
+        mtime = os.stat(file_path).st_mtime_ns
+        key = pdbid.lower()
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry.mtime == mtime:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return entry.chains
+
+            self.cache_misses += 1
+
+        entry = DsspEntry(mtime, self.read_chains(pdbid))
+
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return entry.chains
+
+    def _get_dssp_path(self, pdbid):
         if self.dssp_dir is None:
             raise InitError("dssp directory is not set")
         elif not os.path.isdir(self.dssp_dir):
             raise InitError("No such directory: {}".format(self.dssp_dir))
 
-        file_path = os.path.join(self.dssp_dir, '%s.dssp' % pdbid.lower())
-        with open(file_path, 'r') as f:
+        return os.path.join(self.dssp_dir, '%s.dssp' % pdbid.lower())
+
+    def _get_dssp(self, pdbid):
+        with open(self._get_dssp_path(pdbid), 'r') as f:
             return f.read()
 
     def _parse_dssp(self, dssp_str):
@@ -61,7 +151,7 @@ class DsspService:
                 continue
 
             if chain_id not in data:
-                data[chain_id] = ['', '', {}] 
+                data[chain_id] = [[], [], {}]
 
             i = len(data[chain_id][0])
 
@@ -71,10 +161,14 @@ class DsspService:
                     data[chain_id][2][amino_acid] = []
                 data[chain_id][2][amino_acid].append(i)
 
-                amino_acid = 'C' 
+                amino_acid = 'C'
+
+            data[chain_id][0].append(amino_acid)
+            data[chain_id][1].append(secstr)
 
-            data[chain_id][0] += amino_acid
-            data[chain_id][1] += secstr
+        for chain_id in data:
+            data[chain_id][0] = ''.join(data[chain_id][0])
+            data[chain_id][1] = ''.join(data[chain_id][1])
 
         return data
 
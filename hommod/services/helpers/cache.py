@@ -1,5 +1,10 @@
+import time
+import zlib
+import struct
 import logging
 import datetime
+import threading
+from collections import OrderedDict
 
 import redis
 import pickle
@@ -7,6 +12,7 @@ import pickle
 from dogpile.cache.util import function_key_generator
 
 from hommod.models.error import ServiceError
+from hommod.services.helpers.codec import PickleCodec, SequenceRangesCodec
 
 
 __all__ = ['cache_manager']
@@ -15,17 +21,113 @@ __all__ = ['cache_manager']
 _log = logging.getLogger(__name__)
 
 
+# Cached values are stored with a header, the time they were stored, the id of
+# the codec, flags and the encoded value.
+# Older entries are a bare pickle, with the time stored under a separate key.
+_ENTRY_HEADER = b'HC2'
+_ENTRY_INFO = struct.Struct('<dBB')
+_LEGACY_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+_FLAG_ZLIB = 0x01
+
+# Published when a value has been computed, or failed to.
+_MESSAGE_DONE = b'done'
+_MESSAGE_ERROR = b'error'
+
+# Seconds between checks on the process that computes a value, while waiting for it.
+_WAIT_INTERVAL = 5.0
+
+
+class MemoryCache(object):
+    """
+    Least recently used values, that are kept in this process for at most ttl seconds.
+    Values are returned as they were stored, so they must not be modified.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._values)
+
+    def get(self, key):
+        """
+        Returns whether the key was found and the value.
+        """
+
+        with self._lock:
+            if key not in self._values:
+                return False, None
+
+            expire_time, value = self._values[key]
+            if time.time() >= expire_time:
+                del self._values[key]
+                return False, None
+
+            self._values.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = (time.time() + self.ttl, value)
+            self._values.move_to_end(key)
+            while len(self._values) > self.size:
+                self._values.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+
 class CacheManager(object):
+    """
+    Caches function results in redis, shared by all processes.
+
+    In front of redis, each process keeps the most recently used results in memory,
+    the first tier. Deleting a value only removes it from this process's first tier,
+    other processes keep theirs until the ttl runs out, so keep that short.
+
+    Only one process computes a missing value, the others wait for it to publish the result.
+    For functions cached with stale_while_revalidate, expired values are kept for stale_time
+    seconds more. During that time they're still returned, while a thread computes a new value.
+    Without background_refresh, the caller must refresh them itself, through set_cached.
+    """
+
     def __init__(self, redis_hostname=None, redis_port=None,
-                 redis_db=None, expiration_time=None, lock_timeout=None):
+                 redis_db=None, expiration_time=None, lock_timeout=None,
+                 l1_size=0, l1_ttl=60, compress_min_size=1024, stale_time=0):
         self.redis_hostname = redis_hostname
         self.redis_port = redis_port
         self.redis_db = redis_db
         self.expiration_time = expiration_time
+
+        # How long a value may take to compute, and how long others wait for it.
         self.lock_timeout = lock_timeout
 
+        self.stale_time = stale_time
+        self.l1_size = l1_size
+        self.l1_ttl = l1_ttl
+
+        # Encoded values of at least this many bytes are compressed.
+        self.compress_min_size = compress_min_size
+
+        # The first codec that can encode a value is used.
+        self.codecs = [SequenceRangesCodec(), PickleCodec()]
+
         self._enabled = True
 
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+        self._l1_caches = {}
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
     def disable(self):
         self._enabled = False
 
@@ -42,7 +144,102 @@ class CacheManager(object):
         if self.redis_db is None:
             raise ServiceError("redis db is not set")
 
-        return redis.StrictRedis(host=self.redis_hostname, port=self.redis_port, db=self.redis_db)
+        # The settings are filled in after construction, so make the pool on first use.
+        # The pool makes new connections itself after a fork.
+        with self._pool_lock:
+            address = (self.redis_hostname, self.redis_port, self.redis_db)
+            if self._pool is None or self._pool_address != address:
+                if self._pool is not None:
+                    self._pool.disconnect()
+
+                self._pool = redis.ConnectionPool(host=self.redis_hostname, port=self.redis_port,
+                                                  db=self.redis_db)
+                self._pool_address = address
+
+            return redis.StrictRedis(connection_pool=self._pool)
+
+    def _encode_entry(self, value, stored_time=None):
+        if stored_time is None:
+            stored_time = time.time()
+
+        for codec in self.codecs:
+            if codec.can_encode(value):
+                break
+        else:
+            raise ValueError("no codec for {}".format(type(value)))
+
+        data = codec.encode(value)
+
+        flags = 0
+        if self.compress_min_size is not None and len(data) >= self.compress_min_size:
+            data = zlib.compress(data)
+            flags |= _FLAG_ZLIB
+
+        return _ENTRY_HEADER + _ENTRY_INFO.pack(stored_time, codec.id, flags) + data
+
+    def _decode_entry(self, data):
+        """
+        Returns the stored time and the value, or None if the data isn't an entry.
+        """
+
+        if data is None or not data.startswith(_ENTRY_HEADER):
+            return None
+
+        offset = len(_ENTRY_HEADER)
+        stored_time, codec_id, flags = _ENTRY_INFO.unpack_from(data, offset)
+        data = data[offset + _ENTRY_INFO.size:]
+
+        if flags & _FLAG_ZLIB:
+            data = zlib.decompress(data)
+
+        for codec in self.codecs:
+            if codec.id == codec_id:
+                return stored_time, codec.decode(data)
+
+        _log.warning("no codec with id {}".format(codec_id))
+        return None
+
+    def _get_function_name(self, f):
+        return "%s.%s" % (f.__module__, f.__name__)
+
+    def _get_l1_cache(self, f, size, ttl):
+        """
+        Returns the first tier for the function, or None if it has none.
+        """
+
+        if size is None:
+            size = self.l1_size
+        if ttl is None:
+            ttl = self.l1_ttl
+
+        if size <= 0:
+            return None
+
+        name = self._get_function_name(f)
+        with self._stats_lock:
+            if name not in self._l1_caches:
+                self._l1_caches[name] = MemoryCache(size, ttl)
+            return self._l1_caches[name]
+
+    def _count(self, f, tier):
+        name = self._get_function_name(f)
+        with self._stats_lock:
+            if name not in self._stats:
+                self._stats[name] = {'l1_hits': 0, 'redis_hits': 0, 'stale_hits': 0, 'misses': 0}
+            self._stats[name][tier] += 1
+
+    def get_cache_stats(self):
+        """
+        Returns hits per tier and misses, per cached function.
+        """
+
+        with self._stats_lock:
+            stats = {}
+            for name, counts in self._stats.items():
+                stats[name] = dict(counts)
+                if name in self._l1_caches:
+                    stats[name]['l1_size'] = len(self._l1_caches[name])
+            return stats
 
     def _get_key(self, f, args, kwargs):
         key = function_key_generator(None, f)(*args, **kwargs)
@@ -54,84 +251,327 @@ class CacheManager(object):
     def _get_time_key(self, f, args, kwargs):
         return 'time_%s' % self._get_key(f, args, kwargs)
 
-    def _get_value(self, r, f, args, kwargs):
-        key = self._get_key(f, args, kwargs)
+    def _get_channel_name(self, f, args, kwargs):
+        return 'done_%s' % self._get_key(f, args, kwargs)
+
+    def _get_entry(self, r, f, args, kwargs, max_age=None):
+        """
+        Returns the stored time and value, or None.
+        Takes one round trip. Redis removes expired values itself, but clocks
+        on different hosts may differ, so pass max_age to check the stored time.
+        """
+
+        data = r.get(self._get_key(f, args, kwargs))
+        if data is None:
+            return None
+
+        if data.startswith(_ENTRY_HEADER):
+            entry = self._decode_entry(data)
+        else:
+            entry = self._get_legacy_entry(r, f, args, kwargs, data)
+
+        if entry is None or entry[1] is None:
+            return None
+
+        if max_age is not None and time.time() - entry[0] >= max_age:
+            return None
+
+        return entry
+
+    def _get_legacy_entry(self, r, f, args, kwargs, data):
+        """
+        Reads a value from before entries had a header. These don't expire in redis,
+        they're replaced when the value is computed again.
+        """
 
         time_str = r.get(self._get_time_key(f, args, kwargs))
         if time_str is None:
             return None
 
-        time = datetime.datetime.strptime(time_str.decode('ascii'), "%Y-%m-%dT%H:%M:%S")
-        now = datetime.datetime.now()
-        delta = now - time
-        _log.debug("delta for value is ({}) {}, thus {} seconds".format(type(delta), delta, delta.seconds))
-        if delta.seconds > self.expiration_time:
-            _log.debug("value has expired for {}.{}".format(f.__module__, f.__name__))
+        # The old format stored the local time.
+        stored_time = time.mktime(datetime.datetime.strptime(time_str.decode('ascii'),
+                                                             _LEGACY_TIME_FORMAT).timetuple())
+        return stored_time, pickle.loads(data)
+
+    def _set_value(self, r, f, args, kwargs, value, stale_time=0):
+        with r.pipeline() as pipe:
+            pipe.set(self._get_key(f, args, kwargs), self._encode_entry(value),
+                     ex=self.expiration_time + stale_time)
+
+            # Left behind by the old format, which kept the time separately.
+            pipe.delete(self._get_time_key(f, args, kwargs))
+            pipe.execute()
+
+    def get(self, key):
+        """
+        Returns the value stored under the given key, or None.
+        """
+
+        if not self._enabled:
             return None
 
-        value = r.get(key)
-        if value is None:
+        entry = self._decode_entry(self._get_redis().get(key))
+        if entry is None:
             return None
-        return pickle.loads(value)
 
-    def _set_value(self, r, f, args, kwargs, value):
-        key = self._get_key(f, args, kwargs)
+        stored_time, value = entry
+        return value
+
+    def set(self, key, value, expiration_time=None):
+        if not self._enabled:
+            return
+
+        if expiration_time is None:
+            expiration_time = self.expiration_time
+
+        self._get_redis().set(key, self._encode_entry(value), ex=expiration_time)
+
+    def add(self, key, value, expiration_time=None):
+        """
+        Stores the value only if the key isn't set yet.
+        Returns whether it was stored.
+        """
 
-        now = datetime.datetime.now()
-        r.set(self._get_time_key(f, args, kwargs), now.strftime("%Y-%m-%dT%H:%M:%S").encode('ascii'))
+        if not self._enabled:
+            return True
 
-        r.set(key, pickle.dumps(value))
+        if expiration_time is None:
+            expiration_time = self.expiration_time
+
+        return bool(self._get_redis().set(key, self._encode_entry(value), ex=expiration_time, nx=True))
+
+    def remove(self, key):
+        if not self._enabled:
+            return
+
+        self._get_redis().delete(key)
+
+    def remove_if(self, key, test):
+        """
+        Removes the key only if test returns True for its value. The key isn't removed
+        when another process changes it meanwhile. Returns whether it was removed.
+        """
+
+        if not self._enabled:
+            return False
+
+        with self._get_redis().pipeline() as pipe:
+            try:
+                pipe.watch(key)
+
+                entry = self._decode_entry(pipe.get(key))
+                if entry is None or not test(entry[1]):
+                    return False
+
+                pipe.multi()
+                pipe.delete(key)
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                return False
 
     def delete(self, f, *args, **kwargs):
-        r = self._get_redis()
         key = self._get_key(f, args, kwargs)
 
-        r.delete(key)
+        name = self._get_function_name(f)
+        with self._stats_lock:
+            l1_cache = self._l1_caches.get(name)
+        if l1_cache is not None:
+            l1_cache.delete(key)
+
+        r = self._get_redis()
+
+        r.delete(key, self._get_time_key(f, args, kwargs))
+
+    def cache(self, l1_size=None, l1_ttl=None, stale_while_revalidate=False, background_refresh=True):
+        """
+        Decorator, l1_size and l1_ttl override the manager's first tier settings for the function.
+
+        The decorated function gets get_cached and set_cached, to look up or store a value
+        without calling it. Pass them the same arguments as the function, including self.
+        """
 
-    def cache(self):
         def wrapped(f):
             def new_f(*args, **kwargs):
 
                 if not self._enabled:
                     return f(*args, **kwargs)
 
-                _log.debug("calling new_f")
+                l1_cache = self._get_l1_cache(f, l1_size, l1_ttl)
+                if l1_cache is not None:
+                    key = self._get_key(f, args, kwargs)
+                    found, value = l1_cache.get(key)
+                    if found:
+                        self._count(f, 'l1_hits')
+                        return value
 
-                r = self._get_redis()
-                lock = redis.lock.Lock(r, self._get_lock_name(f, args, kwargs),
-                                       blocking_timeout=self.lock_timeout)
+                if stale_while_revalidate:
+                    stale_time = self.stale_time
+                else:
+                    stale_time = 0
 
-                if lock.acquire():
-                    _log.debug('lock success for {}.{}'.format(f.__module__, f.__name__))
-                    try:
-                        value = self._get_value(r, f, args, kwargs)
-                        if value is not None:
+                value = self._get_from_redis(f, args, kwargs, stale_time, background_refresh)
+                if l1_cache is not None and value is not None:
+                    l1_cache.set(key, value)
+                return value
 
-                            _log.debug('returning old value for {}.{}'.format(f.__module__, f.__name__))
-                            return value
-                        else:
-                            _log.debug('setting new value for {}.{}'.format(f.__module__, f.__name__))
+            def get_cached(*args, **kwargs):
+                """
+                Returns the stored value and whether it's fresh, or None.
+                """
 
-                            value = f(*args, **kwargs)
-                            self._set_value(r, f, args, kwargs, value)
-                            return value
-                    finally:
-                        lock.release()
+                if not self._enabled:
+                    return None
+
+                if stale_while_revalidate:
+                    stale_time = self.stale_time
                 else:
-                    _log.debug('lock failed for {}.{}'.format(f.__module__, f.__name__))
+                    stale_time = 0
 
-                    value = self._get_value(r, f, args, kwargs)
-                    if value is not None:
-                        _log.debug('returning old value for {}.{}'.format(f.__module__, f.__name__))
-                        return value
-                    else:
-                        _log.debug('computing value for {}.{}'.format(f.__module__, f.__name__))
-                        return f(*args, **kwargs)
+                entry = self._get_entry(self._get_redis(), f, args, kwargs, self.expiration_time + stale_time)
+                if entry is None:
+                    return None
+
+                stored_time, value = entry
+                return value, time.time() - stored_time < self.expiration_time
+
+            def set_cached(value, *args, **kwargs):
+                if not self._enabled:
+                    return
+
+                if stale_while_revalidate:
+                    stale_time = self.stale_time
+                else:
+                    stale_time = 0
+
+                r = self._get_redis()
+                self._set_value(r, f, args, kwargs, value, stale_time)
+
+                # Processes may be waiting for it.
+                r.publish(self._get_channel_name(f, args, kwargs), _MESSAGE_DONE)
+
+                l1_cache = self._get_l1_cache(f, l1_size, l1_ttl)
+                if l1_cache is not None:
+                    l1_cache.delete(self._get_key(f, args, kwargs))
 
             new_f.__name__ = f.__name__
             new_f.__module__ = f.__module__
+            new_f.get_cached = get_cached
+            new_f.set_cached = set_cached
             return new_f
         return wrapped
 
+    def _get_from_redis(self, f, args, kwargs, stale_time, background_refresh=True):
+        r = self._get_redis()
+
+        # Most calls are hits, those don't need the lock.
+        entry = self._get_entry(r, f, args, kwargs, self.expiration_time + stale_time)
+        if entry is not None:
+            stored_time, value = entry
+            if time.time() - stored_time < self.expiration_time:
+                self._count(f, 'redis_hits')
+                _log.debug('returning old value for {}.{}'.format(f.__module__, f.__name__))
+                return value
+
+            if stale_time > 0:
+                self._count(f, 'stale_hits')
+                _log.debug('returning stale value for {}.{}'.format(f.__module__, f.__name__))
+                if background_refresh:
+                    self._refresh_in_background(r, f, args, kwargs, stale_time)
+                return value
+
+        return self._compute_or_wait(r, f, args, kwargs, stale_time)
+
+    def _get_lock(self, r, f, args, kwargs):
+        # The lock expires, in case the process that holds it dies.
+        # A background refresh releases it from another thread.
+        return redis.lock.Lock(r, self._get_lock_name(f, args, kwargs), timeout=self.lock_timeout,
+                               thread_local=False)
+
+    def _release(self, lock):
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            _log.warning("lock {} expired before it was released".format(lock.name))
+
+    def _compute(self, r, f, args, kwargs, stale_time):
+        """
+        Computes and stores the value, then tells waiting processes.
+        Must be called with the lock held.
+        """
+
+        channel = self._get_channel_name(f, args, kwargs)
+        try:
+            value = f(*args, **kwargs)
+        except:
+            r.publish(channel, _MESSAGE_ERROR)
+            raise
+
+        self._set_value(r, f, args, kwargs, value, stale_time)
+        r.publish(channel, _MESSAGE_DONE)
+        return value
+
+    def _compute_or_wait(self, r, f, args, kwargs, stale_time):
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+
+        # Subscribe before looking, so that the message can't be missed.
+        pubsub.subscribe(self._get_channel_name(f, args, kwargs))
+        try:
+            deadline = time.time() + self.lock_timeout
+            while True:
+                lock = self._get_lock(r, f, args, kwargs)
+                if lock.acquire(blocking=False):
+                    _log.debug('lock success for {}.{}'.format(f.__module__, f.__name__))
+                    try:
+                        # Another process may have set the value before we got the lock.
+                        entry = self._get_entry(r, f, args, kwargs, self.expiration_time)
+                        if entry is not None:
+                            self._count(f, 'redis_hits')
+                            return entry[1]
+
+                        self._count(f, 'misses')
+                        _log.debug('setting new value for {}.{}'.format(f.__module__, f.__name__))
+                        return self._compute(r, f, args, kwargs, stale_time)
+                    finally:
+                        self._release(lock)
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ServiceError("timed out waiting for {}.{} to be computed"
+                                       .format(f.__module__, f.__name__))
+
+                # Look at the lock again now and then, the process that holds it may have died.
+                message = pubsub.get_message(timeout=min(remaining, _WAIT_INTERVAL))
+                if message is not None and message['data'] == _MESSAGE_ERROR:
+                    raise ServiceError("computing {}.{} failed in another process"
+                                       .format(f.__module__, f.__name__))
+
+                entry = self._get_entry(r, f, args, kwargs, self.expiration_time)
+                if entry is not None:
+                    self._count(f, 'redis_hits')
+                    _log.debug('returning value computed by another process for {}.{}'
+                               .format(f.__module__, f.__name__))
+                    return entry[1]
+        finally:
+            pubsub.close()
+
+    def _refresh_in_background(self, r, f, args, kwargs, stale_time):
+        lock = self._get_lock(r, f, args, kwargs)
+        if not lock.acquire(blocking=False):
+            # Already being refreshed.
+            return
+
+        def refresh():
+            try:
+                self._compute(r, f, args, kwargs, stale_time)
+            except:
+                _log.exception('refreshing {}.{}'.format(f.__module__, f.__name__))
+            finally:
+                self._release(lock)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
 
 cache_manager = CacheManager()
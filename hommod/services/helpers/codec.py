@@ -0,0 +1,82 @@
+import json
+import pickle
+from abc import ABC, abstractmethod
+
+from hommod.models.range import SequenceRange
+
+
+class Codec(ABC):
+    """
+    Turns cached values into bytes and back.
+    Each codec has a unique id, that is stored with the bytes.
+    """
+
+    id = None
+
+    @abstractmethod
+    def can_encode(self, value):
+        pass
+
+    @abstractmethod
+    def encode(self, value):
+        pass
+
+    @abstractmethod
+    def decode(self, data):
+        pass
+
+
+class PickleCodec(Codec):
+    """
+    Encodes anything, but the bytes depend on the classes in the code.
+    """
+
+    id = 0
+
+    def can_encode(self, value):
+        return True
+
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class SequenceRangesCodec(Codec):
+    """
+    Encodes lists of ranges on one sequence as json, with the sequence only once
+    and each range as start, end and ac.
+    """
+
+    id = 1
+
+    SCHEMA_VERSION = 1
+
+    def can_encode(self, value):
+        if not isinstance(value, list) or len(value) <= 0:
+            return False
+
+        for range_ in value:
+            if type(range_) != SequenceRange or range_.sequence != value[0].sequence:
+                return False
+
+        return True
+
+    def encode(self, ranges):
+        return json.dumps({'version': self.SCHEMA_VERSION,
+                           'sequence': ranges[0].sequence,
+                           'ranges': [(range_.start, range_.end, range_.ac) for range_ in ranges]},
+                          separators=(',', ':')).encode('ascii')
+
+    def decode(self, data):
+        obj = json.loads(data.decode('ascii'))
+        if obj['version'] != self.SCHEMA_VERSION:
+            raise ValueError("unsupported ranges schema version {}".format(obj['version']))
+
+        ranges = []
+        for start, end, ac in obj['ranges']:
+            range_ = SequenceRange(start, end, obj['sequence'])
+            range_.ac = ac
+            ranges.append(range_)
+        return ranges
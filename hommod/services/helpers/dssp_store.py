@@ -0,0 +1,162 @@
+"""
+Binary store of dssp sequences and secondary structures, so that workers
+don't need to read and parse dssp text files.
+
+Layout:
+ - header: magic, number of records, number of hash buckets, data offset
+ - hash buckets: record index per bucket, open addressing with linear probing
+ - records: key, data offset, sequence length
+ - data: per record the sequence bytes, followed by the secstr bytes
+
+Every compiled pdbid also gets a record without chain id, so that a chain
+missing from a compiled entry can be told apart from an entry that was
+not compiled.
+"""
+
+import os
+import mmap
+import logging
+import struct
+import shutil
+import tempfile
+from zlib import crc32
+
+from hommod.models.dssp import DsspChain
+
+
+_log = logging.getLogger(__name__)
+
+_MAGIC = b'HMDSSP01'
+_KEY_SIZE = 16
+_HEADER = struct.Struct('<8sIIQ')
+_BUCKET = struct.Struct('<I')
+_RECORD = struct.Struct('<%isQI' % _KEY_SIZE)
+_EMPTY_BUCKET = 0xFFFFFFFF
+
+
+def _get_key(pdbid, chain_id=''):
+    key = ('%s_%s' % (pdbid.lower(), chain_id)).encode('ascii')
+    if len(key) > _KEY_SIZE:
+        raise ValueError("key too long: {}".format(key))
+    return key
+
+
+def _get_bucket(key, count_buckets):
+    return crc32(key) % count_buckets
+
+
+def _encode_entry(pdbid, chains, offset):
+    """
+    Returns the records and the data for one pdbid, with the data at the given offset.
+    """
+
+    records = [(_get_key(pdbid), offset, 0)]
+    data = b''
+    for chain_id in sorted(chains):
+        sequence = chains[chain_id].sequence.encode('ascii')
+        secstr = chains[chain_id].secstr.encode('ascii')
+        if len(sequence) != len(secstr):
+            raise ValueError("{} {}: sequence and secstr lengths differ".format(pdbid, chain_id))
+
+        records.append((_get_key(pdbid, chain_id), offset + len(data), len(sequence)))
+        data += sequence + secstr
+
+    return records, data
+
+
+def write_dssp_store(path, entries):
+    """
+    Writes the given entries to a new store at the given path.
+    The entries must be (pdbid, chains) tuples, with chains
+    a dictionary of DsspChain objects per chain id.
+    Entries that can't be stored are left out, readers treat them as not compiled.
+    """
+
+    records = []
+    data_path = tempfile.mktemp()
+    try:
+        offset = 0
+        with open(data_path, 'wb') as data_file:
+            for pdbid, chains in entries:
+                try:
+                    entry_records, entry_data = _encode_entry(pdbid, chains, offset)
+                except ValueError as e:
+                    _log.warning("leaving {} out of the dssp store: {}".format(pdbid, e))
+                    continue
+
+                records.extend(entry_records)
+                data_file.write(entry_data)
+                offset += len(entry_data)
+
+        count_buckets = max(1, 2 * len(records))
+        buckets = [_EMPTY_BUCKET] * count_buckets
+        for index, (key, offset, length) in enumerate(records):
+            bucket = _get_bucket(key, count_buckets)
+            while buckets[bucket] != _EMPTY_BUCKET:
+                bucket = (bucket + 1) % count_buckets
+            buckets[bucket] = index
+
+        data_offset = _HEADER.size + count_buckets * _BUCKET.size + len(records) * _RECORD.size
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, len(records), count_buckets, data_offset))
+            for index in buckets:
+                f.write(_BUCKET.pack(index))
+            for record in records:
+                f.write(_RECORD.pack(*record))
+
+            with open(data_path, 'rb') as data_file:
+                shutil.copyfileobj(data_file, f)
+
+        # Replace at once, so that readers never see a half written store.
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isfile(data_path):
+            os.remove(data_path)
+
+
+class DsspStore:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns
+
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._count_records, self._count_buckets, self._data_offset = \
+            _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError("not a dssp store: {}".format(path))
+
+        self._records_offset = _HEADER.size + self._count_buckets * _BUCKET.size
+
+    def close(self):
+        self._map.close()
+
+    def _find_record(self, key):
+        bucket = _get_bucket(key, self._count_buckets)
+        while True:
+            index, = _BUCKET.unpack_from(self._map, _HEADER.size + bucket * _BUCKET.size)
+            if index == _EMPTY_BUCKET:
+                return None
+
+            record_key, offset, length = _RECORD.unpack_from(self._map,
+                                                             self._records_offset + index * _RECORD.size)
+            if record_key.rstrip(b'\0') == key:
+                return offset, length
+
+            bucket = (bucket + 1) % self._count_buckets
+
+    def has_entry(self, pdbid):
+        return self._find_record(_get_key(pdbid)) is not None
+
+    def get_chain(self, pdbid, chain_id):
+        record = self._find_record(_get_key(pdbid, chain_id))
+        if record is None:
+            return None
+
+        offset, length = record
+        start = self._data_offset + offset
+        return DsspChain(self._map[start: start + length].decode('ascii'),
+                         self._map[start + length: start + 2 * length].decode('ascii'))
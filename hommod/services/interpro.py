@@ -12,34 +12,98 @@ from hommod.models.error import InitError, ServiceError
 _log = logging.getLogger(__name__)
 
 class InterproService:
+    """
+    Runs interproscan jobs through the EBI's REST service.
+
+    get_domain_ranges waits for the job in the calling process. To not keep a process
+    waiting, use submit_job, get_job_status and get_job_ranges, with get_poll_delay
+    between the status checks, and store the outcome with set_cached_ranges.
+
+    Stale ranges are returned by get_domain_ranges as they are, without waiting for
+    a new job. Refreshing them is up to the caller.
+    """
+
+    # Statuses of jobs that aren't done yet.
+    RUNNING_STATUSES = ['RUNNING', 'PENDING', 'STARTED', 'QUEUED']
+
     def __init__(self, url=None, email=None,
-                 job_timeout=60*60*2, http_timeout=60, poll_interval=10):
+                 job_timeout=60*60*2, http_timeout=60, poll_interval=10, max_poll_interval=60*10):
         self.url = url
         self.email = email
         self.http_timeout = http_timeout
         self.job_timout = job_timeout
         self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
 
-    @cm.cache()
-    def get_domain_ranges(self, sequence):
-        if self.url is None:
-            raise InitError("interpro url is not set")
+        self._session = None
 
-        job_id = self._interpro_submit(sequence)
+    def _get_session(self):
+        # Keeps the connections to interpro open between requests.
+        if self._session is None:
+            self._session = requests.Session()
+        return self._session
+
+    @cm.cache(stale_while_revalidate=True, background_refresh=False)
+    def get_domain_ranges(self, sequence):
+        job_id = self.submit_job(sequence)
 
         t0 = time()
+        attempt = 0
         while (time() - t0) < self.job_timout:
 
-            status = self._interpro_status(job_id)
+            status = self.get_job_status(job_id)
 
-            if status in ['RUNNING', 'PENDING', 'STARTED', 'QUEUED']:
-                sleep(self.poll_interval)
+            if status in InterproService.RUNNING_STATUSES:
+                sleep(self.get_poll_delay(attempt))
+                attempt += 1
             elif status == 'NOT_FOUND':
-                job_id = self._interpro_submit(sequence)
+                job_id = self.submit_job(sequence)
             else:
                 break
 
-        if status == 'RUNNING':
+        return self.get_job_ranges(job_id, status)
+
+    def get_cached_ranges(self, sequence):
+        """
+        Returns the ranges that get_domain_ranges has stored for the sequence
+        and whether they're fresh, or None.
+        """
+
+        return self.get_domain_ranges.get_cached(self, sequence)
+
+    def set_cached_ranges(self, sequence, ranges):
+        self.get_domain_ranges.set_cached(ranges, self, sequence)
+
+    def get_poll_delay(self, attempt):
+        """
+        Returns the number of seconds to wait before a job's next status check,
+        given the number of checks so far. The longer a job runs, the longer we wait.
+        """
+
+        return min(self.poll_interval * 2 ** attempt, self.max_poll_interval)
+
+    def submit_job(self, sequence):
+        """
+        Returns the id of the new job.
+        """
+
+        if self.url is None:
+            raise InitError("interpro url is not set")
+
+        return self._interpro_submit(sequence)
+
+    def get_job_status(self, job_id):
+        if self.url is None:
+            raise InitError("interpro url is not set")
+
+        return self._interpro_status(job_id)
+
+    def get_job_ranges(self, job_id, status):
+        """
+        Returns the ranges found by a job that is done, given its last status.
+        """
+
+        if status in InterproService.RUNNING_STATUSES:
             raise ServiceError("inteproscan job timed out")
         elif status in ['FAILURE', 'ERROR']:
 
@@ -55,7 +119,6 @@ class InterproService:
 
         return self._parse_interpro_ranges(xml_str)
 
-
     def _interpro_submit(self, sequence):
 
         params = {'email': self.email,
@@ -65,7 +128,7 @@ class InterproService:
 
         submit_url = '/'.join([self.url, 'run'])
         try:
-            r = requests.post(submit_url, data=params, timeout=self.http_timeout)
+            r = self._get_session().post(submit_url, data=params, timeout=self.http_timeout)
         except requests.exceptions.ConnectTimeout:
             raise ServiceError("timeout connecting with interpro")
 
@@ -77,7 +140,7 @@ class InterproService:
 
         status_url = '/'.join([self.url, 'status', job_id])
         try:
-            r = requests.get(status_url, timeout=self.http_timeout)
+            r = self._get_session().get(status_url, timeout=self.http_timeout)
         except requests.exceptions.ConnectTimeout:
             raise ServiceError("timeout connecting with interpro")
 
@@ -89,7 +152,7 @@ class InterproService:
 
         result_url = '/'.join([self.url, 'result', job_id, 'xml'])
         try:
-            r = requests.get(result_url, timeout=self.http_timeout)
+            r = self._get_session().get(result_url, timeout=self.http_timeout)
         except requests.exceptions.ConnectTimeout:
             raise ServiceError("timeout connecting with interpro")
 
@@ -101,7 +164,7 @@ class InterproService:
 
         result_url = '/'.join([self.url, 'result', job_id, 'xml'])
         try:
-            r = requests.get(result_url, timeout=self.http_timeout)
+            r = self._get_session().get(result_url, timeout=self.http_timeout)
         except requests.exceptions.ConnectTimeout:
             raise ServiceError("timeout connecting with interpro")
 
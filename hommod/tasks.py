@@ -1,11 +1,12 @@
 import os
 import logging
 import traceback
+from time import time
 
 from filelock import FileLock
 from celery import current_app as celery_app
-from celery import group
-from celery.signals import task_failure
+from celery import group, chain, chord
+from celery.signals import task_failure, task_postrun, worker_process_shutdown
 
 from hommod.controllers.model import modeler
 from hommod.controllers.storage import model_storage
@@ -13,48 +14,353 @@ from hommod.controllers.domain import domain_aligner
 from hommod.models.error import InitError, RecoverableError
 from hommod.controllers.method import select_best_model, select_best_domain_alignment
 from hommod.controllers.log import ModelLogger
+from hommod.controllers.yasara import yasara_pool
+from hommod.controllers.kmad import kmad_aligner
+from hommod.controllers.stage import stage_storage
+from hommod.services.interpro import interpro
+from hommod.services.helpers.cache import cache_manager as cm
 
 
 _log = logging.getLogger(__name__)
 
 
+def get_search_name(target_sequence, target_species_id, require_resnum=None, chosen_template_id=None):
+    """
+    Identifies a model search. Requests with the same name would find the same model.
+    """
+
+    return "%s_%s_%s_%s" % (model_storage.get_sequence_id(target_sequence),
+                            target_species_id.upper(),
+                            str(require_resnum),
+                            str(chosen_template_id))
+
+
+def get_job_key(target_sequence, target_species_id, require_resnum=None, chosen_template_id=None,
+                all_domains=False):
+    """
+    Redis key, under which the id of the job that does this search is kept,
+    with the time it was submitted.
+    """
+
+    if all_domains:
+        prefix = "job_search_all_"
+    else:
+        prefix = "job_search_"
+
+    return prefix + get_search_name(target_sequence, target_species_id,
+                                    require_resnum, chosen_template_id)
+
+
+@celery_app.task(bind=True)
+def create_model(self, target_sequence, target_species_id, require_resnum=None, chosen_template_id=None):
+    """
+    Returns the path of a model for the given parameters, or None if no model could be made.
+
+    In a worker, this is replaced by a chain of stages, that each run on their own queue:
+    search_interpro -> search_domains -> select_template -> build_model.
+    The last stage inherits the job id.
+    When called directly, all stages run in this process.
+    """
+
+    args = (target_sequence, target_species_id, require_resnum, chosen_template_id)
+
+    if self.request.called_directly:
+        return _create_model(*args)
+
+    model_paths = model_storage.list_models(*args)
+    if len(model_paths) > 0:
+        _release_job_key(self.request.id, *args)
+        return select_best_model(model_paths, target_sequence, require_resnum)
+
+    return self.replace(chain(search_interpro.si(target_sequence),
+                              search_domains.s(*args),
+                              select_template.s(*args),
+                              build_model.s(*args)))
+
+
+@celery_app.task(bind=True, max_retries=None)
+def search_interpro(self, target_sequence, job_id=None, attempt=0, submit_time=None, refresh=False):
+    """
+    Returns a stage reference to interpro's ranges for the sequence, for search_domains.
+    The ranges are cached too.
+
+    While interpro works on the job, no worker waits for it. Each run checks the job's
+    status once and if it's not done, the task is retried later, with a growing delay.
+
+    Stale cached ranges are used right away, while another run of this task, with
+    refresh set, replaces them. That run returns None.
+    """
+
+    # Searches for the same sequence follow the same interpro job.
+    job_key = "interpro_job_" + model_storage.get_sequence_id(target_sequence)
+
+    if job_id is None:
+        if not refresh:
+            cached = interpro.get_cached_ranges(target_sequence)
+            if cached is not None:
+                ranges, fresh = cached
+                if not fresh and cm.get(job_key) is None:
+                    search_interpro.apply_async((target_sequence,), {'refresh': True})
+
+                return stage_storage.put(ranges)
+
+        job = cm.get(job_key)
+        if job is None:
+            job = (interpro.submit_job(target_sequence), time())
+            if not cm.add(job_key, job, interpro.job_timout):
+                job = cm.get(job_key) or job
+        elif refresh:
+            # Already being refreshed.
+            return None
+
+        job_id, submit_time = job
+    else:
+        status = interpro.get_job_status(job_id)
+
+        if status == 'NOT_FOUND':
+            job_id = interpro.submit_job(target_sequence)
+            submit_time = time()
+            attempt = 0
+            cm.set(job_key, (job_id, submit_time), interpro.job_timout)
+
+        elif status not in interpro.RUNNING_STATUSES or (time() - submit_time) >= interpro.job_timout:
+            try:
+                ranges = interpro.get_job_ranges(job_id, status)
+                interpro.set_cached_ranges(target_sequence, ranges)
+            finally:
+                cm.remove(job_key)
+
+            if refresh:
+                return None
+            return stage_storage.put(ranges)
+
+    raise self.retry(kwargs={'job_id': job_id, 'attempt': attempt + 1, 'submit_time': submit_time,
+                             'refresh': refresh},
+                     countdown=interpro.get_poll_delay(attempt))
+
+
 @celery_app.task(autoretry_for=(RecoverableError,), retry_kwargs={'max_retries': 50},
-                                                    default_retry_delay=3600)
-def create_model(target_sequence, target_species_id, require_resnum=None, chosen_template_id=None):
+                 default_retry_delay=3600)
+def search_domains(interpro_ranges_ref, target_sequence, target_species_id,
+                   require_resnum=None, chosen_template_id=None):
+    """
+    Returns a stage reference to the domain alignments, or None if there are none.
+    """
+
+    try:
+        domain_alignments = _search_domains(target_sequence, require_resnum, chosen_template_id,
+                                            stage_storage.get(interpro_ranges_ref))
+    except RecoverableError:
+        # The stage will be retried, so it still needs the ranges.
+        raise
+    except:
+        stage_storage.remove(interpro_ranges_ref)
+        raise
+
+    stage_storage.remove(interpro_ranges_ref)
+    if len(domain_alignments) <= 0:
+        return None
+
+    return stage_storage.put(domain_alignments)
+
+
+@celery_app.task()
+def select_template(domain_alignments_ref, target_sequence, target_species_id,
+                    require_resnum=None, chosen_template_id=None):
+    """
+    Returns a stage reference to the domain alignment to model with, or None.
+    """
+
+    if domain_alignments_ref is None:
+        return None
+
+    domain_alignment = select_best_domain_alignment(stage_storage.get(domain_alignments_ref))
+    domain_alignment_ref = stage_storage.put(domain_alignment)
+
+    stage_storage.remove(domain_alignments_ref)
+    return domain_alignment_ref
+
+
+@celery_app.task(bind=True, autoretry_for=(RecoverableError,), retry_kwargs={'max_retries': 50},
+                 default_retry_delay=3600)
+def build_model(self, domain_alignment_ref, target_sequence, target_species_id,
+                require_resnum=None, chosen_template_id=None):
+    """
+    Returns the path of the model, built from the referenced domain alignment.
+    """
+
+    args = (target_sequence, target_species_id, require_resnum, chosen_template_id)
+
+    if domain_alignment_ref is None:
+        _release_job_key(self.request.id, *args)
+        return None
+
+    try:
+        path = _build_model(stage_storage.get(domain_alignment_ref), *args)
+    except RecoverableError:
+        # The stage will be retried, so it still needs the alignment.
+        raise
+    except:
+        stage_storage.remove(domain_alignment_ref)
+        _release_job_key(self.request.id, *args)
+        raise
+
+    stage_storage.remove(domain_alignment_ref)
+    _release_job_key(self.request.id, *args)
+    return path
+
+
+@celery_app.task(bind=True)
+def create_models(self, target_sequence, target_species_id, require_resnum=None, chosen_template_id=None):
+    """
+    Like create_model, but builds a model for every domain alignment that the search finds,
+    in parallel. Returns the paths of all models that were made.
+
+    In a worker, this is replaced by: search_interpro -> search_domains -> build_all_models,
+    which fans out to build_domain_model per alignment and collects with collect_models.
+    """
+
+    args = (target_sequence, target_species_id, require_resnum, chosen_template_id)
+
+    if self.request.called_directly:
+        model_paths = []
+        for domain_alignment in _search_domains(target_sequence, require_resnum, chosen_template_id):
+            model_path = _build_domain_model(domain_alignment, *args)
+            if model_path is not None:
+                model_paths.append(model_path)
+        return model_paths
+
+    return self.replace(chain(search_interpro.si(target_sequence),
+                              search_domains.s(*args),
+                              build_all_models.s(*args)))
+
+
+@celery_app.task(bind=True)
+def build_all_models(self, domain_alignments_ref, target_sequence, target_species_id,
+                     require_resnum=None, chosen_template_id=None):
+    """
+    Replaces itself by a chord, that builds a model for every referenced domain alignment.
+    """
+
+    args = (target_sequence, target_species_id, require_resnum, chosen_template_id)
+
+    if domain_alignments_ref is None:
+        _release_job_key(self.request.id, *args, all_domains=True)
+        return []
+
+    domain_alignment_refs = [stage_storage.put(domain_alignment)
+                             for domain_alignment in stage_storage.get(domain_alignments_ref)]
+    stage_storage.remove(domain_alignments_ref)
+
+    return self.replace(chord([build_domain_model.s(domain_alignment_ref, *args)
+                               for domain_alignment_ref in domain_alignment_refs],
+                              collect_models.s(*args)))
+
+
+@celery_app.task(autoretry_for=(RecoverableError,), retry_kwargs={'max_retries': 50},
+                 default_retry_delay=3600)
+def build_domain_model(domain_alignment_ref, target_sequence, target_species_id,
+                       require_resnum=None, chosen_template_id=None):
+    """
+    Returns the path of the model for the referenced domain alignment, or None if it failed.
+    """
+
+    model_path = _build_domain_model(stage_storage.get(domain_alignment_ref), target_sequence,
+                                     target_species_id, require_resnum, chosen_template_id)
+
+    stage_storage.remove(domain_alignment_ref)
+    return model_path
+
+
+@celery_app.task(bind=True)
+def collect_models(self, model_paths, target_sequence, target_species_id,
+                   require_resnum=None, chosen_template_id=None):
+
+    _release_job_key(self.request.id, target_sequence, target_species_id,
+                     require_resnum, chosen_template_id, all_domains=True)
+
+    return [model_path for model_path in model_paths if model_path is not None]
+
+
+def _build_domain_model(domain_alignment, target_sequence, target_species_id,
+                        require_resnum=None, chosen_template_id=None):
+    # The modeler doesn't build a model twice for the same alignment, no search lock needed.
+    try:
+        return modeler.build_model(target_sequence, target_species_id,
+                                   domain_alignment, require_resnum)
+    except (RecoverableError, InitError):
+        # Retried later, or a misconfigured worker that fails for every domain.
+        raise
+    except:
+        # Don't let one domain take the other models down with it.
+        _log.exception("building a model for {}".format(domain_alignment))
+        return None
+
+
+def _release_job_key(job_id, target_sequence, target_species_id, require_resnum, chosen_template_id,
+                     all_domains=False):
+    key = get_job_key(target_sequence, target_species_id, require_resnum, chosen_template_id,
+                      all_domains)
+    try:
+        # Don't remove the key when it was taken over by another job.
+        cm.remove_if(key, lambda job: job[0] == job_id)
+    except:
+        _log.exception("releasing {}".format(key))
+
+
+def _create_model(target_sequence, target_species_id, require_resnum=None, chosen_template_id=None):
+
+    model_paths = model_storage.list_models(target_sequence, target_species_id,
+                                            require_resnum, chosen_template_id)
+    if len(model_paths) > 0:
+        return select_best_model(model_paths, target_sequence, require_resnum)
+
+    domain_alignments = _search_domains(target_sequence, require_resnum, chosen_template_id)
+    if len(domain_alignments) <= 0:
+        return None
+
+    domain_alignment = select_best_domain_alignment(domain_alignments)
+    return _build_model(domain_alignment, target_sequence, target_species_id,
+                        require_resnum, chosen_template_id)
+
+
+def _search_domains(target_sequence, require_resnum, chosen_template_id, interpro_ranges=None):
+    ModelLogger.get_current().clear()
+
+    domain_alignments = domain_aligner.get_domain_alignments(target_sequence,
+                                                             require_resnum,
+                                                             chosen_template_id,
+                                                             interpro_ranges)
+    if len(domain_alignments) <= 0:
+        _log.warn("no domain alignments for target={} resnum={} template={}"
+                  .format(target_sequence, require_resnum, chosen_template_id))
+
+    return domain_alignments
+
+
+def _build_model(domain_alignment, target_sequence, target_species_id,
+                 require_resnum=None, chosen_template_id=None):
 
     target_species_id = target_species_id.upper()
 
     sequence_id = model_storage.get_sequence_id(target_sequence)
-    lock_name = "lock_search_%s_%s_%s_%s" % (sequence_id,
-                                             target_species_id,
-                                             str(require_resnum),
-                                             str(chosen_template_id))
+    lock_name = "lock_search_" + get_search_name(target_sequence, target_species_id,
+                                                 require_resnum, chosen_template_id)
 
     if model_storage.model_dir is None:
         raise InitError("model directory is not set")
 
-    lock_path = os.path.join(model_storage.model_dir, lock_name)
+    lock_path = model_storage.get_lock_path(sequence_id, lock_name)
     with FileLock(lock_path):
 
+        # Another job may have made the model in the meantime.
         model_paths = model_storage.list_models(target_sequence, target_species_id,
                                                 require_resnum, chosen_template_id)
         if len(model_paths) > 0:
             return select_best_model(model_paths, target_sequence, require_resnum)
-        else:
-            ModelLogger.get_current().clear()
-
-            domain_alignments = \
-                domain_aligner.get_domain_alignments(target_sequence,
-                                                     require_resnum,
-                                                     chosen_template_id)
-            if len(domain_alignments) <= 0:
-                _log.warn("no domain alignments for target={} resnum={} template={}"
-                          .format(target_sequence, require_resnum, chosen_template_id))
-                return None
 
-            domain_alignment = select_best_domain_alignment(domain_alignments)
-            return modeler.build_model(target_sequence, target_species_id,
-                                       domain_alignment, require_resnum)
+        return modeler.build_model(target_sequence, target_species_id,
+                                   domain_alignment, require_resnum)
 
 
 @task_failure.connect
@@ -63,3 +369,14 @@ def task_failure_handler(task_id, exception, *args, **kwargs):
     message += '\n' + ''.join(traceback.format_tb(kwargs['traceback']))
 
     _log.error(message)
+
+
+@task_postrun.connect
+def task_postrun_handler(*args, **kwargs):
+    _log.info("kmad cache stats: {}".format(kmad_aligner.get_cache_stats()))
+    _log.info("cache stats: {}".format(cm.get_cache_stats()))
+
+
+@worker_process_shutdown.connect
+def worker_process_shutdown_handler(*args, **kwargs):
+    yasara_pool.close()
@@ -0,0 +1,58 @@
+import os
+from argparse import ArgumentParser
+import logging
+
+settings = {}
+filename = 'hommod/default_settings.py'
+with open(filename) as config_file:
+    exec(compile(config_file.read(), filename, 'exec'), settings)
+env_settings = {}
+filename = os.environ['HOMMOD_SETTINGS']
+with open(filename) as config_file:
+    exec(compile(config_file.read(), filename, 'exec'), env_settings)
+settings.update(env_settings)
+settings = {k:v for k, v in settings.items() if k.isupper()}
+
+from hommod.services.dssp import dssp
+dssp.dssp_dir = settings['DSSP_DIR']
+
+from hommod.controllers.fasta import FastaIterator
+from hommod.services.helpers.dssp_store import write_dssp_store
+
+
+_log = logging.getLogger(__name__)
+
+
+def get_template_pdbids(templates_fasta_path):
+    pdbids = set()
+    with FastaIterator(templates_fasta_path) as fasta:
+        for id_, sequence in fasta:
+            # ids are formatted like: pdb|1CRN|A
+            pdbids.add(id_.split('|')[1].lower())
+    return pdbids
+
+
+def get_entries(pdbids):
+    for pdbid in sorted(pdbids):
+        try:
+            chains = dssp.read_chains(pdbid)
+        except:
+            _log.warning("cannot read dssp for {}".format(pdbid))
+            continue
+
+        yield pdbid, chains
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig()
+    if settings['DEBUG']:
+        _log.setLevel(logging.DEBUG)
+
+    parser = ArgumentParser(description='Compile the dssp data of all templates into one store')
+    parser.add_argument('templates_fasta', help='the templates fasta, as made by make_templates_fasta.py')
+    parser.add_argument('output_file', help='the output store file')
+
+    args = parser.parse_args()
+
+    write_dssp_store(args.output_file, get_entries(get_template_pdbids(args.templates_fasta)))
@@ -0,0 +1,38 @@
+import os
+from argparse import ArgumentParser
+import logging
+
+settings = {}
+filename = 'hommod/default_settings.py'
+with open(filename) as config_file:
+    exec(compile(config_file.read(), filename, 'exec'), settings)
+env_settings = {}
+filename = os.environ['HOMMOD_SETTINGS']
+with open(filename) as config_file:
+    exec(compile(config_file.read(), filename, 'exec'), env_settings)
+settings.update(env_settings)
+settings = {k:v for k, v in settings.items() if k.isupper()}
+
+from hommod.controllers.clustal import clustal_aligner
+clustal_aligner.clustalw_exe = settings['CLUSTALW_EXE']
+
+from hommod.controllers.storage import model_storage
+model_storage.model_dir = settings['MODEL_DIR']
+model_storage.sharded = settings['MODEL_DIR_SHARDED']
+model_storage.catalog.path = settings['MODEL_CATALOG_PATH']
+
+
+_log = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig()
+    if settings['DEBUG']:
+        _log.setLevel(logging.DEBUG)
+
+    parser = ArgumentParser(description='Make the model catalog match the model directory')
+
+    args = parser.parse_args()
+
+    model_storage.update_catalog()
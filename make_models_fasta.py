@@ -20,6 +20,7 @@ from hommod.controllers.fasta import write_fasta
 
 from hommod.controllers.storage import model_storage
 model_storage.model_dir = settings['MODEL_DIR']
+model_storage.sharded = settings['MODEL_DIR_SHARDED']
 
 
 _log = logging.getLogger(__name__)
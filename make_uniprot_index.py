@@ -0,0 +1,20 @@
+from argparse import ArgumentParser
+import logging
+
+from hommod.controllers.uniprot import uniprot
+
+
+_log = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig()
+
+    parser = ArgumentParser(description='Index a uniprot fasta by accession code')
+    parser.add_argument('fasta_files', nargs='+', help='the uniprot fasta files')
+
+    args = parser.parse_args()
+
+    for fasta_path in args.fasta_files:
+        uniprot.update_index(fasta_path)
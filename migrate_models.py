@@ -0,0 +1,34 @@
+import os
+from argparse import ArgumentParser
+import logging
+
+settings = {}
+filename = 'hommod/default_settings.py'
+with open(filename) as config_file:
+    exec(compile(config_file.read(), filename, 'exec'), settings)
+env_settings = {}
+filename = os.environ['HOMMOD_SETTINGS']
+with open(filename) as config_file:
+    exec(compile(config_file.read(), filename, 'exec'), env_settings)
+settings.update(env_settings)
+settings = {k:v for k, v in settings.items() if k.isupper()}
+
+from hommod.controllers.storage import model_storage
+model_storage.model_dir = settings['MODEL_DIR']
+model_storage.sharded = True
+
+
+_log = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig()
+    if settings['DEBUG']:
+        _log.setLevel(logging.DEBUG)
+
+    parser = ArgumentParser(description='Move the models from the flat directory to the sharded layout')
+
+    args = parser.parse_args()
+
+    model_storage.migrate_to_shards()
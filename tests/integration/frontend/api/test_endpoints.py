@@ -1,11 +1,18 @@
+import os
 import json
+import shutil
 import logging
-from time import sleep
+import queue
+import tempfile
+from time import sleep, time
+from threading import Timer
 
-from mock import patch
+from mock import patch, Mock
 from nose.tools import with_setup, ok_, eq_
 
 from hommod.application import app as flask_app
+from hommod.controllers.bundle import write_bundle
+from hommod.controllers.fasta import write_fasta
 
 
 _log = logging.getLogger(__name__)
@@ -20,23 +27,39 @@ def teardown():
     pass
 
 
+def _make_bundle(output_dir, target_id):
+    work_dir_path = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(work_dir_path, 'target.pdb'), 'w') as f:
+            f.write("END\n")
+        with open(os.path.join(work_dir_path, 'selected-targets.txt'), 'w') as f:
+            f.write("A: %s\n" % target_id)
+        write_fasta(os.path.join(work_dir_path, 'align.fa'), {'target': 'TTCC', '1crn': 'TTCC'})
+
+        path = os.path.join(output_dir, 'abcd_CRAAB_1-4_1crn-A.zip')
+        write_bundle(path, work_dir_path, 'abcd_CRAAB_1-4_1crn-A')
+        return path
+    finally:
+        shutil.rmtree(work_dir_path)
+
+
 @patch('hommod.tasks.create_model.apply_async')
 @patch('hommod.application.celery.AsyncResult')
-@patch('hommod.controllers.storage.model_storage.extract_model')
-@patch('hommod.controllers.storage.model_storage.extract_alignments')
-@patch('hommod.controllers.storage.model_storage.extract_selected_targets')
 @with_setup(setup, teardown)
-def test_interface(mock_targets, mock_alignments, mock_model, mock_async, mock_result):
+def test_interface(mock_async, mock_result):
 
     target_id = 'target'
 
+    output_dir = tempfile.mkdtemp()
+    model_path = _make_bundle(output_dir, target_id)
+
     class FakeResult:
         def __init__(self, job_id):
             self.status = 'SUCCESS'
             self.task_id = str(job_id)
 
         def get(self):
-            return [target_id]
+            return model_path
 
         def failed(self):
             return False
@@ -44,10 +67,6 @@ def test_interface(mock_targets, mock_alignments, mock_model, mock_async, mock_r
     mock_result.return_value = FakeResult('no-job')
     mock_async.return_value = FakeResult('no-job')
 
-    mock_alignments.return_value = []
-    mock_targets.return_value = {'A': target_id}
-    mock_model.return_value = ''
-
     sequence = "TTCCPSIVARSNFNVCRLPGTPEAICATYTGCIIIPGATCPGDYAN"
 
     r = flask_client.post('/api/submit/',
@@ -84,9 +103,293 @@ def test_interface(mock_targets, mock_alignments, mock_model, mock_async, mock_r
 
     r = flask_client.get('/api/get_model_file/%s.pdb' % job_id)
     eq_(r.status_code, 200)
+    eq_(r.data, b"END\n")
+
+    r = flask_client.get('/api/get_model_file/%s.pdb' % job_id,
+                         headers={'If-None-Match': r.headers['ETag']})
+    eq_(r.status_code, 304)
+
+    r = flask_client.get('/api/get_model_file/%s.pdb' % job_id,
+                         headers={'Range': 'bytes=1-2'})
+    eq_(r.status_code, 206)
+    eq_(r.data, b"ND")
 
     _log.debug("getting metadata")
 
     r = flask_client.get('/api/get_metadata/%s/' % job_id)
     eq_(r.status_code, 200)
-    json.loads(r.data)
+    eq_(json.loads(r.data)['selected_targets'], {'A': target_id})
+
+    shutil.rmtree(output_dir)
+
+
+@patch('hommod.tasks.create_model.apply_async')
+@patch('hommod.application.celery.AsyncResult')
+@patch('hommod.services.helpers.cache.cache_manager.add')
+@patch('hommod.services.helpers.cache.cache_manager.get')
+@patch('hommod.controllers.storage.model_storage.find_models_bulk')
+@with_setup(setup, teardown)
+def test_submit_many(mock_find, mock_get, mock_add, mock_result, mock_async):
+
+    def find_models_bulk(queries):
+        for index, (sequence, species_id, position, template_id) in enumerate(queries):
+            if species_id == 'HUMAN':
+                yield index, ['/tmp/abcd_HUMAN_1-4_1crn-A.zip']
+            else:
+                yield index, []
+    mock_find.side_effect = find_models_bulk
+
+    # The MOUSE search is in flight already.
+    mock_add.side_effect = lambda key, value, expiration_time: 'MOUSE' not in key
+    mock_get.return_value = ('running-job', time())
+
+    class FakeResult:
+        def __init__(self, job_id=None):
+            self.status = 'STARTED'
+            self.task_id = job_id
+    mock_result.return_value = FakeResult()
+    mock_async.side_effect = lambda args, task_id: FakeResult(task_id)
+
+    sequence = "TTCCPSIVARSNFNVCRLPGTPEAICATYTGCIIIPGATCPGDYAN"
+    r = flask_client.post('/api/submit_many/',
+                          json=[{'sequence': sequence, 'species_id': 'CRAAB'},
+                                {'sequence': sequence, 'species_id': 'HUMAN'},
+                                {'sequence': sequence, 'species_id': 'craab'},
+                                {'sequence': sequence, 'species_id': 'MOUSE'},
+                                {'sequence': '123', 'species_id': 'CRAAB'}])
+    eq_(r.status_code, 200)
+
+    jobs = json.loads(r.data)['jobs']
+    eq_(len(jobs), 5)
+
+    # Both CRAAB queries share one new job.
+    ok_('jobid' in jobs[0])
+    eq_(jobs[0], jobs[2])
+    eq_(mock_async.call_count, 1)
+
+    eq_(jobs[1], {'model_ids': ['abcd_HUMAN_1-4_1crn-A']})
+    eq_(jobs[3], {'jobid': 'running-job'})
+    ok_('error' in jobs[4])
+
+
+@patch('hommod.tasks.create_model.apply_async')
+@patch('hommod.application.celery.AsyncResult')
+@patch('hommod.services.helpers.cache.cache_manager.remove_if')
+@patch('hommod.services.helpers.cache.cache_manager.add')
+@patch('hommod.services.helpers.cache.cache_manager.get')
+@with_setup(setup, teardown)
+def test_submit_lost_job(mock_get, mock_add, mock_remove_if, mock_result, mock_async):
+
+    class FakeResult:
+        def __init__(self, job_id=None):
+            self.status = 'PENDING'
+            self.task_id = job_id
+    mock_result.return_value = FakeResult()
+    mock_async.side_effect = lambda args, task_id: FakeResult(task_id)
+
+    # The job that holds the key never got a state.
+    lost_job = ('lost-job', time() - flask_app.config['JOB_PENDING_GRACE_TIME'] - 1)
+    mock_get.return_value = lost_job
+    mock_add.side_effect = [False, True]
+
+    sequence = "TTCCPSIVARSNFNVCRLPGTPEAICATYTGCIIIPGATCPGDYAN"
+    r = flask_client.post('/api/submit/', data={'sequence': sequence, 'species_id': 'CRAAB'})
+    eq_(r.status_code, 200)
+    ok_(json.loads(r.data)['jobid'] != 'lost-job')
+
+    # Only the lost job's key is removed.
+    key, test = mock_remove_if.call_args[0]
+    ok_(test(lost_job))
+    ok_(not test(('other-job', time())))
+    eq_(mock_add.call_args[0][2], flask_app.config['JOB_KEY_EXPIRATION_TIME'])
+
+    # When the job can't be queued, its key is released.
+    mock_add.side_effect = None
+    mock_add.return_value = True
+    mock_remove_if.reset_mock()
+    mock_async.side_effect = IOError("broker down")
+
+    r = flask_client.post('/api/submit/', data={'sequence': sequence, 'species_id': 'CRAAB'})
+    eq_(r.status_code, 500)
+
+    key, test = mock_remove_if.call_args[0]
+    job_id = mock_add.call_args[0][1][0]
+    ok_(test((job_id, time())))
+
+
+class FakePubSub:
+    def __init__(self, backend):
+        self.backend = backend
+        self.messages = queue.Queue()
+
+    def subscribe(self, *keys):
+        self.backend.subscribers.append(self)
+
+    def get_message(self, timeout):
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.backend.subscribers.remove(self)
+
+
+class FakeBackend:
+    """
+    Like the redis result backend, that has mget and publishes each status change.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.subscribers = []
+        self.count_mget = 0
+        self.client = self
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+    def get_key_for_task(self, job_id):
+        return 'celery-task-meta-' + job_id
+
+    def mget(self, keys):
+        self.count_mget += 1
+        return [self.data.get(key) for key in keys]
+
+    def decode_result(self, value):
+        return value
+
+    def set_status(self, job_id, meta):
+        key = self.get_key_for_task(job_id)
+        self.data[key] = meta
+        for subscriber in self.subscribers:
+            subscriber.messages.put({'channel': key, 'data': meta})
+
+
+@with_setup(setup, teardown)
+def test_statuses():
+    backend = FakeBackend()
+    backend.set_status('started', {'status': 'STARTED'})
+    backend.set_status('failed', {'status': 'FAILURE', 'traceback': 'error'})
+
+    with patch('hommod.application.celery', Mock(backend=backend)):
+        r = flask_client.post('/api/statuses/', json={'jobs': {'started': None, 'failed': None,
+                                                               'pending': None}})
+        eq_(r.status_code, 200)
+        eq_(json.loads(r.data)['statuses'], {'started': {'status': 'STARTED'},
+                                             'failed': {'status': 'FAILURE', 'message': 'error'},
+                                             'pending': {'status': 'PENDING'}})
+
+        # One request to the backend for all jobs.
+        eq_(backend.count_mget, 1)
+
+        # Returns as soon as a status changes.
+        Timer(0.2, backend.set_status, ('started', {'status': 'SUCCESS'})).start()
+        t0 = time()
+        r = flask_client.post('/api/statuses/', json={'jobs': {'started': 'STARTED', 'pending': 'PENDING'},
+                                                      'wait': 10})
+        ok_(time() - t0 < 5)
+        eq_(json.loads(r.data)['statuses']['started'], {'status': 'SUCCESS'})
+
+        # Or when the time is up.
+        t0 = time()
+        r = flask_client.post('/api/statuses/', json={'jobs': {'pending': 'PENDING'}, 'wait': 0.2})
+        ok_(time() - t0 >= 0.2)
+        eq_(json.loads(r.data)['statuses'], {'pending': {'status': 'PENDING'}})
+
+        # A negative wait doesn't wait.
+        r = flask_client.post('/api/statuses/', json={'jobs': {'pending': 'PENDING'}, 'wait': -10})
+        eq_(r.status_code, 200)
+
+        for wait in ['"soon"', 'NaN', 'Infinity']:
+            r = flask_client.post('/api/statuses/', data='{"jobs": {}, "wait": %s}' % wait,
+                                  content_type='application/json')
+            eq_(r.status_code, 400)
+
+        eq_(flask_client.post('/api/statuses/', json=['started']).status_code, 400)
+
+
+def test_get_all_domains():
+    from hommod.frontend.api.endpoints import _get_all_domains
+
+    for value in ['1', 'true', 'True', 'yes', 'on', True]:
+        ok_(_get_all_domains({'all_domains': value}))
+
+    for value in ['0', 'false', 'no', '', False]:
+        ok_(not _get_all_domains({'all_domains': value}))
+
+    ok_(not _get_all_domains({}))
+
+
+@patch('hommod.tasks.create_models.apply_async')
+@patch('hommod.tasks.create_model.apply_async')
+@patch('hommod.services.helpers.cache.cache_manager.add', return_value=True)
+@patch('hommod.application.celery.AsyncResult')
+@with_setup(setup, teardown)
+def test_all_domains_job(mock_result, mock_add, mock_async, mock_async_all):
+
+    class FakeResult:
+        def __init__(self, job_id=None):
+            self.status = 'SUCCESS'
+            self.task_id = job_id
+
+        def get(self):
+            return ['/tmp/abcd_HUMAN_1-4_1crn-A.zip', '/tmp/abcd_HUMAN_8-20_2crn-A.zip']
+
+    mock_result.return_value = FakeResult()
+    mock_async_all.side_effect = lambda args, task_id: FakeResult(task_id)
+
+    sequence = "TTCCPSIVARSNFNVCRLPGTPEAICATYTGCIIIPGATCPGDYAN"
+    r = flask_client.post('/api/submit/', data={'sequence': sequence, 'species_id': 'HUMAN',
+                                                'all_domains': 'true'})
+    eq_(r.status_code, 200)
+    ok_(mock_async_all.called)
+    ok_(not mock_async.called)
+    ok_(mock_add.call_args[0][0].startswith('job_search_all_'))
+
+    job_id = json.loads(r.data)['jobid']
+
+    r = flask_client.get('/api/result/%s/' % job_id)
+    eq_(r.status_code, 200)
+    eq_(json.loads(r.data), {'model_created': True,
+                             'model_ids': ['abcd_HUMAN_1-4_1crn-A', 'abcd_HUMAN_8-20_2crn-A']})
+
+    # There's no single model file or metadata for these jobs.
+    eq_(flask_client.get('/api/get_model_file/%s.pdb' % job_id).status_code, 400)
+    eq_(flask_client.get('/api/get_metadata/%s/' % job_id).status_code, 400)
+
+
+@patch('hommod.application.celery.AsyncResult')
+@with_setup(setup, teardown)
+def test_model_file_closes_bundle(mock_result):
+    from hommod.controllers.storage import model_storage
+
+    output_dir = tempfile.mkdtemp()
+    try:
+        model_path = _make_bundle(output_dir, 'target')
+        mock_result.return_value = Mock(status='SUCCESS', get=Mock(return_value=model_path))
+
+        bundles = []
+        def open_bundle(path):
+            bundle = open_bundle_(path)
+            bundle.close = Mock(side_effect=bundle.close)
+            bundles.append(bundle)
+            return bundle
+
+        open_bundle_ = model_storage.open_bundle
+        with patch.object(model_storage, 'open_bundle', side_effect=open_bundle):
+            for headers in [{}, {'Accept-Encoding': 'gzip'}, {'Range': 'bytes=1-2'}]:
+                r = flask_client.get('/api/get_model_file/job.pdb', headers=headers, buffered=True)
+                ok_(r.status_code in (200, 206))
+                r.close()
+
+            r = flask_client.get('/api/get_model_file/job.pdb', buffered=True,
+                                 headers={'If-None-Match': r.headers['ETag']})
+            eq_(r.status_code, 304)
+            r.close()
+
+        eq_(len(bundles), 4)
+        for bundle in bundles:
+            ok_(bundle.close.called)
+    finally:
+        shutil.rmtree(output_dir)
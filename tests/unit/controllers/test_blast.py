@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+from nose.tools import eq_, ok_
+
+from hommod.controllers.blast import blaster, BlastCache
+
+
+_XML = """<?xml version="1.0"?>
+<BlastOutput>
+  <BlastOutput_iterations>
+    <Iteration>
+      <Iteration_iter-num>1</Iteration_iter-num>
+      <Iteration_query-def>query0</Iteration_query-def>
+      <Iteration_hits>
+        <Hit>
+          <Hit_def>pdb|1CRN|A</Hit_def>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_query-from>1</Hsp_query-from>
+              <Hsp_query-to>4</Hsp_query-to>
+              <Hsp_hit-from>2</Hsp_hit-from>
+              <Hsp_hit-to>5</Hsp_hit-to>
+              <Hsp_qseq>TTCC</Hsp_qseq>
+              <Hsp_hseq>TTCC</Hsp_hseq>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+      </Iteration_hits>
+    </Iteration>
+    <Iteration>
+      <Iteration_iter-num>2</Iteration_iter-num>
+      <Iteration_query-def>query1</Iteration_query-def>
+      <Iteration_hits>
+      </Iteration_hits>
+      <Iteration_message>No hits found</Iteration_message>
+    </Iteration>
+  </BlastOutput_iterations>
+</BlastOutput>
+"""
+
+
+def test_parse_multiple_queries():
+    hits_per_query = blaster._parse_alignments(BytesIO(_XML.encode('ascii')),
+                                               {'query0': 'TTCCP', 'query1': 'AAAA'}, 'templates')
+
+    eq_(len(hits_per_query['query0']), 1)
+    alignment = hits_per_query['query0']['pdb|1CRN|A'][0]
+    eq_(alignment.full_query_sequence, 'TTCCP')
+    eq_(alignment.get_hit_accession_code(), '1CRN')
+    eq_(alignment.subject_start, 2)
+
+    eq_(hits_per_query['query1'], {})
+
+
+def test_parse_filters():
+    hits_per_query = blaster._parse_alignments(BytesIO(_XML.encode('ascii')),
+                                               {'query0': 'TTCCP', 'query1': 'AAAA'}, 'templates',
+                                               hit_id_suffix='|B')
+    eq_(hits_per_query['query0'], {})
+
+    hits_per_query = blaster._parse_alignments(BytesIO(_XML.replace('<Hsp_hseq>TTCC', '<Hsp_hseq>TTAA').encode('ascii')),
+                                               {'query0': 'TTCCP', 'query1': 'AAAA'}, 'templates',
+                                               min_identity=70.0)
+    eq_(hits_per_query['query0'], {})
+
+
+def test_cache():
+    cache_dir = tempfile.mkdtemp()
+    databank_dir = tempfile.mkdtemp()
+    try:
+        databank = os.path.join(databank_dir, 'templates')
+        open(databank + '.pin', 'w').close()
+
+        cache = BlastCache(cache_dir)
+        mtime = cache.get_databank_mtime(databank)
+        ok_(mtime is not None)
+
+        key = cache.get_key('TTCCP', databank, mtime, {})
+        eq_(cache.get(key, 'TTCCP', databank), None)
+
+        hits = blaster._parse_alignments(BytesIO(_XML.encode('ascii')),
+                                         {'query0': 'TTCCP', 'query1': 'AAAA'}, 'templates')['query0']
+        cache.set(key, hits)
+
+        cached_hits = cache.get(key, 'TTCCP', databank)
+        eq_(list(cached_hits.keys()), ['pdb|1CRN|A'])
+
+        alignment = cached_hits['pdb|1CRN|A'][0]
+        eq_(alignment.full_query_sequence, 'TTCCP')
+        eq_(alignment.query_start, 1)
+        eq_(alignment.subject_end, 5)
+        eq_(alignment.subject_alignment, 'TTCC')
+
+        # A rebuilt databank must not hit the old entry.
+        ok_(cache.get_key('TTCCP', databank, mtime + 1, {}) != key)
+    finally:
+        shutil.rmtree(cache_dir)
+        shutil.rmtree(databank_dir)
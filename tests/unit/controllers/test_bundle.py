@@ -0,0 +1,81 @@
+import os
+import gzip
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from hommod.controllers.bundle import open_bundle, write_bundle, ZipBundle, TarBundle
+from hommod.controllers.fasta import write_fasta
+
+
+def _make_work_dir():
+    work_dir_path = tempfile.mkdtemp()
+    write_fasta(os.path.join(work_dir_path, 'target.fa'), {'target': 'MTTCCP'})
+    write_fasta(os.path.join(work_dir_path, 'align.fa'), {'target': 'TTCC|AA', '1crn': 'TTCA|AA'})
+    with open(os.path.join(work_dir_path, 'selected-targets.txt'), 'w') as f:
+        f.write("A: abc\nB: def\n")
+    with open(os.path.join(work_dir_path, 'target.pdb'), 'w') as f:
+        f.write("END\n")
+    return work_dir_path
+
+
+def _check_bundle(bundle):
+    eq_(bundle.get_target_sequence(), 'MTTCCP')
+    eq_(bundle.get_selected_targets(), {'A': 'abc', 'B': 'def'})
+    eq_(bundle.get_model(), "END\n")
+
+    alignments = bundle.get_alignments()
+    eq_(len(alignments), 2)
+    eq_(alignments[0].aligned_sequences['1crn'], 'TTCA')
+
+    ok_(not bundle.has_member('align.fasta'))
+
+
+def test_bundle_formats():
+    work_dir_path = _make_work_dir()
+    output_dir = tempfile.mkdtemp()
+    try:
+        zip_path = os.path.join(output_dir, 'model.zip')
+        write_bundle(zip_path, work_dir_path, 'model', 'zip')
+        with open_bundle(zip_path) as bundle:
+            ok_(isinstance(bundle, ZipBundle))
+            _check_bundle(bundle)
+
+        tgz_path = os.path.join(output_dir, 'model.tgz')
+        write_bundle(tgz_path, work_dir_path, 'model', 'tgz')
+        with open_bundle(tgz_path) as bundle:
+            ok_(isinstance(bundle, TarBundle))
+            _check_bundle(bundle)
+    finally:
+        shutil.rmtree(work_dir_path)
+        shutil.rmtree(output_dir)
+
+
+def test_old_tarball():
+    with open_bundle('tests/unit/data/zfn.tgz') as bundle:
+        ok_(bundle.get_model().startswith('SEQRES') or 'ATOM' in bundle.get_model())
+
+
+def test_gzip_passthrough():
+    work_dir_path = _make_work_dir()
+    output_dir = tempfile.mkdtemp()
+    try:
+        zip_path = os.path.join(output_dir, 'model.zip')
+        write_bundle(zip_path, work_dir_path, 'model', 'zip')
+        with open_bundle(zip_path) as bundle:
+            data = b''.join(bundle.iter_gzip('target.fa'))
+            eq_(len(data), bundle.get_gzip_size('target.fa'))
+            eq_(gzip.decompress(data), bundle.read('target.fa'))
+
+            eq_(bundle.open_member('target.pdb').read(), b"END\n")
+            eq_(bundle.get_member_size('target.pdb'), 4)
+
+        tgz_path = os.path.join(output_dir, 'model.tgz')
+        write_bundle(tgz_path, work_dir_path, 'model', 'tgz')
+        with open_bundle(tgz_path) as bundle:
+            eq_(bundle.get_gzip_size('target.fa'), None)
+            eq_(bundle.open_member('target.pdb').read(), b"END\n")
+    finally:
+        shutil.rmtree(work_dir_path)
+        shutil.rmtree(output_dir)
@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from nose.tools import eq_, ok_
+
+from hommod.controllers.storage import ModelStorage
+from hommod.controllers.fasta import write_fasta
+from hommod.models.template import TemplateID
+
+
+def _make_work_dir(sequence):
+    work_dir_path = tempfile.mkdtemp()
+    write_fasta(os.path.join(work_dir_path, 'target.fa'), {'target': sequence})
+    write_fasta(os.path.join(work_dir_path, 'align.fa'), {'target': 'TTCC', '1crn': 'TTCA'})
+    return work_dir_path
+
+
+def test_catalog():
+    model_dir = tempfile.mkdtemp()
+    work_dir_path = _make_work_dir('MTTCCP')
+    try:
+        storage = ModelStorage(model_dir)
+        storage.catalog.path = os.path.join(model_dir, 'catalog.sqlite')
+
+        sequence_id = storage.get_sequence_id('MTTCCP')
+        name = '%s_HUMAN_2-5_1CRN-A' % sequence_id
+        tar_path = storage.get_tar_path_from_name(name)
+
+        storage.store_model(work_dir_path, tar_path, 'MTTCCP', 75.0)
+        ok_(os.path.isfile(tar_path))
+        ok_(not os.path.isfile(tar_path + '.tmp'))
+
+        # Not built from disk yet, so the directory is scanned.
+        ok_(not storage._use_catalog())
+        eq_(storage.list_models('MTTCCP', 'human'), [tar_path])
+
+        storage.update_catalog()
+        ok_(storage._use_catalog())
+
+        eq_(storage.list_models('MTTCCP', 'human'), [tar_path])
+        eq_(storage.list_models('MTTCCP', 'human', template_id=TemplateID('1crn', 'A')), [tar_path])
+        eq_(storage.list_models('MTTCCP', 'human', template_id=TemplateID('1crn', 'B')), [])
+        eq_(storage.list_models('MTTCCP', 'mouse'), [])
+        eq_(storage.list_all_models(), [tar_path])
+
+        os.remove(tar_path)
+        storage.update_catalog()
+        eq_(storage.list_all_models(), [])
+
+        # Rebuilding reads the identity from the tarball.
+        storage.store_model(work_dir_path, tar_path, 'MTTCCP', 75.0)
+        os.remove(storage.catalog.path)
+        storage.update_catalog()
+        eq_(storage.list_all_models(), [tar_path])
+    finally:
+        shutil.rmtree(model_dir)
+        shutil.rmtree(work_dir_path)
+
+
+def test_parse_model_name():
+    storage = ModelStorage()
+
+    eq_(storage.parse_model_name('abc_HUMAN_2-5_1crn-A'), ('abc', 'HUMAN', 2, 5, TemplateID('1crn', 'A')))
+    eq_(storage.parse_model_name('abc_HUMAN_2-5'), ('abc', 'HUMAN', 2, 5, None))
+
+
+def test_intervals_cover():
+    storage = ModelStorage()
+
+    ok_(storage._intervals_cover([[1, 3], [8, 10]], 8))
+    ok_(not storage._intervals_cover([[1, 3], [8, 10]], 5))
+
+
+def test_find_models_bulk():
+    model_dir = tempfile.mkdtemp()
+    work_dir_path = _make_work_dir('MTTCCP')
+    try:
+        storage = ModelStorage(model_dir)
+        storage.catalog.path = os.path.join(model_dir, 'catalog.sqlite')
+
+        sequence_id = storage.get_sequence_id('MTTCCP')
+        tar_path = storage.get_tar_path_from_name('%s_HUMAN_2-5_1CRN-A' % sequence_id)
+        storage.store_model(work_dir_path, tar_path, 'MTTCCP', 75.0)
+        storage._write_covered_intervals(tar_path, 'MTTCCP', [[2, 5]])
+
+        queries = [('MTTCCP', 'HUMAN', None, None),
+                   ('AAAA', 'HUMAN', None, None),
+                   ('MTTCCP', 'human', 3, TemplateID('1crn', 'A')),
+                   ('MTTCCP', 'HUMAN', 6, None),
+                   ('MTTCCP', 'MOUSE', None, None)]
+        expected = {0: [tar_path], 1: [], 2: [tar_path], 3: [], 4: []}
+
+        # Once by listing the directory, once from the catalog.
+        eq_(dict(storage.find_models_bulk(queries)), expected)
+
+        storage.update_catalog()
+        ok_(storage._use_catalog())
+        eq_(dict(storage.find_models_bulk(queries)), expected)
+    finally:
+        shutil.rmtree(model_dir)
+        shutil.rmtree(work_dir_path)
+
+
+def test_update_catalog_while_storing():
+    model_dir = tempfile.mkdtemp()
+    work_dir_path = _make_work_dir('MTTCCP')
+    try:
+        storage = ModelStorage(model_dir)
+        storage.catalog.path = os.path.join(model_dir, 'catalog.sqlite')
+        storage.update_catalog()
+
+        sequence_id = storage.get_sequence_id('MTTCCP')
+        tar_path = storage.get_tar_path_from_name('%s_HUMAN_2-5_1CRN-A' % sequence_id)
+
+        # A worker stores a model after the directory was scanned.
+        scan_all_models = storage._scan_all_models
+        def scan_and_store():
+            paths = scan_all_models()
+            storage.store_model(work_dir_path, tar_path, 'MTTCCP', 75.0)
+            return paths
+
+        with patch.object(storage, '_scan_all_models', side_effect=scan_and_store):
+            storage.update_catalog()
+
+        eq_(storage.list_models('MTTCCP', 'human'), [tar_path])
+    finally:
+        shutil.rmtree(model_dir)
+        shutil.rmtree(work_dir_path)
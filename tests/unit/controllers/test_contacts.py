@@ -0,0 +1,27 @@
+from nose.tools import eq_, ok_
+
+from hommod.controllers.contacts import any_within_distance, get_interacting_chains
+
+
+def test_any_within_distance():
+    positions = [(0.0, 0.0, 0.0), (10.0, 0.0, 0.0)]
+
+    ok_(any_within_distance(positions, [(14.0, 3.0, 0.0)], 6.0))
+    ok_(not any_within_distance(positions, [(20.0, 0.0, 0.0), (-6.0, 0.0, 0.0)], 6.0))
+    ok_(not any_within_distance(positions, [], 6.0))
+
+
+def test_get_interacting_chains():
+    positions_per_chain = {
+        'A': [(0.0, 0.0, 0.0), (1.5, 0.0, 0.0)],
+        'B': [(-5.0, 0.0, 0.0), (-4.0, -1.0, 0.0)],
+        'C': [(5.5, 0.0, 0.0)],
+        'D': [(50.0, 50.0, 50.0)],
+    }
+
+    interacting = get_interacting_chains(positions_per_chain, 4.5)
+
+    eq_(interacting['A'], ['B', 'C'])
+    eq_(interacting['B'], ['A'])
+    eq_(interacting['C'], ['A'])
+    eq_(interacting['D'], [])
@@ -1,3 +1,4 @@
+from mock import patch
 from nose.tools import eq_, ok_, with_setup
 
 from hommod.controllers.domain import domain_aligner
@@ -154,3 +155,24 @@ def test_filter_forbidden_ranges():
     rs = domain_aligner._filter_forbidden_ranges(il)
 
     eq_(len(rs), 2)
+
+
+@patch('hommod.controllers.kmad.kmad_aligner.align')
+def test_kmad_align_all_keeps_order(mock_align):
+    def align(template_sequence, template_secstr, target_sequence):
+        if template_sequence == 'FAIL':
+            raise RuntimeError("kmad failed")
+        return TargetTemplateAlignment(target_sequence, template_sequence)
+    mock_align.side_effect = align
+
+    templates = [('AAAA', 'CCCC'), ('FAIL', 'CCCC'), ('CCCC', 'HHHH'), ('DDDD', 'EEEE')]
+
+    domain_aligner.kmad_concurrency = 3
+    try:
+        alignments = domain_aligner._kmad_align_all('AAAC', templates)
+    finally:
+        domain_aligner.kmad_concurrency = 1
+
+    eq_(alignments[1], None)
+    eq_([alignment.template_alignment for alignment in alignments if alignment is not None],
+        ['AAAA', 'CCCC', 'DDDD'])
@@ -0,0 +1,32 @@
+from mock import patch
+from nose.tools import eq_
+
+from hommod.controllers.kmad import KmadAligner
+
+
+@patch('hommod.controllers.kmad.KmadAligner._align')
+def test_align_cached(mock_align):
+    mock_align.return_value = ('TTCC-', 'TTCCP')
+
+    aligner = KmadAligner(cache_size=1)
+
+    alignment = aligner.align('TTCCP', 'CHHHC', 'TTCC')
+    eq_(alignment.target_alignment, 'TTCC-')
+
+    alignment.target_alignment = 'changed'
+
+    alignment = aligner.align('TTCCP', 'CHHHC', 'TTCC')
+    eq_(alignment.target_alignment, 'TTCC-')
+    eq_(mock_align.call_count, 1)
+
+    aligner.align('TTCCP', 'CHHHC', 'TTCC', modifier=4.0)
+    eq_(mock_align.call_count, 2)
+
+    # The first alignment must have been pushed out.
+    aligner.align('TTCCP', 'CHHHC', 'TTCC')
+    eq_(mock_align.call_count, 3)
+
+    stats = aligner.get_cache_stats()
+    eq_(stats['hits'], 1)
+    eq_(stats['misses'], 3)
+    eq_(stats['size'], 1)
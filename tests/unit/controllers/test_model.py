@@ -1,16 +1,16 @@
 import tempfile
+import shutil
 import os
 
 from nose.tools import eq_
-from mock import patch
 
 from hommod.controllers.model import modeler
 from hommod.controllers.storage import model_storage
+from hommod.controllers.bundle import write_bundle
 from hommod.models.align import TargetTemplateAlignment
 
 
-@patch("tarfile.open")
-def test_selected_targets_format(mock_open):
+def test_selected_targets_format():
 
     targets = {'a': 'coffee',
                'b': 'tea'}
@@ -20,25 +20,17 @@ def test_selected_targets_format(mock_open):
         alignments[chain_id] = TargetTemplateAlignment('', '')
         alignments[chain_id].target_id = targets[chain_id]
 
-    path = tempfile.mktemp()
-
-    class FakeTarFile:
-        def __enter__(self, *args, **kwargs):
-            return self
-
-        def __exit__(self, *args, **kwargs):
-            pass
-
-        def extractfile(self, *args, **kwargs):
-            return open(path, 'rb')
+    work_dir_path = tempfile.mkdtemp()
+    output_dir = tempfile.mkdtemp()
+    try:
+        modeler._write_selected_targets(alignments, os.path.join(work_dir_path, 'selected-targets.txt'))
 
-    mock_open.return_value = FakeTarFile()
+        tar_path = os.path.join(output_dir, 'model.tgz')
+        write_bundle(tar_path, work_dir_path, 'model', 'tgz')
 
-    try:
-        modeler._write_selected_targets(alignments, path)
-        parsed = model_storage.extract_selected_targets('no.tar.gz')
+        parsed = model_storage.extract_selected_targets(tar_path)
     finally:
-        if os.path.isfile(path):
-            os.remove(path)
+        shutil.rmtree(work_dir_path)
+        shutil.rmtree(output_dir)
 
     eq_(parsed, targets)
@@ -0,0 +1,47 @@
+import os
+import time
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_, raises
+
+from hommod.controllers.stage import StageStorage
+from hommod.models.range import SequenceRange
+
+
+def test_put_get_remove():
+    stage_dir = tempfile.mkdtemp()
+    try:
+        storage = StageStorage(os.path.join(stage_dir, 'stages'))
+        range_ = SequenceRange(2, 10, "AAAAAAAAAAAAAA")
+
+        ref = storage.put([range_])
+        eq_(storage.get(ref), [range_])
+
+        storage.remove(ref)
+        eq_(os.listdir(storage.stage_dir), [])
+    finally:
+        shutil.rmtree(stage_dir)
+
+
+def test_remove_older_than():
+    stage_dir = tempfile.mkdtemp()
+    try:
+        storage = StageStorage(stage_dir)
+
+        old_ref = storage.put(1)
+        new_ref = storage.put(2)
+
+        path = storage._get_path(old_ref)
+        os.utime(path, (time.time() - 100, time.time() - 100))
+
+        eq_(storage.remove_older_than(50), 1)
+        ok_(not os.path.isfile(path))
+        eq_(storage.get(new_ref), 2)
+    finally:
+        shutil.rmtree(stage_dir)
+
+
+@raises(ValueError)
+def test_invalid_ref():
+    StageStorage('/tmp').get('../secret')
@@ -1,7 +1,12 @@
-from nose.tools import with_setup, ok_
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from nose.tools import with_setup, ok_, eq_
 
 from hommod import default_settings as settings
-from hommod.controllers.storage import model_storage
+from hommod.controllers.storage import model_storage, ModelStorage
 from hommod.controllers.clustal import clustal_aligner
 
 
@@ -14,12 +19,23 @@ def teardown():
     pass
 
 
+def _model_covers_copy(name, sequence, position):
+    # model_covers writes a file next to the tarball, keep that out of the repo.
+    model_dir = tempfile.mkdtemp()
+    try:
+        tar_path = os.path.join(model_dir, name)
+        shutil.copy(os.path.join("tests/unit/data", name), tar_path)
+        return model_storage.model_covers(tar_path, sequence, position)
+    finally:
+        shutil.rmtree(model_dir)
+
+
 @with_setup(setup, teardown)
 def test_covered_zfn():
     sequence = "MELLTFRDVAIEFSPEEWKCLDPDQQNLYRDVMLENYRNLVSLGVAISNPDLVTCLEQRKEPYNVKIHKIVARPPAMCSHFTQDHWPVQGIEDSFHKLILRRYEKCGHDNLQLRKGCKSLNECKLQKGGYNEFNECLSTTQSKILQCKASVKVVSKFSNSNKRKTRHTGEKHFKECGKSFQKFSHLTQHKVIHAGEKPYTCEECGKAFKWSLIFNEHKRIHTGEKPFTCEECGSIFTTSSHFAKHKIIHTGEKPYKCEECGKAFNRFTTLTKHKRIHAGEKPITCEECRKIFTSSSNFAKHKRIHTGEKPYKCEECGKAFNRSTTLTKHKRIHTGEKPYTCEECGKAFRQSSKLNEHKKVHTGERPYKCDECGKAFGRSRVLNEHKKIHTGEKPYKCEECGKAFRRSTDRSQHKKIHSADKPYKCKECDKAFKQFSLLSQHKKIHTVDKPYKCKDCDKAFKRFSHLNKHKKIHT"
     position = 385
 
-    ok_(not model_storage.model_covers("tests/unit/data/zfn.tgz", sequence, position))
+    ok_(not _model_covers_copy("zfn.tgz", sequence, position))
 
 
 @with_setup(setup, teardown)
@@ -27,4 +43,71 @@ def test_covered_transferase():
     sequence = "MALKNINYLLIFYLSFSLLIYIKNSFCNKNNTRCLSNSCQNNSTCKDFSKDNDCSCSDTANNLDKDCDNMKDPCFSNPCQGSATCVNTPGERSFLCKCPPGYSGTICETTIGSCGKNSCQHGGICHQDPIYPVCICPAGYAGRFCEIDHDECASSPCQNGAVCQDGIDGYSCFCVPGYQGRHCDLEVDECASDPCKNEATCLNEIGRYTCICPHNYSGVNCELEIDECWSQPCLNGATCQDALGAYFCDCAPGFLGDHCELNTDECASQPCLHGGLCVDGENRYSCNCTGSGFTGTHCETLMPLCWSKPCHNNATCEDSVDNYTCHCWPGYTGAQCEIDLNECNSNPCQSNGECVELSSEKQYGRITGLPSSFSYHEASGYVCICQPGFTGIHCEEDVNECSSNPCQNGGTCENLPGNYTCHCPFDNLSRTFYGGRDCSDILLGCTHQQCLNNGTCIPHFQDGQHGFSCLCPSGYTGSLCEIATTLSFEGDGFLWVKSGSVTTKGSVCNIALRFQTVQPMALLLFRSNRDVFVKLELLSGYIHLSIQVNNQSKVLLFISHNTSDGEWHFVEVIFAEAVTLTLIDDSCKEKCIAKAPTPLESDQSICAFQNSFLGGLPVGMTSNGVALLNFYNMPSTPSFVGCLQDIKIDWNHITLENISSGSSLNVKAGCVRKDWCESQPCQSRGRCINLWLSYQCDCHRPYEGPNCLREYVAGRFGQDDSTGYVIFTLDESYGDTISLSMFVRTLQPSGLLLALENSTYQYIRVWLERGRLAMLTPNSPKLVVKFVLNDGNVHLISLKIKPYKIELYQSSQNLGFISASTWKIEKGDVIYIGGLPDKQETELNGGFFKGCIQDVRLNNQNLEFFPNPTNNASLNPVLVNVTQGCAGDNSCKSNPCHNGGVCHSRWDDFSCSCPALTSGKACEEVQWCGFSPCPHGAQCQPVLQGFECIANAVFNGQSGQILFRSNGNITRELTNITFGFRTRDANVIILHAEKEPEFLNISIQDSRLFFQLQSGNSFYMLSLTSLQSVNDGTWHEVTLSMTDPLSQTSRWQMEVDNETPFVTSTIATGSLNFLKDNTDIYVGDRAIDNIKGLQGCLSTIEIGGIYLSYFENVHGFINKPQEEQFLKISTNSVVTGCLQLNVCNSNPCLHGGNCEDIYSSYHCSCPLGWSGKHCELNIDECFSNPCIHGNCSDRVAAYHCTCEPGYTGVNCEVDIDNCQSHQCANGATCISHTNGYSCLCFGNFTGKFCRQSRLPSTVCGNEKTNLTCYNGGNCTEFQTELKCMCRPGFTGEWCEKDIDECASDPCVNGGLCQDLLNKFQCLCDVAFAGERCEVDLADDLISDIFTTIGSVTVALLLILLLAIVASVVTSNKRATQGTYSPSRQEKEGSRVEMWNLMPPPAMERLI"
     position = 162
 
-    ok_(not model_storage.model_covers("tests/unit/data/transferase.tgz", sequence, position))
+    ok_(not _model_covers_copy("transferase.tgz", sequence, position))
+
+
+def test_covered_from_file():
+    model_dir = tempfile.mkdtemp()
+    try:
+        storage = ModelStorage(model_dir)
+        tar_path = os.path.join(model_dir, 'model.tgz')
+
+        eq_(storage.read_covered_intervals(tar_path, "MTTCCP"), None)
+
+        storage._write_covered_intervals(tar_path, "MTTCCP", [[2, 4]])
+
+        # The tarball doesn't exist, so this must not extract it.
+        ok_(storage.model_covers(tar_path, "MTTCCP", 3))
+        ok_(not storage.model_covers(tar_path, "MTTCCP", 5))
+
+        # Intervals for another sequence don't count.
+        eq_(storage.read_covered_intervals(tar_path, "MTTCC"), None)
+    finally:
+        shutil.rmtree(model_dir)
+
+
+def test_covered_read_only():
+    model_dir = tempfile.mkdtemp()
+    try:
+        storage = ModelStorage(model_dir)
+        tar_path = os.path.join(model_dir, 'model.tgz')
+
+        with patch.object(storage, 'extract_model', return_value=''), \
+                patch.object(storage, 'get_covered_intervals', return_value=[[2, 4]]), \
+                patch.object(storage, '_write_covered_intervals', side_effect=PermissionError()):
+            ok_(storage.model_covers(tar_path, "MTTCCP", 3))
+    finally:
+        shutil.rmtree(model_dir)
+
+
+def test_sharded_layout():
+    model_dir = tempfile.mkdtemp()
+    try:
+        storage = ModelStorage(model_dir)
+
+        name = 'abcdef_HUMAN_2-5_1crn-A'
+        flat_path = os.path.join(model_dir, name + '.tgz')
+        open(flat_path, 'w').close()
+        storage._write_covered_intervals(flat_path, "MTTCCP", [[2, 4]])
+
+        storage.sharded = True
+        sharded_path = os.path.join(model_dir, 'ab', 'cd', name + '.tgz')
+
+        # Flat models must still be found.
+        eq_(storage.get_tar_path_from_name(name), flat_path)
+        eq_(storage._scan_all_models(), [flat_path])
+
+        storage.migrate_to_shards()
+        ok_(os.path.isfile(sharded_path))
+        ok_(not os.path.isfile(flat_path))
+        ok_(os.path.isfile(storage.get_covered_path(sharded_path)))
+
+        eq_(storage.get_tar_path_from_name(name), sharded_path)
+        eq_(storage.resolve_tar_path(flat_path), sharded_path)
+        eq_(storage._scan_all_models(), [sharded_path])
+
+        storage.lock_dir = os.path.join(model_dir, 'locks')
+        eq_(storage.get_lock_path('abcdef', 'lock_search'),
+            os.path.join(model_dir, 'locks', 'ab', 'cd', 'lock_search'))
+    finally:
+        shutil.rmtree(model_dir)
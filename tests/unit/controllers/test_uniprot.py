@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_, raises
+
+from hommod.controllers.uniprot import Uniprot
+
+
+_FASTA = """>sp|P01542|CRAM_CRAAB
+TTCCPSIVARSNFNVCRLPG
+TPEAICATYTGCIIIPGATCPGDYAN
+>sp|P69905|HBA_HUMAN
+MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHF
+"""
+
+
+def _write_fasta(dir_path, name, contents):
+    path = os.path.join(dir_path, name)
+    with open(path, 'w') as f:
+        f.write(contents)
+    return path
+
+
+def test_get_sequences():
+    dir_path = tempfile.mkdtemp()
+    try:
+        sprot_path = _write_fasta(dir_path, 'sprot.fasta', _FASTA)
+        trembl_path = _write_fasta(dir_path, 'trembl.fasta', ">tr|Q00001|Q00001_HUMAN\nAAAA\n")
+
+        uniprot = Uniprot([sprot_path, trembl_path])
+
+        eq_(uniprot.get_sequence('P01542'), "TTCCPSIVARSNFNVCRLPGTPEAICATYTGCIIIPGATCPGDYAN")
+
+        sequences = uniprot.get_sequences(['P69905', 'Q00001'])
+        eq_(sequences['P69905'], "MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHF")
+        eq_(sequences['Q00001'], "AAAA")
+
+        ok_(os.path.isfile(uniprot.get_index_path(sprot_path)))
+    finally:
+        shutil.rmtree(dir_path)
+
+
+def test_rebuild_on_change():
+    dir_path = tempfile.mkdtemp()
+    try:
+        fasta_path = _write_fasta(dir_path, 'sprot.fasta', _FASTA)
+
+        uniprot = Uniprot([fasta_path])
+        eq_(uniprot.get_sequence('P69905'), "MVLSPADKTNVKAAWGKVGAHAGEYGAEALERMFLSFPTTKTYFPHF")
+
+        _write_fasta(dir_path, 'sprot.fasta', ">sp|P69905|HBA_HUMAN\nMVLS\n")
+        stat = os.stat(fasta_path)
+        os.utime(fasta_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+        eq_(uniprot.get_sequence('P69905'), "MVLS")
+    finally:
+        shutil.rmtree(dir_path)
+
+
+@raises(ValueError)
+def test_not_found():
+    dir_path = tempfile.mkdtemp()
+    try:
+        fasta_path = _write_fasta(dir_path, 'sprot.fasta', _FASTA)
+
+        Uniprot([fasta_path]).get_sequence('XXXXXX')
+    finally:
+        shutil.rmtree(dir_path)
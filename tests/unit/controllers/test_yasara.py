@@ -0,0 +1,83 @@
+from threading import Event
+
+from mock import patch, MagicMock
+from nose.tools import eq_, ok_
+
+from hommod.controllers.yasara import YasaraPool
+
+
+def _fake_yasara(yasara_dir):
+    yasara = MagicMock()
+    yasara.yasara_dir = yasara_dir
+    yasara.count_jobs = 0
+    yasara.is_alive.return_value = True
+    return yasara
+
+
+@patch("hommod.controllers.yasara.YasaraObject", side_effect=_fake_yasara)
+def test_pool_reuses_process(mock_yasara_object):
+    pool = YasaraPool(size=1, max_jobs=3)
+
+    yasara = pool.acquire('yasara')
+    pool.release(yasara)
+    ok_(pool.acquire('yasara') is yasara)
+
+    eq_(mock_yasara_object.call_count, 1)
+    ok_(yasara.Clear.called)
+
+
+@patch("hommod.controllers.yasara.YasaraObject", side_effect=_fake_yasara)
+def test_pool_recycles_process(mock_yasara_object):
+    pool = YasaraPool(size=1, max_jobs=2)
+
+    yasara = pool.acquire('yasara')
+    pool.release(yasara)
+    pool.release(pool.acquire('yasara'))
+
+    ok_(yasara.Exit.called)
+    ok_(pool.acquire('yasara') is not yasara)
+
+
+@patch("hommod.controllers.yasara.YasaraObject", side_effect=_fake_yasara)
+def test_pool_discards_dead_process(mock_yasara_object):
+    pool = YasaraPool(size=1, max_jobs=10)
+
+    yasara = pool.acquire('yasara')
+    pool.release(yasara)
+
+    yasara.is_alive.return_value = False
+    ok_(pool.acquire('yasara') is not yasara)
+
+
+@patch("hommod.controllers.yasara.YasaraObject", side_effect=_fake_yasara)
+def test_pool_discards_failed_process(mock_yasara_object):
+    pool = YasaraPool(size=1, max_jobs=10)
+
+    yasara = pool.acquire('yasara')
+    pool.release(yasara, failed=True)
+
+    ok_(yasara.Exit.called)
+    ok_(not yasara.Clear.called)
+    ok_(pool.acquire('yasara') is not yasara)
+
+
+@patch("hommod.controllers.yasara.YasaraObject", side_effect=_fake_yasara)
+def test_pool_kills_hung_process(mock_yasara_object):
+    pool = YasaraPool(size=1, max_jobs=10, timeout=0.1)
+
+    yasara = pool.acquire('yasara')
+
+    killed = Event()
+
+    def kill():
+        yasara.is_alive.return_value = False
+        killed.set()
+
+    # Clear only returns when the process is killed, like a blocked socket read.
+    yasara.Kill.side_effect = kill
+    yasara.Clear.side_effect = lambda: killed.wait(5.0)
+
+    pool.release(yasara)
+
+    ok_(killed.is_set())
+    ok_(pool.acquire('yasara') is not yasara)
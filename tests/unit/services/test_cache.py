@@ -0,0 +1,310 @@
+import time
+import pickle
+import datetime
+
+import redis
+from mock import patch
+from nose.tools import eq_, ok_
+
+from hommod.services.helpers.cache import CacheManager
+from hommod.models.range import SequenceRange
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+        self.watched = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def watch(self, key):
+        self.watched[key] = self.redis.data.get(key)
+
+    def get(self, key):
+        return self.redis.get(key)
+
+    def multi(self):
+        pass
+
+    def set(self, *args, **kwargs):
+        self.commands.append((self.redis.set, args, kwargs))
+
+    def delete(self, *args):
+        self.commands.append((self.redis.delete, args, {}))
+
+    def execute(self):
+        for key, value in self.watched.items():
+            if self.redis.data.get(key) != value:
+                raise redis.exceptions.WatchError()
+
+        for command, args, kwargs in self.commands:
+            command(*args, **kwargs)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.gets = 0
+        self.published = []
+        self.on_wait = None
+
+    def get(self, key):
+        self.gets += 1
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return False
+        self.data[key] = value
+        self.expires[key] = ex
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+
+    def subscribe(self, channel):
+        pass
+
+    def get_message(self, timeout):
+        # Meanwhile, another process sets the value.
+        if self.redis.on_wait is not None:
+            self.redis.on_wait()
+        return None
+
+    def close(self):
+        pass
+
+
+def test_entry():
+    cm = CacheManager()
+
+    stored_time, value = cm._decode_entry(cm._encode_entry([1, 2], 10.0))
+    eq_(stored_time, 10.0)
+    eq_(value, [1, 2])
+
+    eq_(cm._decode_entry(pickle.dumps([1, 2])), None)
+
+
+@patch('redis.lock.Lock')
+def test_legacy_entry(mock_lock):
+    r = FakeRedis()
+    cm = CacheManager(expiration_time=100, lock_timeout=10)
+
+    @cm.cache()
+    def f(x):
+        raise AssertionError("computed while an old entry was stored")
+
+    with patch.object(cm, '_get_redis', return_value=r):
+        # Stored without a header, with the local time under a separate key.
+        r.set(cm._get_key(f, (1,), {}), pickle.dumps([1, 2]))
+        r.set(cm._get_time_key(f, (1,), {}),
+              datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S").encode('ascii'))
+
+        eq_(f(1), [1, 2])
+
+
+def test_ranges_entry():
+    cm = CacheManager(compress_min_size=100)
+
+    sequence = "A" * 1000
+    ranges = [SequenceRange(0, 10, sequence), SequenceRange(20, 100, sequence)]
+    ranges[1].ac = 'IPR000001'
+
+    data = cm._encode_entry(ranges)
+    ok_(len(data) < len(sequence))
+
+    stored_time, value = cm._decode_entry(data)
+    eq_(value, ranges)
+    eq_(value[1].ac, 'IPR000001')
+
+
+@patch('redis.lock.Lock')
+def test_cache(mock_lock):
+    r = FakeRedis()
+    cm = CacheManager(expiration_time=100, lock_timeout=10)
+
+    calls = []
+
+    @cm.cache()
+    def f(x):
+        calls.append(x)
+        return x * 2
+
+    with patch.object(cm, '_get_redis', return_value=r):
+        eq_(f(2), 4)
+        eq_(mock_lock.call_count, 1)
+
+        # A hit takes one get and no lock.
+        r.gets = 0
+        eq_(f(2), 4)
+        eq_(calls, [2])
+        eq_(r.gets, 1)
+        eq_(mock_lock.call_count, 1)
+
+        key = cm._get_key(f, (2,), {})
+        eq_(r.expires[key], 100)
+
+        cm.delete(f, 2)
+        ok_(key not in r.data)
+
+
+def test_remove_if():
+    r = FakeRedis()
+    cm = CacheManager(expiration_time=100)
+
+    with patch.object(cm, '_get_redis', return_value=r):
+        cm.set('key', ('job', 1.0), 10)
+        eq_(r.expires['key'], 10)
+
+        cm.set('key', ('job', 1.0))
+        eq_(r.expires['key'], 100)
+
+        ok_(not cm.remove_if('key', lambda job: job[0] == 'other'))
+        ok_('key' in r.data)
+
+        ok_(cm.remove_if('key', lambda job: job[0] == 'job'))
+        ok_('key' not in r.data)
+
+        # Another process sets the key between the get and the delete.
+        cm.set('key', ('job', 1.0))
+        ok_(not cm.remove_if('key', lambda job: r.set('key', b'other') and True))
+        eq_(r.data['key'], b'other')
+
+
+@patch('redis.lock.Lock')
+def test_l1_cache(mock_lock):
+    r = FakeRedis()
+    cm = CacheManager(expiration_time=100, lock_timeout=10, l1_size=1, l1_ttl=100)
+
+    @cm.cache()
+    def f(x):
+        return x * 2
+
+    @cm.cache(l1_size=0)
+    def g(x):
+        return x * 3
+
+    with patch.object(cm, '_get_redis', return_value=r):
+        f(1)
+        f(1)
+        f(2)  # pushes 1 out of the first tier
+        f(1)
+
+        g(1)
+        g(1)
+
+        # Deleting also removes it from the first tier.
+        cm.delete(f, 1)
+        r.gets = 0
+        eq_(f(1), 2)
+        ok_(r.gets > 0)
+
+    stats = cm.get_cache_stats()
+    eq_(stats['%s.f' % __name__], {'l1_hits': 1, 'redis_hits': 1, 'stale_hits': 0, 'misses': 3, 'l1_size': 1})
+    eq_(stats['%s.g' % __name__], {'l1_hits': 0, 'redis_hits': 1, 'stale_hits': 0, 'misses': 1})
+
+
+@patch('threading.Thread')
+@patch('redis.lock.Lock')
+def test_stale_while_revalidate(mock_lock, mock_thread):
+    r = FakeRedis()
+    cm = CacheManager(expiration_time=100, lock_timeout=10, stale_time=1000)
+
+    calls = []
+
+    @cm.cache(stale_while_revalidate=True)
+    def f(x):
+        calls.append(x)
+        return len(calls)
+
+    with patch.object(cm, '_get_redis', return_value=r):
+        key = cm._get_key(f, (1,), {})
+        r.set(key, cm._encode_entry(0, time.time() - 200))
+
+        # The stale value is returned, while the refresh starts.
+        eq_(f(1), 0)
+        eq_(calls, [])
+        eq_(mock_thread.call_count, 1)
+
+        mock_thread.call_args[1]['target']()
+        eq_(calls, [1])
+        eq_(r.expires[key], 1100)
+        eq_(f(1), 1)
+
+
+@patch('threading.Thread')
+@patch('redis.lock.Lock')
+def test_stale_without_background_refresh(mock_lock, mock_thread):
+    r = FakeRedis()
+    cm = CacheManager(expiration_time=100, lock_timeout=10, stale_time=1000)
+
+    @cm.cache(stale_while_revalidate=True, background_refresh=False)
+    def f(x):
+        raise AssertionError("computed while a stale value was stored")
+
+    with patch.object(cm, '_get_redis', return_value=r):
+        r.set(cm._get_key(f, (1,), {}), cm._encode_entry(0, time.time() - 200))
+
+        eq_(f(1), 0)
+        eq_(mock_thread.call_count, 0)
+        eq_(f.get_cached(1), (0, False))
+
+        f.set_cached(1, 1)
+        eq_(f.get_cached(1), (1, True))
+
+
+@patch('threading.Thread')
+@patch('redis.lock.Lock')
+def test_expired_without_stale_time(mock_lock, mock_thread):
+    r = FakeRedis()
+    cm = CacheManager(expiration_time=100, lock_timeout=10, stale_time=1000)
+
+    @cm.cache()
+    def f(x):
+        return 1
+
+    with patch.object(cm, '_get_redis', return_value=r):
+        # Redis didn't expire it yet, for instance because the writer's clock is behind.
+        r.set(cm._get_key(f, (1,), {}), cm._encode_entry(0, time.time() - 200))
+
+        eq_(f(1), 1)
+        eq_(mock_thread.call_count, 0)
+
+
+@patch('redis.lock.Lock')
+def test_wait_for_other_process(mock_lock):
+    r = FakeRedis()
+    cm = CacheManager(expiration_time=100, lock_timeout=10)
+
+    @cm.cache()
+    def f(x):
+        raise AssertionError("computed while another process was doing it")
+
+    mock_lock.return_value.acquire.return_value = False
+
+    with patch.object(cm, '_get_redis', return_value=r):
+        key = cm._get_key(f, (1,), {})
+        r.on_wait = lambda: r.set(key, cm._encode_entry(5))
+
+        eq_(f(1), 5)
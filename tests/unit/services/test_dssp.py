@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from hommod.services.dssp import DsspService
+from hommod.services.helpers.dssp_store import write_dssp_store
+from hommod.models.dssp import DsspChain
+from hommod.models.template import TemplateID
+
+
+def _dssp_line(chain_id, amino_acid, secstr):
+    return ' ' * 11 + chain_id + ' ' + amino_acid + '  ' + secstr + '   0   0'
+
+
+def _write_dssp(dir_path, pdbid, lines):
+    path = os.path.join(dir_path, '%s.dssp' % pdbid)
+    with open(path, 'w') as f:
+        f.write("==== Secondary Structure Definition by the program DSSP ==== .\n")
+        f.write("  #  RESIDUE AA STRUCTURE BP1 BP2  ACC\n")
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+def test_parse_once():
+    dir_path = tempfile.mkdtemp()
+    try:
+        _write_dssp(dir_path, '1crn', [_dssp_line('A', 'T', 'E'),
+                                       _dssp_line('A', 'a', 'H'),
+                                       _dssp_line('B', 'G', ' ')])
+        dssp = DsspService(dir_path)
+
+        ok_(dssp.has_secondary_structure(TemplateID('1CRN', 'A')))
+        ok_(not dssp.has_secondary_structure(TemplateID('1crn', 'C')))
+        eq_(dssp.get_sequence(TemplateID('1crn', 'A')), "TC")
+        eq_(dssp.get_secondary_structure(TemplateID('1crn', 'A')), "EH")
+
+        stats = dssp.get_cache_stats()
+        eq_(stats['misses'], 1)
+        eq_(stats['hits'], 3)
+    finally:
+        shutil.rmtree(dir_path)
+
+
+def test_cache_bounds_and_invalidation():
+    dir_path = tempfile.mkdtemp()
+    try:
+        path = _write_dssp(dir_path, '1crn', [_dssp_line('A', 'T', 'E')])
+        _write_dssp(dir_path, '2crn', [_dssp_line('A', 'G', 'H')])
+
+        dssp = DsspService(dir_path, cache_size=1)
+        dssp.prefetch([TemplateID('1crn', 'A'), TemplateID('2crn', 'A'), TemplateID('3crn', 'A')])
+        eq_(dssp.get_cache_stats()['size'], 1)
+
+        _write_dssp(dir_path, '1crn', [_dssp_line('A', 'M', 'H')])
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+        eq_(dssp.get_sequence(TemplateID('1crn', 'A')), "M")
+    finally:
+        shutil.rmtree(dir_path)
+
+
+def test_store():
+    dir_path = tempfile.mkdtemp()
+    try:
+        _write_dssp(dir_path, '1crn', [_dssp_line('A', 'T', 'E'),
+                                       _dssp_line('A', 'T', 'H')])
+        store_path = os.path.join(dir_path, 'templates.bin')
+
+        dssp = DsspService(dir_path, store_path=store_path)
+        write_dssp_store(store_path, [('1crn', dssp.read_chains('1crn')),
+                                      ('2crn', {'B': DsspChain("GAC", "HH ")})])
+
+        # Must come from the store, not from the dssp files:
+        os.remove(os.path.join(dir_path, '1crn.dssp'))
+
+        eq_(dssp.get_sequence(TemplateID('1crn', 'A')), "TT")
+        eq_(dssp.get_secondary_structure(TemplateID('2crn', 'B')), "HH ")
+        ok_(not dssp.has_secondary_structure(TemplateID('2crn', 'A')))
+        ok_(not dssp.has_secondary_structure(TemplateID('3crn', 'A')))
+        eq_(dssp.get_cache_stats()['misses'], 0)
+    finally:
+        shutil.rmtree(dir_path)
+
+
+def test_store_skips_bad_entries():
+    dir_path = tempfile.mkdtemp()
+    try:
+        store_path = os.path.join(dir_path, 'templates.bin')
+
+        write_dssp_store(store_path, [('1crn', {'A': DsspChain("TT", "EH")}),
+                                      ('2crn', {'A' * 20: DsspChain("GA", "HH")}),
+                                      ('3crn', {'A': DsspChain("GA", "H")}),
+                                      ('4crn', {'A': DsspChain("MM", "  ")})])
+
+        dssp = DsspService(dir_path, store_path=store_path)
+        eq_(dssp.get_sequence(TemplateID('1crn', 'A')), "TT")
+        eq_(dssp.get_sequence(TemplateID('4crn', 'A')), "MM")
+        ok_(not dssp.has_secondary_structure(TemplateID('3crn', 'A')))
+    finally:
+        shutil.rmtree(dir_path)
@@ -1,6 +1,15 @@
-from nose.tools import eq_
+import shutil
+import tempfile
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from hommod.services.interpro import interpro
+from mock import patch
+from nose.tools import eq_, ok_
+
+from hommod.services.interpro import interpro, InterproService
+from hommod.services.helpers.cache import cache_manager as cm
+from hommod.controllers.stage import stage_storage
+from hommod.models.range import SequenceRange
 
 
 
@@ -17,3 +26,181 @@ def test_interpro_parser():
 
     domain_ranges = interpro._parse_interpro_ranges(xml)
     eq_(type(domain_ranges), list)
+
+
+_RESULT_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<protein-matches xmlns="http://www.ebi.ac.uk/interpro/resources/schemas/interproscan5">
+    <protein>
+        <sequence md5="?">%s</sequence>
+        <matches>
+            <hmmer3-match>
+                <signature>
+                    <entry ac="IPR000001" desc="Kringle"/>
+                </signature>
+                <locations>
+                    <hmmer3-location start="2" end="40"/>
+                </locations>
+            </hmmer3-match>
+        </matches>
+    </protein>
+</protein-matches>"""
+
+_SEQUENCE = "M" + "A" * 50
+
+
+class _FakeInterproHandler(BaseHTTPRequestHandler):
+    """
+    Stands in for the interpro REST service. Jobs are done after two status checks.
+    """
+
+    # Keeps connections open.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, text):
+        data = text.encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.submitted += 1
+        self._respond('job-%d' % self.server.submitted)
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+
+        parts = self.path.strip('/').split('/')
+        if parts[0] == 'status':
+            self.server.status_checks += 1
+            if self.server.status_checks < 3:
+                self._respond('RUNNING')
+            else:
+                self._respond('FINISHED')
+        elif parts[0] == 'result':
+            self._respond(_RESULT_XML % _SEQUENCE)
+        else:
+            self.send_error(404)
+
+
+def _start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _FakeInterproHandler)
+    server.submitted = 0
+    server.status_checks = 0
+    server.connections = set()
+
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def test_interpro_job():
+    server = _start_server()
+    cm.disable()
+    try:
+        service = InterproService('http://127.0.0.1:%d' % server.server_port, poll_interval=0.01)
+
+        ranges = service.get_domain_ranges(_SEQUENCE)
+        eq_([(range_.start, range_.end, range_.ac) for range_ in ranges], [(1, 39, 'IPR000001')])
+        eq_(server.submitted, 1)
+        eq_(server.status_checks, 3)
+
+        # One connection for all requests.
+        eq_(len(server.connections), 1)
+    finally:
+        cm.enable()
+        server.shutdown()
+        server.server_close()
+
+
+def test_poll_delay():
+    service = InterproService(poll_interval=10, max_poll_interval=60)
+    eq_([service.get_poll_delay(attempt) for attempt in range(4)], [10, 20, 40, 60])
+
+
+def test_search_interpro_task():
+    from hommod.tasks import search_interpro
+
+    server = _start_server()
+    url = interpro.url
+    interpro.url = 'http://127.0.0.1:%d' % server.server_port
+    stage_dir = tempfile.mkdtemp()
+    stage_storage.stage_dir = stage_dir
+    cm.disable()
+    try:
+        with patch.object(interpro, 'get_poll_delay', return_value=0), \
+                patch.object(interpro, 'set_cached_ranges') as mock_set:
+
+            result = search_interpro.apply((_SEQUENCE,))
+            eq_(result.status, 'SUCCESS')
+
+            # Each status check is a retry of the task.
+            eq_(server.submitted, 1)
+            eq_(server.status_checks, 3)
+
+            sequence, ranges = mock_set.call_args[0]
+            eq_(sequence, _SEQUENCE)
+            eq_([range_.ac for range_ in ranges], ['IPR000001'])
+
+            # The ranges are passed on, even when they can't be cached.
+            eq_([range_.ac for range_ in stage_storage.get(result.result)], ['IPR000001'])
+    finally:
+        cm.enable()
+        stage_storage.stage_dir = None
+        shutil.rmtree(stage_dir)
+        interpro.url = url
+        server.shutdown()
+        server.server_close()
+
+
+def test_search_interpro_stale():
+    from hommod.tasks import search_interpro
+
+    stage_dir = tempfile.mkdtemp()
+    stage_storage.stage_dir = stage_dir
+    try:
+        ranges = [SequenceRange(0, 38, _SEQUENCE)]
+        with patch.object(interpro, 'get_cached_ranges', return_value=(ranges, False)), \
+                patch.object(interpro, 'submit_job') as mock_submit, \
+                patch('hommod.tasks.cm') as mock_cm, \
+                patch.object(search_interpro, 'apply_async') as mock_apply_async:
+            mock_cm.get.return_value = None
+
+            # The stale ranges are used right away, another task refreshes them.
+            result = search_interpro.apply((_SEQUENCE,))
+            eq_(stage_storage.get(result.result), ranges)
+            ok_(not mock_submit.called)
+            eq_(mock_apply_async.call_args[0], ((_SEQUENCE,), {'refresh': True}))
+
+            # No second refresh while the first one is running.
+            mock_cm.get.return_value = ('job', 0.0)
+            eq_(search_interpro.apply((_SEQUENCE,), {'refresh': True}).result, None)
+            ok_(not mock_submit.called)
+    finally:
+        stage_storage.stage_dir = None
+        shutil.rmtree(stage_dir)
+
+
+def test_search_interpro_resubmit():
+    from hommod.tasks import search_interpro
+
+    with patch.object(interpro, 'get_job_status', return_value='NOT_FOUND'), \
+            patch.object(interpro, 'submit_job', return_value='new-job'), \
+            patch.object(interpro, 'get_poll_delay', return_value=0), \
+            patch.object(search_interpro, 'retry', side_effect=RuntimeError("retry")), \
+            patch('hommod.tasks.cm') as mock_cm:
+
+        search_interpro.apply((_SEQUENCE,), {'job_id': 'lost-job', 'submit_time': 0.0})
+
+        # Followers must not find the new job after it could have timed out.
+        key, (job_id, submit_time), expiration_time = mock_cm.set.call_args[0]
+        eq_(job_id, 'new-job')
+        eq_(expiration_time, interpro.job_timout)
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from nose.tools import eq_, ok_, raises
+from celery import chain
+
+from hommod.tasks import (search_domains, select_template, build_model, create_models,
+                          build_all_models, collect_models, _build_domain_model)
+from hommod.controllers.stage import stage_storage
+from hommod.models.error import ModelRunError, InitError
+
+
+_ARGS = ('MTTCCP', 'HUMAN', None, None)
+
+
+def _with_stage_dir(f):
+    def wrapped(*args, **kwargs):
+        stage_dir = tempfile.mkdtemp()
+        stage_storage.stage_dir = stage_dir
+        try:
+            return f(*args, **kwargs)
+        finally:
+            stage_storage.stage_dir = None
+            shutil.rmtree(stage_dir)
+
+    wrapped.__name__ = f.__name__
+    return wrapped
+
+
+@_with_stage_dir
+@patch('hommod.tasks._release_job_key')
+@patch('hommod.tasks._build_model', return_value='/models/model.zip')
+@patch('hommod.tasks.select_best_domain_alignment', side_effect=lambda alignments: alignments[0])
+@patch('hommod.tasks._search_domains', return_value=['alignment1', 'alignment2'])
+def test_stages(mock_search, mock_select, mock_build, mock_release):
+
+    ranges_ref = stage_storage.put(['range'])
+
+    result = chain(search_domains.s(ranges_ref, *_ARGS),
+                   select_template.s(*_ARGS),
+                   build_model.s(*_ARGS)).apply()
+    eq_(result.get(), '/models/model.zip')
+
+    # Each stage gets the previous stage's object.
+    eq_(mock_search.call_args[0], ('MTTCCP', None, None, ['range']))
+    eq_(mock_select.call_args[0], (['alignment1', 'alignment2'],))
+    eq_(mock_build.call_args[0], ('alignment1',) + _ARGS)
+
+    # All stage files are removed and the job key is released.
+    eq_(os.listdir(stage_storage.stage_dir), [])
+    eq_(mock_release.call_args[0][1:], _ARGS)
+
+
+@_with_stage_dir
+@patch('hommod.tasks._release_job_key')
+@patch('hommod.tasks._build_model')
+@patch('hommod.tasks._search_domains', return_value=[])
+def test_stages_without_alignments(mock_search, mock_build, mock_release):
+
+    result = chain(search_domains.s(stage_storage.put([]), *_ARGS),
+                   select_template.s(*_ARGS),
+                   build_model.s(*_ARGS)).apply()
+    eq_(result.get(), None)
+
+    ok_(not mock_build.called)
+    eq_(os.listdir(stage_storage.stage_dir), [])
+    ok_(mock_release.called)
+
+
+@_with_stage_dir
+@patch('hommod.tasks._release_job_key')
+@patch('hommod.tasks._build_model', side_effect=ModelRunError("failed"))
+def test_build_model_failure(mock_build, mock_release):
+
+    result = build_model.apply((stage_storage.put('alignment'),) + _ARGS)
+    eq_(result.status, 'FAILURE')
+
+    eq_(os.listdir(stage_storage.stage_dir), [])
+    ok_(mock_release.called)
+
+
+@_with_stage_dir
+@patch('hommod.tasks._search_domains', side_effect=ModelRunError("failed"))
+def test_search_domains_failure(mock_search):
+
+    result = search_domains.apply((stage_storage.put([]),) + _ARGS)
+    eq_(result.status, 'FAILURE')
+
+    eq_(os.listdir(stage_storage.stage_dir), [])
+
+
+@patch('hommod.tasks.modeler')
+def test_build_domain_model_failure(mock_modeler):
+
+    # A failing domain doesn't take the others down.
+    mock_modeler.build_model.side_effect = ModelRunError("failed")
+    eq_(_build_domain_model('alignment', *_ARGS), None)
+
+
+@raises(InitError)
+@patch('hommod.tasks.modeler')
+def test_build_domain_model_init_error(mock_modeler):
+
+    # A misconfigured worker must not look like a successful job.
+    mock_modeler.build_model.side_effect = InitError("yasara dir is not set")
+    _build_domain_model('alignment', *_ARGS)
+
+
+@_with_stage_dir
+@patch('hommod.tasks._release_job_key')
+@patch('hommod.tasks._build_domain_model', side_effect=lambda alignment, *args: None if alignment == 'bad'
+                                                                            else '/models/%s.zip' % alignment)
+def test_build_all_models(mock_build, mock_release):
+
+    ref = stage_storage.put(['a', 'bad', 'b'])
+    result = build_all_models.apply((ref,) + _ARGS)
+    eq_(result.get(), ['/models/a.zip', '/models/b.zip'])
+
+    eq_(os.listdir(stage_storage.stage_dir), [])
+    eq_(mock_release.call_args[1], {'all_domains': True})
+
+    # Without alignments, no models.
+    mock_release.reset_mock()
+    eq_(build_all_models.apply((None,) + _ARGS).get(), [])
+    eq_(mock_release.call_args[1], {'all_domains': True})
+
+
+@patch('hommod.tasks._release_job_key')
+def test_collect_models(mock_release):
+    eq_(collect_models.apply(([None, '/models/a.zip'],) + _ARGS).get(), ['/models/a.zip'])
+    ok_(mock_release.called)
+
+
+@patch('hommod.tasks._build_domain_model', side_effect=lambda alignment, *args: '/models/%s.zip' % alignment)
+@patch('hommod.tasks._search_domains', return_value=['a', 'b'])
+def test_create_models_directly(mock_search, mock_build):
+    eq_(create_models(*_ARGS), ['/models/a.zip', '/models/b.zip'])
@@ -8,25 +8,30 @@ DATA_DIR=/data
 FASTA_DIR=$DATA_DIR/fasta
 BLAST_DIR=$DATA_DIR/blast
 MODEL_DIR=$DATA_DIR/models
+SECSTR_DIR=$DATA_DIR/secstr
 
-mkdir -p $FASTA_DIR $BLAST_DIR
+mkdir -p $FASTA_DIR $BLAST_DIR $SECSTR_DIR
 
 MODELS_FASTA=$FASTA_DIR/models.fa
 MODELS_DB=$BLAST_DIR/models
 
 build_models () {
 
+    $PYTHON make_model_catalog.py
     $PYTHON make_models_fasta.py $MODELS_FASTA
     $MAKEBLASTDB -in $MODELS_FASTA -dbtype prot -out $MODELS_DB
 }
 
 TEMPLATES_FASTA=$FASTA_DIR/templates.fa
 TEMPLATES_DB=$BLAST_DIR/templates
+TEMPLATES_SECSTR=$SECSTR_DIR/templates.bin
 
 build_templates () {
 
     $PYTHON make_templates_fasta.py $TEMPLATES_FASTA
     $MAKEBLASTDB -in $TEMPLATES_FASTA -dbtype prot -out $TEMPLATES_DB
+
+    $PYTHON make_dssp_store.py $TEMPLATES_FASTA $TEMPLATES_SECSTR
 }
 
 SPROT_FASTA=$FASTA_DIR/uniprot_sprot.fasta
@@ -41,6 +46,8 @@ build_sprot () {
     sed -i 's/^>\([^ ]\+\) .*$/>\1/' $SPROT_FASTA
 
     $MAKEBLASTDB -in $SPROT_FASTA -dbtype prot -out $SPROT_DB
+
+    $PYTHON make_uniprot_index.py $SPROT_FASTA
 }
 
 TREMBL_FASTA=$FASTA_DIR/uniprot_trembl.fasta
@@ -55,6 +62,8 @@ build_trembl () {
     sed -i 's/^>\([^ ]\+\) .*$/>\1/' $TREMBL_FASTA
 
     $MAKEBLASTDB -in $TREMBL_FASTA -dbtype prot -out $TREMBL_DB
+
+    $PYTHON make_uniprot_index.py $TREMBL_FASTA
 }
 
 build_models &
@@ -65,3 +74,9 @@ build_sprot &
 wait
 
 /bin/echo -e "TITLE uniprot\nDBLIST $BLAST_DIR/uniprot_sprot $BLAST_DIR/uniprot_trembl" > $BLAST_DIR/uniprot.pal
+
+# Cached results are keyed by databank mtime, so the old ones can't be hit anymore.
+rm -rf $BLAST_DIR/cache
+
+# Stage results of jobs that failed halfway are never picked up.
+$PYTHON clean_stages.py